@@ -1,5 +1,9 @@
-from PIL import Image
+from PIL import Image, ImageOps
 import os
+import encoders
+import image_cache
+from config import ENCODER_PRESET
+from utils import read_metadata
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 import threading
@@ -12,7 +16,7 @@ class BatchProcessor:
     SUPPORTED_INPUT_FORMATS = [".JPG", ".PNG", ".BMP", ".JPEG", ".WEBP", ".GIF", ".TIFF", ".TIF", ".ICO", ".PPM"]
     
     # 支持的输出格式
-    SUPPORTED_OUTPUT_FORMATS = ["JPG", "PNG", "BMP", "WEBP", "TIFF", "ICO"]
+    SUPPORTED_OUTPUT_FORMATS = encoders.available_formats()
     
     def __init__(self, parent=None):
         self.parent = parent
@@ -218,12 +222,20 @@ class BatchProcessor:
                     
                     # 打开图片
                     img = Image.open(file_path)
-                    # 先检查是否是带有透明通道的调色板图像，如果是则先转换为RGBA
-                    if img.mode == 'P' and 'transparency' in img.info:
-                        img = img.convert('RGBA')
-                    # 转换为RGB模式（如果是RGBA或P模式）
-                    if img.mode not in ["RGB", "L"]:
-                        img = img.convert("RGB")
+                    metadata = read_metadata(img)
+                    # 编辑器打开过且未缩小的彩色图直接用缓存的像素（已摆正）
+                    cached = image_cache.load(file_path, full_resolution=True) if img.mode != "L" else None
+                    if cached is not None:
+                        img = cached
+                    else:
+                        # 先检查是否是带有透明通道的调色板图像，如果是则先转换为RGBA
+                        if img.mode == 'P' and 'transparency' in img.info:
+                            img = img.convert('RGBA')
+                        # 转换为RGB模式（如果是RGBA或P模式）
+                        if img.mode not in ["RGB", "L"]:
+                            img = img.convert("RGB")
+                        # 按 EXIF 方向摆正
+                        img = ImageOps.exif_transpose(img)
                     
                     # 生成输出文件名
                     filename = os.path.basename(file_path)
@@ -249,16 +261,10 @@ class BatchProcessor:
                             output_path = os.path.join(output_dir, output_filename)
                             counter += 1
                     
-                    # 保存图片
-                    save_options = {}
-                    if target_format == "JPG":
-                        save_options = {"quality": quality, "optimize": True}
-                    elif target_format == "WEBP":
-                        save_options = {"quality": quality, "method": 6}
-                    elif target_format == "TIFF":
-                        save_options = {"compression": "tiff_lzw"}
-                    
-                    img.save(output_path, **save_options)
+                    # 保存图片：参数来自编码器注册表的预设
+                    encoder = encoders.get_encoder(target_format)
+                    encoder.prepare(img).save(output_path, **encoder.save_options(ENCODER_PRESET, quality),
+                                              **encoder.metadata_options(metadata, img))
                     success_count += 1
                     
                 except Exception as e:
@@ -547,10 +553,15 @@ class BatchProcessor:
                 try:
                     # 打开图片
                     img = Image.open(file_path)
-                    # 先检查是否是带有透明通道的调色板图像，如果是则先转换为RGBA
-                    if img.mode == 'P' and 'transparency' in img.info:
-                        img = img.convert('RGBA')
-                    img = img.convert("RGB")
+                    metadata = read_metadata(img)
+                    cached = image_cache.load(file_path, full_resolution=True)
+                    if cached is not None:
+                        img = cached
+                    else:
+                        # 先检查是否是带有透明通道的调色板图像，如果是则先转换为RGBA
+                        if img.mode == 'P' and 'transparency' in img.info:
+                            img = img.convert('RGBA')
+                        img = ImageOps.exif_transpose(img.convert("RGB"))
                     img_width, img_height = img.size
                     
                     # 创建水印
@@ -622,7 +633,9 @@ class BatchProcessor:
                     # 保存图片
                     filename = os.path.basename(file_path)
                     output_path = os.path.join(output_dir, filename)
-                    img_with_watermark.save(output_path, quality=95)
+                    encoder = encoders.encoder_for_path(output_path)
+                    encoder.prepare(img_with_watermark).save(output_path, **encoder.save_options(ENCODER_PRESET),
+                                                             **encoder.metadata_options(metadata, img_with_watermark))
                     
                     success_count += 1
                 except Exception as e:
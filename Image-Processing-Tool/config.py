@@ -1,3 +1,5 @@
+import os
+
 # --- 配置配色方案 ---
 COLORS = {
     "bg_main": "#2b2b2b",  # 主背景深灰
@@ -8,3 +10,43 @@ COLORS = {
     "accent_hover": "#357abd",  # 强调色悬停
     "border": "#1a1a1a"  # 边框色
 }
+
+# --- 输出编码 ---
+# 编码预设："最快" / "平衡" / "最小"，越往后 CPU 耗时越多、文件越小（见 encoders.py）
+ENCODER_PRESET = "平衡"
+
+# --- 打开图片 ---
+WORKING_MAX_SIZE = 4000  # 编辑用工作图的最长边，超过时缩小
+
+# --- 工作图像素缓存 ---
+# 解码后的工作图以原始 RGB 像素存到磁盘，再次打开同一文件时通过内存映射读出，不必重新解码
+RAW_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".image_processing_tool", "raw")
+RAW_CACHE_MAX_BYTES = 2 * 1024 ** 3  # 缓存总大小上限，超出时淘汰最久未用的；设为 0 关闭缓存
+
+# --- 超大图分块处理 ---
+TILE_SIZE = 1024  # 分块边长（像素）
+TILED_MIN_PIXELS = 50_000_000  # 批量处理时像素数超过此值的图片改为分块流式处理
+TILED_MAX_PIXELS = 4_000_000_000  # 分块处理允许打开的最大像素数（放宽 Pillow 的解压炸弹检查）
+TILE_TEMP_DIR = None  # 分块处理的磁盘缓冲区目录，None 表示系统临时目录
+
+# --- 水印字体 ---
+# 可以用环境变量 IMAGE_TOOL_FONT 指定字体文件，否则按顺序尝试下列候选字体
+FONT_PATH = os.environ.get("IMAGE_TOOL_FONT")
+FONT_CANDIDATES = [
+    "msyh.ttc",  # Windows 微软雅黑
+    "simhei.ttf",
+    "/System/Library/Fonts/PingFang.ttc",  # macOS
+    "/System/Library/Fonts/STHeiti Medium.ttc",
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",  # Linux
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
+    "/usr/share/fonts/wenquanyi/wqy-microhei/wqy-microhei.ttc",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",  # 不含中文，至少可以缩放
+    "DejaVuSans.ttf",
+]
+FONT_CACHE_SIZE = 32  # 最多缓存多少个 (字体, 字号) 组合
+
+# --- 贴纸缩略图磁盘缓存 ---
+THUMB_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".image_processing_tool", "thumbnails")
@@ -1,11 +1,22 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, simpledialog, ttk, colorchooser
-from PIL import Image, ImageTk, ImageFilter, ImageEnhance, ImageOps
+from PIL import Image, ImageTk, ImageEnhance, ImageOps
+import math
 import os
-from config import COLORS
+import queue
+import threading
+from config import COLORS, ENCODER_PRESET, WORKING_MAX_SIZE
+import encoders
+import image_cache
+import tile_processor
+from utils import (
+    apply_orientation, atomic_save, auto_compress, encode_to_target, exif_orientation, exif_thumbnail,
+    jpeg_mcu_size, lossless_jpeg_transform, oriented_size, read_metadata, save_image_atomic
+)
+import pipeline
 from models import (
     DraggableTextWatermark, DoodleEditor, MosaicEditor, CropController,
-    DraggableSticker
+    DraggableSticker, StickerLayer, TiledWatermark
 )
 class EditorController:
     def __init__(self, view):
@@ -21,11 +32,32 @@ class EditorController:
         self.history = []  # 撤销栈
         self.redo_history = []  # 重做栈
         
+        # 后台打开图片
+        self._open_generation = 0  # 每次打开/取消递增，过期的加载结果直接丢弃
+        self._open_queue = queue.Queue()  # 后台线程 -> 主线程的消息 (generation, 类型, 内容)
+        self._opening = False
+        
+        # 后台保存
+        self._save_worker = None
+        self._save_result = None  # 完成提示文字或异常
+        self._save_progress = ""  # 后台线程写入的进度文字，主线程轮询显示
+        
+        # 非破坏编辑：editing_image 是工作尺寸的代理图，recipe 记录可重放到源文件上的操作
+        self.recipe = None  # pipeline 操作序列，None 表示有操作无法重放，只能保存工作图
+        self.recipe_history = []  # 与撤销栈对应的操作序列
+        self.recipe_redo = []  # 与重做栈对应的操作序列
+        self.source_scale = 1.0  # 源图相对工作图的缩放比例
+        self.lossless_mcu = None  # 源 JPEG 的 MCU 尺寸，None 表示不能无损保存
+        self.source_metadata = {}  # 源图的 EXIF/ICC，保存时带到输出文件
+        self._filter_op = None  # 滤镜面板当前预览的滤镜操作
+        
         # 画布视图状态
         self.zoom_scale = 1.0
         self.pan_offset_x = 0
         self.pan_offset_y = 0
         self.last_mouse_pos = (0, 0)
+        self._display_image = None  # 当前画布上显示的缩放图，局部刷新时就地修改
+        self._display_key = None
         
         # 当前工具状态
         self.current_tool = None
@@ -40,6 +72,7 @@ class EditorController:
         self.doodle_editor = None  # 涂鸦编辑器实例
         self.mosaic_editor = None  # 马赛克编辑器实例
         self.text_watermark = None  # 文字水印实例
+        self.tiled_watermark = None  # 平铺水印实例（预览中，尚未应用）
         self.crop_controller = None  # 裁剪控制器实例
         
         # 裁剪相关变量
@@ -51,6 +84,12 @@ class EditorController:
         self.move_offset = (0, 0)  # 裁剪框移动偏移量
         self.selected_ratio = None
         self.rotate_angle_var = None
+        self._rotate_angle = 0  # 正在预览（尚未应用）的任意旋转角度
+        self._rotate_proxy = None  # 旋转预览用的显示分辨率代理图
+        self._rotate_proxy_source = None
+        self._rotate_proxy_scale = 1.0
+        self._rotate_worker = None  # 后台执行全分辨率旋转的线程
+        self._rotate_result = None
         
         # 文字水印相关变量
         self.is_dragging_text = False  # 是否正在拖动文字
@@ -65,12 +104,15 @@ class EditorController:
         self.magnifier_scale = 1.5  # 调整放大倍数
         self.magnifier_x = 0  # 放大镜位置
         self.magnifier_y = 0
+        self.magnified_tk = None  # 放大镜复用的 PhotoImage
+        self._magnifier_job = None  # 待执行的放大镜重绘，保证每帧最多一次
         
         # 贴纸相关变量
         self.sticker_files = []  # 贴纸文件列表
         self.selected_sticker = None  # 当前选中的贴纸
         self.sticker_obj = None  # 当前贴纸的DraggableSticker对象
         self.sticker_image = None  # 当前贴纸的Image对象
+        self.sticker_layer = None  # 所有尚未确认的贴纸所在的叠加层
         self.sticker_tk = None  # 当前贴纸的ImageTk对象
         self.sticker_pos = (0, 0)  # 贴纸在图片上的位置
         self.is_dragging_sticker = False  # 是否正在拖动贴纸
@@ -111,45 +153,189 @@ class EditorController:
     
     # 核心图片处理方法
     def open_image(self):
-        """打开图片文件"""
+        """打开图片文件：解码在后台线程进行，先显示快速预览，准备好后换成工作图"""
         path = filedialog.askopenfilename(filetypes=[("Images", "*.jpg *.png *.jpeg *.bmp *.webp")])
-        if path:
+        if not path:
+            return
+        
+        self._open_generation += 1
+        generation = self._open_generation
+        self._opening = True
+        threading.Thread(target=self._load_image_in_thread, args=(path, generation), daemon=True).start()
+        self.view.update_status("正在打开图片...（Esc 取消）", duration=60000)
+        self.view.after(30, self._poll_open, generation)
+    
+    def cancel_open(self):
+        """取消正在进行的打开；后台解码无法中断，结果到达后会被丢弃"""
+        if not self._opening:
+            return
+        self._open_generation += 1
+        self._opening = False
+        self.view.update_status("已取消打开")
+        self._restore_after_open()
+    
+    def _load_image_in_thread(self, path, generation):
+        """后台线程：先产出快速预览，再解码工作图并创建各工具实例"""
+        def post(kind, payload=None):
+            self._open_queue.put((generation, kind, payload))
+        
+        try:
+            # 1. 快速预览：EXIF 内嵌缩略图，没有时 JPEG 按 1/8 draft 解码；工作图已在缓存中时不需要
+            if not image_cache.contains(path):
+                with Image.open(path) as img:
+                    quick = exif_thumbnail(img)
+                    if quick is None and img.format == "JPEG":
+                        img.draft("RGB", (img.width // 8, img.height // 8))
+                        quick = img.convert("RGB")
+                    if quick is not None:
+                        quick = apply_orientation(quick, exif_orientation(img))
+                if quick is not None:
+                    post("preview", quick)
+                if generation != self._open_generation:
+                    return
+            
+            # 2. 工作图
+            post("ready", self._decode_working_image(path))
+        except Exception as e:
+            post("error", e)
+    
+    def _decode_working_image(self, path):
+        """解码工作图并准备打开后需要的全部状态（在后台线程中运行，不访问 Tk）"""
+        # 先只读文件头：尺寸、方向和元数据
+        img = Image.open(path)
+        source_size = oriented_size(img)  # 摆正后的原图尺寸
+        orientation = exif_orientation(img)
+        metadata = read_metadata(img)
+        
+        # 再次打开同一文件时从缓存映射读出工作图，不重新解码
+        image = image_cache.load(path)
+        if image is None:
+            image = self._decode_pixels(img, orientation)
+            image_cache.store(path, image, source_size)
+        
+        # 未缩小、无需摆正的 RGB/灰度 JPEG 才能在保存时走无损变换
+        lossless_mcu = None
+        if img.mode in ("RGB", "L") and image.size == source_size and orientation == 1:
+            lossless_mcu = jpeg_mcu_size(img)
+        
+        return {
+            "path": path,
+            "image": image,
+            "source_size": source_size,
+            "lossless_mcu": lossless_mcu,
+            "metadata": metadata,
+            # 初始化新功能实例
+            "doodle_editor": DoodleEditor(image.copy()),
+            "mosaic_editor": MosaicEditor(image.copy()),
+            "text_watermark": DraggableTextWatermark(image.copy()),
+            "crop_controller": CropController(image.copy()),
+        }
+    
+    def _decode_pixels(self, img, orientation):
+        """把打开的源图解码成摆正、缩小到工作尺寸的 RGB 图"""
+        source_size = img.size
+        # 超大 JPEG 用 draft 在 DCT 域按 1/2、1/4、1/8 直接缩小解码，
+        # 不先解出全尺寸图，得到的尺寸不小于工作尺寸
+        if max(source_size) > WORKING_MAX_SIZE:
+            ratio = WORKING_MAX_SIZE / max(source_size)
+            img.draft(img.mode, (math.ceil(source_size[0] * ratio), math.ceil(source_size[1] * ratio)))
+        # 先检查是否是带有透明通道的调色板图像，如果是则先转换为RGBA
+        if img.mode == 'P' and 'transparency' in img.info:
+            img = img.convert('RGBA')
+        image = img.convert("RGB")
+        # 按 EXIF 方向摆正，之后的编辑和保存都基于摆正后的像素
+        if orientation != 1:
+            image = ImageOps.exif_transpose(image)
+        # 限制最大尺寸以防卡顿
+        if max(image.size) > WORKING_MAX_SIZE:
+            image.thumbnail((WORKING_MAX_SIZE, WORKING_MAX_SIZE))
+        return image
+    
+    def _poll_open(self, generation):
+        """主线程轮询后台打开的进度"""
+        while True:
             try:
-                self.filepath = path
-                # 尝试打开图片并处理带有透明通道的调色板图像
-                img = Image.open(path)
-                # 先检查是否是带有透明通道的调色板图像，如果是则先转换为RGBA
-                if img.mode == 'P' and 'transparency' in img.info:
-                    img = img.convert('RGBA')
-                image = img.convert("RGB")
-                # 限制最大尺寸以防卡顿
-                if max(image.size) > 4000:
-                    image.thumbnail((4000, 4000))
-
-                self.original_image = image
-                self.editing_image = image.copy()
-                self.preview_image = image.copy()
-
-                # 初始化新功能实例
-                self.doodle_editor = DoodleEditor(self.editing_image.copy())
-                self.mosaic_editor = MosaicEditor(self.editing_image.copy())
-                self.text_watermark = DraggableTextWatermark(self.editing_image.copy())
-                self.crop_controller = CropController(self.editing_image.copy())
-
-                self.history.clear()
-                self._reset_view()
-                
-                # 检查status_label是否存在再销毁
-                if hasattr(self.view, 'status_label') and self.view.status_label.winfo_exists():
-                    self.view.status_label.destroy()
-                
-                self.view.show_panel("adjust")  # 默认打开调节面板
-                self._update_canvas()
-                
-            except Exception as e:
+                msg_generation, kind, payload = self._open_queue.get_nowait()
+            except queue.Empty:
+                break
+            if msg_generation != self._open_generation:
+                continue  # 已取消或被新的打开取代
+            if kind == "preview":
+                self._show_open_preview(payload)
+            elif kind == "ready":
+                self._finish_open(payload)
+                return
+            elif kind == "error":
+                self._opening = False
+                self._restore_after_open()
                 # 显示错误信息
-                messagebox.showerror("错误", f"无法打开图片: {str(e)}")
-                print(f"打开图片失败: {str(e)}")
+                messagebox.showerror("错误", f"无法打开图片: {str(payload)}")
+                print(f"打开图片失败: {str(payload)}")
+                return
+        
+        if generation == self._open_generation:
+            self.view.after(30, self._poll_open, generation)
+    
+    def _show_open_preview(self, quick):
+        """工作图解码完成前，先把快速预览按窗口大小显示出来"""
+        cw = self.view.canvas.winfo_width()
+        ch = self.view.canvas.winfo_height()
+        scale = min(cw / quick.width, ch / quick.height) * 0.9
+        size = (max(1, int(quick.width * scale)), max(1, int(quick.height * scale)))
+        self.view.tk_image = ImageTk.PhotoImage(quick.resize(size, Image.Resampling.BILINEAR))
+        self._display_image = None
+        self._display_key = None
+        
+        if hasattr(self.view, 'status_label') and self.view.status_label.winfo_exists():
+            self.view.status_label.place_forget()
+        self.view.canvas.delete("all")
+        self.view.canvas.create_image(cw // 2, ch // 2, anchor=tk.CENTER, image=self.view.tk_image, tags="img")
+    
+    def _restore_after_open(self):
+        """打开取消或失败后恢复画布：重新显示当前图片或初始提示"""
+        if self.preview_image:
+            self._update_canvas()
+        else:
+            self.view.canvas.delete("all")
+            if hasattr(self.view, 'status_label') and self.view.status_label.winfo_exists():
+                self.view.status_label.place(relx=0.5, rely=0.5, anchor=tk.CENTER)
+    
+    def _finish_open(self, state):
+        """在主线程中换上后台准备好的工作图"""
+        self._opening = False
+        image = state["image"]
+        source_size = state["source_size"]
+        
+        self.filepath = state["path"]
+        self.lossless_mcu = state["lossless_mcu"]
+        self.source_metadata = state["metadata"]
+        # 工作图被缩小时，保存会把 recipe 重放到全分辨率源图上
+        self.source_scale = max(source_size) / max(image.size)
+        self.recipe = []
+        self.recipe_history.clear()
+        self.recipe_redo.clear()
+        
+        self.original_image = image
+        self.editing_image = image.copy()
+        self.preview_image = image.copy()
+        
+        self.doodle_editor = state["doodle_editor"]
+        self.mosaic_editor = state["mosaic_editor"]
+        self.text_watermark = state["text_watermark"]
+        self.crop_controller = state["crop_controller"]
+        
+        self.history.clear()
+        self.redo_history.clear()
+        self._reset_view()
+        
+        # 检查status_label是否存在再销毁
+        if hasattr(self.view, 'status_label') and self.view.status_label.winfo_exists():
+            self.view.status_label.destroy()
+        
+        self.view.show_panel("adjust", rebuild=True)  # 默认打开调节面板，滑块回到初始值
+        self.view.discard_panels()  # 裁剪角度、水印样式等面板状态不带到新图片
+        self._update_canvas()
+        self.view.update_status(f"已打开 {source_size[0]}x{source_size[1]}")
     
     def _reset_view(self):
         """重置视图缩放和偏移"""
@@ -171,6 +357,11 @@ class EditorController:
         """渲染画布 (核心渲染循环)"""
         if not self.preview_image:
             return
+        
+        # 任意角度旋转预览中：画代理图，不碰全分辨率图
+        if self._rotate_angle:
+            self._draw_rotate_preview()
+            return
 
         # 1. 计算显示尺寸
         orig_w, orig_h = self.preview_image.size
@@ -183,20 +374,20 @@ class EditorController:
             
             # 如果正在拖动水印，或者当前正在编辑水印，显示临时水印
             if (self.is_dragging_text or self.current_tool == "text") and self.text_watermark:
-                # 生成带临时水印的预览图
-                temp_img = self.text_watermark.apply()
+                # 生成带临时水印的预览图，只重新合成水印覆盖的区域
+                temp_img, _ = self.text_watermark.update_preview()
                 display_img = temp_img.resize((new_w, new_h),
                                             Image.Resampling.NEAREST if self.zoom_scale > 2 else Image.Resampling.LANCZOS)
             # 如果当前正在编辑涂鸦，显示临时涂鸦
             elif self.current_tool == "doodle" and self.doodle_editor:
                 # 生成带临时涂鸦的预览图
-                temp_img = self.doodle_editor.merge()
+                temp_img = self.doodle_editor.get_preview()
                 display_img = temp_img.resize((new_w, new_h),
                                             Image.Resampling.NEAREST if self.zoom_scale > 2 else Image.Resampling.LANCZOS)
             # 如果当前正在编辑马赛克，显示临时马赛克
             elif self.current_tool == "mosaic" and self.mosaic_editor:
                 # 生成带临时马赛克的预览图
-                temp_img = self.mosaic_editor.merge()
+                temp_img = self.mosaic_editor.get_preview()
                 display_img = temp_img.resize((new_w, new_h),
                                             Image.Resampling.NEAREST if self.zoom_scale > 2 else Image.Resampling.LANCZOS)
             else:
@@ -205,6 +396,9 @@ class EditorController:
                                             Image.Resampling.NEAREST if self.zoom_scale > 2 else Image.Resampling.LANCZOS)
             
             self.view.tk_image = ImageTk.PhotoImage(display_img)
+            # 记住当前显示图及其缩放，供局部刷新使用
+            self._display_image = display_img
+            self._display_key = (orig_w, orig_h, new_w, new_h)
 
             # 3. 计算居中坐标 + 偏移量
             cx = self.view.canvas.winfo_width() // 2 + self.pan_offset_x
@@ -250,19 +444,23 @@ class EditorController:
     
     def _apply_pending_changes(self):
         """应用当前面板的临时修改"""
+        # 未应用的任意角度旋转预览直接丢弃
+        self._discard_rotate_preview()
+        
         # 处理不同工具的应用逻辑
         if self.current_tool == "adjust":
             # 调节是实时的，不需要特殊应用，因为 preview 已经是 adjust 后的结果
             # 但我们需要把 preview 固化到 editing_image
             if self.preview_image != self.editing_image:
-                self._push_history()
+                self._push_history(pipeline.Enhance.record(self.editing_image, self.temp_adjustments))
                 self.editing_image = self.preview_image.copy()
                 self._reset_adjust_params()
         elif self.current_tool == "filter":
             # 切换工具时，应用当前滤镜效果
             if self.preview_image != self.editing_image:
-                self._push_history()
+                self._push_history(self._filter_op)
                 self.editing_image = self.preview_image.copy()
+            self._filter_op = None
         elif self.current_tool == "crop":
             # 裁剪需要显式确认，切换工具时自动取消裁剪框
             self.is_cropping = False
@@ -279,18 +477,20 @@ class EditorController:
         reset_canvas = False
         
         # 切换工具时重置贴纸状态
-        if self.sticker_image:
+        if self.sticker_image or self.sticker_layer:
             # 如果有未确认的贴纸，重置状态
             self.sticker_image = None
             self.selected_sticker = None
             self.sticker_obj = None
+            self.sticker_layer = None
             self.preview_image = self.editing_image.copy()
             reset_canvas = True
         
         # 切换工具时重置水印状态
-        if self.text_watermark:
+        if self.text_watermark or self.tiled_watermark:
             # 如果有未确认的水印，重置状态
             self.text_watermark = None
+            self.tiled_watermark = None
             self.preview_image = self.editing_image.copy()
             reset_canvas = True
         
@@ -337,37 +537,20 @@ class EditorController:
         self._update_canvas()
 
     def _apply_adjust(self):
-        self._push_history()
+        self._push_history(pipeline.Enhance.record(self.editing_image, self.temp_adjustments))
         self.editing_image = self.preview_image.copy()
         self._reset_adjust_params()
-        self.view.show_panel("adjust")  # 重置滑块
+        self.view.show_panel("adjust", rebuild=True)  # 重置滑块
 
     def _apply_filter_preview(self, mode):
         if not self.editing_image:
             return
-        img = self.editing_image.copy()
-
-        if mode == "黑白":
-            img = img.convert("L").convert("RGB")
-        elif mode == "怀旧":
-            # 简单的棕褐色滤镜模拟
-            sepia = []
-            r, g, b = (239, 224, 198)
-            for i in range(255):
-                sepia.extend((int(r * i / 255), int(g * i / 255), int(b * i / 255)))
-            img = img.convert("L")
-            img.putpalette(sepia)
-            img = img.convert("RGB")
-        elif mode == "模糊":
-            img = img.filter(ImageFilter.GaussianBlur(5))
-        elif mode == "浮雕":
-            img = img.filter(ImageFilter.EMBOSS)
-        elif mode == "轮廓":
-            img = img.filter(ImageFilter.CONTOUR)
-        elif mode == "原始":
-            img = self.editing_image.copy()
-
-        self.preview_image = img
+        
+        # 滤镜实现放在 pipeline 中，导出时对全分辨率源图用同一份实现重放
+        self._filter_op = pipeline.Filter(mode)
+        self.preview_image = pipeline.apply_filter(self.editing_image, mode)
+        if self.preview_image is self.editing_image:
+            self.preview_image = self.editing_image.copy()
         self._update_canvas()
 
     def _load_lut_file(self):
@@ -380,19 +563,19 @@ class EditorController:
             return
         
         try:
-            # 保存当前状态到撤销栈，以便用户可以撤销添加LUT的操作
-            self._push_history()
-            
-            # 应用LUT效果
+            # 只是预览，确认应用时才写入撤销栈
             from utils import apply_LUT
             self.preview_image = apply_LUT(self.editing_image, path)
+            self._filter_op = pipeline.LUT(path)
             self._update_canvas()
             messagebox.showinfo("提示", "LUT滤镜已加载")
         except Exception as e:
             messagebox.showerror("错误", f"无法加载LUT文件: {str(e)}")
 
     def _confirm_filter(self):
-        self._push_history()
+        # 没有预览过滤镜时确认不改变图片
+        self._push_history(self._filter_op or pipeline.Filter("原始"))
+        self._filter_op = None
         self.editing_image = self.preview_image.copy()
         # 更新其他功能实例
         self.doodle_editor = DoodleEditor(self.editing_image.copy())
@@ -423,9 +606,10 @@ class EditorController:
         """左旋转90°"""
         if not self.editing_image: return
         
-        self._push_history()
+        op = pipeline.Transpose(Image.Transpose.ROTATE_90)
+        self._push_history(op)
         # 左旋转90°（PIL的rotate方法，逆时针旋转）
-        self.editing_image = self.editing_image.rotate(90, expand=True)
+        self.editing_image = op.apply(self.editing_image)
         self.preview_image = self.editing_image.copy()
         
         # 更新其他功能实例
@@ -440,9 +624,10 @@ class EditorController:
         """右旋转90°"""
         if not self.editing_image: return
         
-        self._push_history()
+        op = pipeline.Transpose(Image.Transpose.ROTATE_270)
+        self._push_history(op)
         # 右旋转90°（PIL的rotate方法，顺时针旋转）
-        self.editing_image = self.editing_image.rotate(-90, expand=True)
+        self.editing_image = op.apply(self.editing_image)
         self.preview_image = self.editing_image.copy()
         
         # 更新其他功能实例
@@ -457,9 +642,10 @@ class EditorController:
         """镜面左右翻转"""
         if not self.editing_image: return
         
-        self._push_history()
+        op = pipeline.Transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+        self._push_history(op)
         # 左右翻转
-        self.editing_image = ImageOps.mirror(self.editing_image)
+        self.editing_image = op.apply(self.editing_image)
         self.preview_image = self.editing_image.copy()
         
         # 更新其他功能实例
@@ -474,9 +660,10 @@ class EditorController:
         """镜面上下翻转"""
         if not self.editing_image: return
         
-        self._push_history()
+        op = pipeline.Transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+        self._push_history(op)
         # 上下翻转
-        self.editing_image = ImageOps.flip(self.editing_image)
+        self.editing_image = op.apply(self.editing_image)
         self.preview_image = self.editing_image.copy()
         
         # 更新其他功能实例
@@ -493,23 +680,131 @@ class EditorController:
         angle = self.rotate_angle_var.get()
         if angle < 0:
             self.rotate_angle_var.set(0)
+            angle = 0
         elif angle > 360:
             self.rotate_angle_var.set(360)
+            angle = 360
         
-        # 实时预览旋转效果
-        if self.editing_image and self.preview_image:
-            # 基于原始图片进行旋转，而不是累积旋转
-            self.preview_image = self.editing_image.rotate(angle, expand=True)
-            self._update_canvas()
+        # 正在后台应用旋转时不再更新预览
+        if not self.editing_image or self._rotate_worker:
+            return
+        
+        # 实时预览只旋转显示分辨率的代理图，全分辨率旋转留到点击"旋转"时进行
+        self._rotate_angle = angle % 360
+        self._update_canvas()
+
+    def _get_rotate_proxy(self):
+        """返回缩放小于 1 时缩小到显示分辨率的代理图（否则就是编辑图本身），editing_image 不变时复用"""
+        scale = min(1.0, self.zoom_scale)
+        if self._rotate_proxy_source is not self.editing_image or self._rotate_proxy_scale != scale:
+            w, h = self.editing_image.size
+            size = (max(1, round(w * scale)), max(1, round(h * scale)))
+            if size == (w, h):
+                self._rotate_proxy = self.editing_image
+            else:
+                self._rotate_proxy = self.editing_image.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+            self._rotate_proxy_source = self.editing_image
+            self._rotate_proxy_scale = scale
+        return self._rotate_proxy, scale
+
+    def _draw_rotate_preview(self):
+        """在画布上绘制旋转后的代理图和用于找正的网格，只对画布可见的部分采样"""
+        proxy, scale = self._get_rotate_proxy()
+        canvas_w = self.view.canvas.winfo_width()
+        canvas_h = self.view.canvas.winfo_height()
+        cx = canvas_w // 2 + self.pan_offset_x
+        cy = canvas_h // 2 + self.pan_offset_y
+        
+        # 旋转（扩展画布）并缩放后的整图在画布上的范围，与可见区域求交
+        angle = math.radians(self._rotate_angle)
+        cos_a, sin_a = math.cos(angle), math.sin(angle)
+        dw, dh = self.editing_image.width * self.zoom_scale, self.editing_image.height * self.zoom_scale
+        w = max(1, round(abs(dw * cos_a) + abs(dh * sin_a)))
+        h = max(1, round(abs(dw * sin_a) + abs(dh * cos_a)))
+        x0, y0 = cx - w // 2, cy - h // 2
+        vx1, vy1 = max(0, x0), max(0, y0)
+        vx2, vy2 = min(canvas_w, x0 + w), min(canvas_h, y0 + h)
+        
+        self.view.canvas.delete("all")
+        # 显示的不是 preview_image 的缩放图，局部刷新不可用
+        self._display_image = None
+        self._display_key = None
+        if vx1 >= vx2 or vy1 >= vy2:
+            return
+        
+        # 画布像素 -> 代理图像素：相对图片中心逆向旋转（与 Image.rotate 相同）再换算到代理图分辨率
+        k = scale / self.zoom_scale
+        a, b = cos_a * k, -sin_a * k
+        d, e = sin_a * k, cos_a * k
+        c = proxy.width / 2 + a * (vx1 - cx) + b * (vy1 - cy)
+        f = proxy.height / 2 + d * (vx1 - cx) + e * (vy1 - cy)
+        resample = Image.Resampling.NEAREST if self.zoom_scale > 2 else Image.Resampling.BILINEAR
+        visible = proxy.transform((vx2 - vx1, vy2 - vy1), Image.AFFINE, (a, b, c, d, e, f), resample=resample)
+        
+        self.view.tk_image = ImageTk.PhotoImage(visible)
+        self.view.canvas.create_image(vx1, vy1, anchor=tk.NW, image=self.view.tk_image, tags="img")
+        
+        # 找正网格：水平/垂直参考线，约每 60 像素一条，只画可见部分
+        step = 60
+        first_x = x0 + (w % step) // 2
+        first_y = y0 + (h % step) // 2
+        for x in range(first_x + max(0, -(-(vx1 - first_x) // step)) * step, vx2 + 1, step):
+            self.view.canvas.create_line(x, vy1, x, vy2, fill="#ffffff", dash=(2, 4), tags="rotate_grid")
+        for y in range(first_y + max(0, -(-(vy1 - first_y) // step)) * step, vy2 + 1, step):
+            self.view.canvas.create_line(vx1, y, vx2, y, fill="#ffffff", dash=(2, 4), tags="rotate_grid")
+
+    def _discard_rotate_preview(self):
+        """放弃尚未应用的旋转预览"""
+        if self._rotate_angle:
+            self._rotate_angle = 0
+            if self.rotate_angle_var is not None:
+                self.rotate_angle_var.set(0)
+        self._rotate_proxy = None
+        self._rotate_proxy_source = None
 
     def _rotate_by_angle(self):
-        """根据自定义角度旋转图片"""
-        if not self.editing_image: return
+        """根据自定义角度旋转图片：全分辨率高质量旋转在后台线程中执行一次"""
+        if not self.editing_image or self._rotate_worker or not self._rotate_angle:
+            return
         
-        self._push_history()
+        source = self.editing_image
+        op = pipeline.Rotate(self._rotate_angle)
+        self._rotate_result = None
+        self._rotate_worker = threading.Thread(target=self._rotate_in_thread, args=(source, op), daemon=True)
+        self._rotate_worker.start()
+        self.view.update_status("正在旋转...", duration=60000)
+        self.view.after(50, self._poll_rotate_worker, source, op)
+
+    def _rotate_in_thread(self, source, op):
+        """后台线程：对编辑图做一次双三次插值旋转"""
+        try:
+            self._rotate_result = op.apply(source)
+        except Exception as e:
+            self._rotate_result = e
+
+    def _poll_rotate_worker(self, source, op):
+        """在主线程轮询后台旋转，完成后应用结果"""
+        if self._rotate_worker.is_alive():
+            self.view.after(50, self._poll_rotate_worker, source, op)
+            return
         
-        # 将实时预览的旋转效果应用到编辑图像
-        self.editing_image = self.preview_image.copy()
+        self._rotate_worker = None
+        result, self._rotate_result = self._rotate_result, None
+        if isinstance(result, Exception):
+            print(f"旋转失败: {str(result)}")
+            messagebox.showerror("错误", f"旋转失败: {str(result)}")
+            self.view.update_status("旋转失败")
+            return
+        # 旋转期间图片已被其他操作（撤销等）替换，结果作废
+        if self.editing_image is not source:
+            self.view.update_status("图片已改变，旋转已取消")
+            return
+        
+        self._push_history(op)
+        
+        # 将旋转结果应用到编辑图像
+        self.editing_image = result
+        self.preview_image = self.editing_image.copy()
         
         # 更新其他功能实例
         self.doodle_editor = DoodleEditor(self.editing_image.copy())
@@ -517,15 +812,18 @@ class EditorController:
         self.crop_controller = CropController(self.editing_image.copy())
         
         # 重置旋转角度滑块
-        self.rotate_angle_var.set(0)
+        self._discard_rotate_preview()
         
         self._reset_view()
         self._update_canvas()
+        self.view.update_status("旋转完成")
 
     def _init_crop_tool(self):
         """初始化裁剪工具，确保所有状态正确设置"""
         self.is_cropping = True
         self.current_tool = "crop"  # 确保当前工具为裁剪
+        # 裁剪框画在未旋转的图片上，先放弃旋转预览
+        self._discard_rotate_preview()
         self.view.canvas.config(cursor="cross")
         
         # 重置裁剪相关状态
@@ -827,7 +1125,7 @@ class EditorController:
             
             # 执行裁剪
             crop_box = (img_x1, img_y1, img_x2, img_y2)
-            self._push_history()
+            self._push_history(pipeline.Crop(crop_box))
             
             # 执行裁剪并检查结果
             cropped_img = self.editing_image.crop(crop_box)
@@ -876,6 +1174,7 @@ class EditorController:
             self._push_history()
             self.editing_image = self.original_image.copy()
             self.preview_image = self.original_image.copy()
+            self.recipe = []
             self._reset_adjust_params()
             # 重新初始化所有功能实例
             from models import DoodleEditor, DraggableTextWatermark, CropController, MosaicEditor
@@ -1051,6 +1350,14 @@ class EditorController:
         if not self.editing_image:
             return
         
+        # 平铺模式：整张图片预览，不需要拖动
+        if hasattr(self, "watermark_tile_var") and self.watermark_tile_var.get():
+            self._update_tiled_preview()
+            return
+        if self.tiled_watermark:
+            self.tiled_watermark = None
+            self.preview_image = self.editing_image.copy()
+        
         # 创建新的水印对象，基于当前编辑图像
         is_time_watermark = self.watermark_type.get() == "time"
         self.text_watermark = DraggableTextWatermark(self.editing_image.copy(), is_time_watermark)
@@ -1078,15 +1385,53 @@ class EditorController:
         # 更新画布
         self._update_canvas()
     
+    def _update_tiled_preview(self):
+        """按当前文字和样式生成平铺水印预览"""
+        from datetime import datetime
+        if self.watermark_type.get() == "time":
+            text = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        else:
+            text = self.watermark_text_var.get()
+        
+        self.text_watermark = None
+        self._hide_delete_button()
+        if not text.strip():
+            # 空文字时不显示任何内容
+            self.tiled_watermark = None
+            self.preview_image = self.editing_image.copy()
+        else:
+            self.tiled_watermark = TiledWatermark.from_text(
+                text,
+                self.watermark_size_var.get(),
+                self.watermark_color,
+                self.watermark_stroke_color,
+                self.watermark_stroke_width_var.get(),
+                spacing=self.watermark_tile_spacing_var.get(),
+                angle=self.watermark_tile_angle_var.get(),
+                opacity=self.watermark_alpha_var.get()
+            )
+            self.preview_image = self.tiled_watermark.apply(self.editing_image)
+        self._update_canvas()
+    
     def _add_text_watermark(self):
         """添加文字水印"""
-        if not self.editing_image or not self.text_watermark:
+        if self.editing_image and self.tiled_watermark:
+            # 平铺水印的预览就是最终结果
+            self._push_history(pipeline.Patch.from_diff(self.editing_image, self.preview_image))
+            self.editing_image = self.preview_image.copy()
+            self.tiled_watermark = None
+            self.view.show_panel("text", rebuild=True)
+            self._update_canvas()
+            messagebox.showinfo("提示", "水印已添加到图片")
             return
         
-        self._push_history()
+        if not self.editing_image or not self.text_watermark:
+            return
         
         # 将水印应用到编辑图像
-        self.editing_image = self.text_watermark.apply()
+        result = self.text_watermark.apply()
+        self._push_history(pipeline.Patch.from_diff(self.editing_image, result))
+        self.editing_image = result
         
         # 更新预览图像为编辑图像的副本，此时已经包含了固定的水印
         self.preview_image = self.editing_image.copy()
@@ -1097,7 +1442,7 @@ class EditorController:
         self.text_watermark = None
         
         # 确保当前工具仍然是text，但此时没有活跃的水印对象
-        self.view.show_panel("text")
+        self.view.show_panel("text", rebuild=True)
         
         # 隐藏删除按钮
         self._hide_delete_button()
@@ -1154,12 +1499,14 @@ class EditorController:
         # 更新水印位置
         self.text_watermark.move_to(new_px, new_py)
         
+        # 只刷新水印新旧位置覆盖的区域
+        image, box = self.text_watermark.update_preview()
+        if box:
+            self._refresh_canvas_region(box, image)
+        
         # 更新删除按钮位置
         self._hide_delete_button()
         self._show_delete_button()
-        
-        # 更新画布
-        self._update_canvas()
 
     def _on_text_watermark_release(self, event):
         """水印释放事件"""
@@ -1253,20 +1600,18 @@ class EditorController:
         # 记录开始位置
         self.last_draw_pos = (event.x, event.y)
         
-        # 初始化点列表，用于存储绘制路径点
-        self.draw_points = []
-        
-        # 将第一个点转换为图片坐标并添加到点列表
+        # 将第一个点转换为图片坐标，交给笔画平滑引擎
         px, py = self._screen_to_image(event.x, event.y)
         if px is not None and py is not None:
-            self.draw_points.append((px, py))
-            # 绘制第一个点
-            self.doodle_editor.draw_line(px, py, px, py)
-            self._update_canvas()
+            box = self.doodle_editor.begin_stroke(px, py)
+            if box:
+                self._refresh_canvas_region(box, self.doodle_editor.get_preview())
+            if self.show_magnifier:
+                self._schedule_magnifier()
 
     def _doodle_draw(self, event):
         """涂鸦绘制事件"""
-        if not self.doodle_editor or not hasattr(self, "last_draw_pos") or not hasattr(self, "draw_points"):
+        if not self.doodle_editor or not hasattr(self, "last_draw_pos"):
             return
         
         # 转换为图片坐标
@@ -1278,15 +1623,12 @@ class EditorController:
         if self.show_magnifier:
             self.magnifier_x, self.magnifier_y = event.x, event.y
         
-        # 绘制线条 - 使用图片坐标
-        last_px, last_py = self.draw_points[-1]
-        self.doodle_editor.draw_line(last_px, last_py, px, py)
-        
-        # 将点添加到点列表
-        self.draw_points.append((px, py))
-        
-        # 更新画布
-        self._update_canvas()
+        # 由平滑引擎抽稀和重采样，距离太近的事件不会产生新笔触，也就不必重绘
+        box = self.doodle_editor.continue_stroke(px, py)
+        if box:
+            self._refresh_canvas_region(box, self.doodle_editor.get_preview())
+        if self.show_magnifier:
+            self._schedule_magnifier()
 
     def _doodle_end(self, event):
         """涂鸦结束事件"""
@@ -1296,23 +1638,28 @@ class EditorController:
         # 绘制结束，隐藏放大镜
         self.show_magnifier = False
         
-        # 清理临时属性
+        # 补画最后一段
         if hasattr(self, "last_draw_pos"):
+            box = self.doodle_editor.end_stroke()
             delattr(self, "last_draw_pos")
+            if box:
+                self._refresh_canvas_region(box, self.doodle_editor.get_preview())
         
-        if hasattr(self, "draw_points"):
-            delattr(self, "draw_points")
-        
-        self._update_canvas()
+        # 移除放大镜
+        if self._magnifier_job is not None:
+            self.view.after_cancel(self._magnifier_job)
+            self._magnifier_job = None
+        self.view.canvas.delete("magnifier")
 
     def _apply_doodle(self):
         """应用涂鸦"""
         if not self.doodle_editor:
             return
         
-        self._push_history()
         # 合并涂鸦到编辑图像
-        self.editing_image = self.doodle_editor.merge()
+        result = self.doodle_editor.merge()
+        self._push_history(pipeline.Patch.from_diff(self.editing_image, result))
+        self.editing_image = result
         self.preview_image = self.editing_image.copy()
         
         # 重新初始化涂鸦编辑器
@@ -1391,6 +1738,41 @@ class EditorController:
         # 设置光标
         self.view.canvas.config(cursor="cross")
 
+    def _refresh_canvas_region(self, box, source):
+        """只重新缩放 source 中 box 区域并贴回当前显示图，缩放或尺寸变化时退回整体重绘
+
+        :param box: 图像坐标下的 (x1, y1, x2, y2)
+        :param source: 与 preview_image 同尺寸的最新画面
+        """
+        display = self._display_image
+        w, h = source.size
+        new_w, new_h = int(w * self.zoom_scale), int(h * self.zoom_scale)
+        if display is None or self.view.tk_image is None or self._display_key != (w, h, new_w, new_h):
+            self._update_canvas()
+            return
+
+        sx, sy = new_w / w, new_h / h
+        # 向外多取两个显示像素，避免 LANCZOS 在拼接处留下接缝
+        dx1 = max(0, int(box[0] * sx) - 2)
+        dy1 = max(0, int(box[1] * sy) - 2)
+        dx2 = min(new_w, int(math.ceil(box[2] * sx)) + 2)
+        dy2 = min(new_h, int(math.ceil(box[3] * sy)) + 2)
+        if dx1 >= dx2 or dy1 >= dy2:
+            return
+
+        resample = Image.Resampling.NEAREST if self.zoom_scale > 2 else Image.Resampling.LANCZOS
+        region = source.resize((dx2 - dx1, dy2 - dy1), resample,
+                               box=(dx1 / sx, dy1 / sy, dx2 / sx, dy2 / sy))
+        display.paste(region, (dx1, dy1))
+        # 画布上的图片对象保持不变，只更新其像素
+        photo = self.view.tk_image
+        if (dx2 - dx1) * (dy2 - dy1) * 2 > new_w * new_h:
+            photo.paste(display)  # 脏区域超过显示图一半时整图上传更省事
+            return
+        # 只把脏区域上传给 Tk：先做成区域大小的 PhotoImage，再用 Tk 的 photo copy 拷到显示图的对应位置
+        patch = ImageTk.PhotoImage(region)
+        photo.tk.call(str(photo), "copy", str(patch), "-to", dx1, dy1, "-compositingrule", "set")
+
     def _on_mosaic_press(self, event):
         """马赛克按下事件"""
         if not self.mosaic_editor:
@@ -1402,10 +1784,11 @@ class EditorController:
             return
         
         # 应用马赛克
-        self.mosaic_editor.apply_mosaic_area(px, py)
-        # 合并并更新预览
-        self.preview_image = self.mosaic_editor.merge()
-        self._update_canvas()
+        box = self.mosaic_editor.begin_stroke(px, py)
+        # 预览直接引用编辑器的合成缓存，之后只刷新笔触覆盖的区域
+        self.preview_image = self.mosaic_editor.get_preview()
+        if box:
+            self._refresh_canvas_region(box, self.preview_image)
 
     def _on_mosaic_drag(self, event):
         """马赛克拖动事件"""
@@ -1417,28 +1800,35 @@ class EditorController:
         if px is None or py is None:
             return
         
-        # 应用马赛克
-        self.mosaic_editor.apply_mosaic_area(px, py)
-        # 合并并更新预览
-        self.preview_image = self.mosaic_editor.merge()
-        self._update_canvas()
+        # 应用马赛克，没有产生新笔触时跳过重绘
+        box = self.mosaic_editor.continue_stroke(px, py)
+        if box:
+            self._refresh_canvas_region(box, self.mosaic_editor.get_preview())
 
     def _on_mosaic_release(self, event):
         """马赛克释放事件"""
-        pass
+        if not self.mosaic_editor:
+            return
+        
+        # 补齐最后一段笔画
+        box = self.mosaic_editor.end_stroke()
+        if box:
+            self._refresh_canvas_region(box, self.mosaic_editor.get_preview())
 
     def _apply_mosaic(self):
         """应用马赛克"""
         if not self.mosaic_editor:
             return
         
-        self._push_history()
         # 合并马赛克到编辑图像
-        self.editing_image = self.mosaic_editor.merge()
+        result = self.mosaic_editor.merge()
+        self._push_history(pipeline.Patch.from_diff(self.editing_image, result))
+        self.editing_image = result
         self.preview_image = self.editing_image.copy()
         
-        # 重新初始化马赛克编辑器
+        # 重新初始化马赛克编辑器，并在后台预先计算新底图的马赛克效果
         self.mosaic_editor = MosaicEditor(self.editing_image.copy())
+        self.mosaic_editor.set_mosaic_params(self.mosaic_size_var.get(), self.mosaic_type_var.get())
         
         # 更新画布
         self._update_canvas()
@@ -1448,10 +1838,13 @@ class EditorController:
         """选择贴纸"""
         try:
             self.selected_sticker = sticker_path
-            # 使用DraggableSticker类创建贴纸对象
+            # 使用DraggableSticker类创建贴纸对象，加到贴纸层最上面，之前的贴纸保留
             if self.editing_image:
+                if self.sticker_layer is None:
+                    self.sticker_layer = StickerLayer(self.editing_image)
                 self.sticker_obj = DraggableSticker(self.editing_image, sticker_path)
                 self.sticker_image = self.sticker_obj.sticker
+                self.sticker_layer.add(self.sticker_obj)
                 self.sticker_pos = (self.editing_image.width // 2, self.editing_image.height // 2)
                 self.sticker_scale = 1.0
                 self.sticker_rotation = 0
@@ -1475,18 +1868,45 @@ class EditorController:
             self.sticker_image = None
             self.sticker_obj = None
 
-    def _update_sticker_preview(self):
-        """更新贴纸预览"""
-        if not self.editing_image or not self.sticker_obj:
+    def _update_sticker_preview(self, region=False):
+        """更新贴纸预览
+
+        :param region: 为 True 时只刷新贴纸新旧位置覆盖的区域，画布上其他元素保持不变
+        """
+        if not self.editing_image or not self.sticker_obj or not self.sticker_layer:
             return
         
-        # 使用DraggableSticker对象的apply方法更新预览
-        self.preview_image = self.sticker_obj.apply()
-        self._update_canvas()
+        # 预览图只在当前贴纸新旧位置覆盖的区域重新合成
+        box = self.sticker_layer.update(self.sticker_obj)
+        self.preview_image = self.sticker_layer.image
+        if not region:
+            self._update_canvas()
+        elif box:
+            self._refresh_canvas_region(box, self.preview_image)
+
+    def _activate_sticker(self, sticker):
+        """把点中的贴纸设为当前贴纸：移到最上层，滑块显示它的缩放和角度"""
+        self.sticker_obj = sticker
+        self.sticker_image = sticker.sticker
+        self.sticker_scale = sticker.scale
+        self.sticker_rotation = sticker.rotation
+        if hasattr(self.view, 'sticker_scale_var'):
+            self.view.sticker_scale_var.set(self.sticker_scale)
+            self.view.sticker_scale_slider.configure(value=self.sticker_scale)
+        if hasattr(self.view, 'sticker_rotation_var'):
+            self.view.sticker_rotation_var.set(self.sticker_rotation)
+            self.view.sticker_rotation_slider.configure(value=self.sticker_rotation)
+        
+        box = self.sticker_layer.raise_to_top(sticker)
+        if box:
+            self._refresh_canvas_region(box, self.sticker_layer.image)
+        # 删除按钮和旋转手柄跟随当前贴纸
+        if self.show_rotation_handle:
+            self._show_rotation_handle()
 
     def _on_sticker_press(self, event):
         """贴纸拖动或旋转开始"""
-        if not self.sticker_obj or not self.editing_image:
+        if not self.sticker_layer or not self.editing_image:
             return
         
         # 转换屏幕坐标到图片坐标
@@ -1504,16 +1924,11 @@ class EditorController:
                 self.view.canvas.config(cursor="fleur")
                 return
         
-        # 获取贴纸的边界框
-        bbox = self.sticker_obj.get_bbox()
-        # 计算贴纸的实际边界
-        x1 = bbox[0]
-        y1 = bbox[1]
-        x2 = bbox[2]
-        y2 = bbox[3]
-        
-        # 判断点击是否落在贴纸内
-        if x1 <= px <= x2 and y1 <= py <= y2:
+        # 通过贴纸层的空间索引找到点中的最上层贴纸
+        hit = self.sticker_layer.hit_test(px, py)
+        if hit:
+            if hit is not self.sticker_obj:
+                self._activate_sticker(hit)
             # 进入拖动模式
             self.is_dragging_sticker = True
             # 计算偏移量：屏幕坐标 - 贴纸在屏幕上的坐标
@@ -1551,7 +1966,7 @@ class EditorController:
                 self._show_rotation_handle()
             
             # 更新预览
-            self._update_sticker_preview()
+            self._update_sticker_preview(region=True)
         elif self.is_rotating_sticker:
             # 旋转逻辑
             # 获取贴纸中心坐标（图像坐标）
@@ -1602,7 +2017,7 @@ class EditorController:
 
     def _on_sticker_right_click(self, event):
         """右键点击贴纸：显示删除按钮和旋转手柄"""
-        if not self.sticker_obj:
+        if not self.sticker_layer:
             return
 
         # 检查是否点中了贴纸区域
@@ -1610,16 +2025,11 @@ class EditorController:
         if px is None:
             return
 
-        # 获取贴纸的边界框
-        bbox = self.sticker_obj.get_bbox()
-        # 计算贴纸的实际边界
-        x1 = bbox[0]
-        y1 = bbox[1]
-        x2 = bbox[2]
-        y2 = bbox[3]
-
-        # 判断点击是否落在贴纸内
-        if x1 <= px <= x2 and y1 <= py <= y2:
+        # 判断点击是否落在某个贴纸上
+        hit = self.sticker_layer.hit_test(px, py)
+        if hit:
+            if hit is not self.sticker_obj:
+                self._activate_sticker(hit)
             # 显示删除按钮和旋转手柄
             self._show_sticker_delete_button()
             self._show_rotation_handle()
@@ -1627,14 +2037,15 @@ class EditorController:
 
     def _confirm_sticker(self):
         """确认添加贴纸"""
-        if not self.editing_image or not self.sticker_obj:
+        if not self.editing_image or not self.sticker_layer:
             messagebox.showinfo("提示", "请先选择一个贴纸")
             return
         
-        self._push_history()
+        self._push_history(pipeline.Patch.from_diff(self.editing_image, self.sticker_layer.image))
         
-        # 将贴纸应用到编辑图像
-        self.editing_image = self.preview_image.copy()
+        # 将贴纸层上的所有贴纸一起应用到编辑图像
+        self.editing_image = self.sticker_layer.image.copy()
+        self.sticker_layer = None
         
         # 更新预览图像为编辑图像的副本，此时已经包含了固定的贴纸
         self.preview_image = self.editing_image.copy()
@@ -1652,6 +2063,9 @@ class EditorController:
         if hasattr(self.view, 'sticker_scale_var'):
             self.view.sticker_scale_var.set(1.0)
             self.view.sticker_scale_slider.configure(value=1.0)
+        if hasattr(self.view, 'sticker_rotation_var'):
+            self.view.sticker_rotation_var.set(0.0)
+            self.view.sticker_rotation_slider.configure(value=0.0)
         
         # 确保当前工具仍然是sticker，但此时没有活跃的贴纸对象
         self.view.show_panel("sticker")
@@ -1668,28 +2082,27 @@ class EditorController:
         self._update_canvas()
         messagebox.showinfo("提示", "贴纸已添加")
 
-    def _delete_sticker(self, event=None):
-        """删除当前贴纸"""
-        if self.sticker_obj:
-            self.sticker_image = None
-            self.selected_sticker = None
-            self.sticker_obj = None
-            self.sticker_scale = 1.0
-            self.sticker_rotation = 0
-            self.preview_image = self.editing_image.copy()
-            self._hide_delete_button()
-            self._hide_rotation_handle()
-            self.show_sticker_delete_button = False
-            self.show_rotation_handle = False
-            self._update_canvas()
-    
-    def _push_history(self):
-        """保存当前 editing_image 到历史栈"""
+    def _push_history(self, op=None):
+        """
+        保存当前 editing_image 到历史栈
+        
+        op: 即将执行的 pipeline 操作，导出时重放到全分辨率源图上；
+            为 None 表示该操作无法重放，此后只能保存工作图
+        """
         if self.editing_image:
             self.history.append(self.editing_image.copy())
+            self.recipe_history.append(self.recipe)
             # 新操作时清空重做栈
             self.redo_history.clear()
-            if len(self.history) > 15: self.history.pop(0)
+            self.recipe_redo.clear()
+            if len(self.history) > 15:
+                self.history.pop(0)
+                self.recipe_history.pop(0)
+            
+            if self.recipe is not None and op is not None:
+                self.recipe = self.recipe + [op]
+            else:
+                self.recipe = None
     
     def undo(self):
         """撤销操作"""
@@ -1699,8 +2112,10 @@ class EditorController:
             
             # 将当前状态保存到重做栈
             self.redo_history.append(self.editing_image.copy())
+            self.recipe_redo.append(self.recipe)
             # 从撤销栈获取上一个状态
             self.editing_image = self.history.pop()
+            self.recipe = self.recipe_history.pop()
             self.preview_image = self.editing_image.copy()
             self._reset_adjust_params()
             
@@ -1712,6 +2127,7 @@ class EditorController:
             self.sticker_image = None
             self.selected_sticker = None
             self.sticker_obj = None
+            self.sticker_layer = None
             self.text_watermark = None
             self.show_delete_button = False
             self.show_sticker_delete_button = False
@@ -1738,7 +2154,7 @@ class EditorController:
             
             # 更新视图面板，确保显示正确的工具面板
             if hasattr(self.view, 'show_panel'):
-                self.view.show_panel("adjust")
+                self.view.show_panel("adjust", rebuild=True)
     
     def redo(self):
         """重做操作"""
@@ -1748,8 +2164,10 @@ class EditorController:
             
             # 将当前状态保存到撤销栈
             self.history.append(self.editing_image.copy())
+            self.recipe_history.append(self.recipe)
             # 从重做栈获取下一个状态
             self.editing_image = self.redo_history.pop()
+            self.recipe = self.recipe_redo.pop()
             self.preview_image = self.editing_image.copy()
             self._reset_adjust_params()
             
@@ -1761,6 +2179,7 @@ class EditorController:
             self.sticker_image = None
             self.selected_sticker = None
             self.sticker_obj = None
+            self.sticker_layer = None
             self.text_watermark = None
             self.show_delete_button = False
             self.show_sticker_delete_button = False
@@ -1787,14 +2206,14 @@ class EditorController:
             
             # 更新视图面板，确保显示正确的工具面板
             if hasattr(self.view, 'show_panel'):
-                self.view.show_panel("adjust")
+                self.view.show_panel("adjust", rebuild=True)
     
     def auto_enhance(self):
         """自动增强图片"""
         if not self.editing_image: return
-        self._push_history()
-        from PIL import ImageOps
-        self.editing_image = ImageOps.autocontrast(self.editing_image)
+        op = pipeline.Autocontrast.record(self.editing_image)
+        self._push_history(op)
+        self.editing_image = op.apply(self.editing_image.copy())
         self.preview_image = self.editing_image.copy()
         self._update_canvas()
     
@@ -1860,6 +2279,10 @@ class EditorController:
             
             # 转换质量
             'quality_var': tk.IntVar(value=95),
+            # 编码预设：最快 / 平衡 / 最小
+            'preset_var': tk.StringVar(value=ENCODER_PRESET),
+            # 目标大小 (KB)，JPG/WEBP 输出时按大小自动选择质量，0 表示不限制
+            'target_kb_var': tk.IntVar(value=0),
             
             # 重命名选项
             'rename_var': tk.BooleanVar(value=False),
@@ -1972,6 +2395,12 @@ class EditorController:
         selected_files = vars['selected_files']
         target_format = vars['target_format_var'].get().upper()
         quality = vars['quality_var'].get()
+        preset = vars['preset_var'].get()
+        encoder = encoders.get_encoder(target_format)
+        try:
+            target_kb = max(0, vars['target_kb_var'].get())
+        except tk.TclError:
+            target_kb = 0
         output_dir = vars['output_dir']
         
         # 转换统计
@@ -1991,12 +2420,25 @@ class EditorController:
                     skipped_count += 1
                     continue
                 
-                # 打开图片
-                img = Image.open(file_path)
+                # 打开图片，先取出要保留的 EXIF/ICC
+                img = tile_processor.open_image(file_path)
+                metadata = read_metadata(img)
+                # 超大图交给分块流式处理，这里不解码（按目标大小压缩需要整图反复编码，仍在内存中进行）
+                streaming = tile_processor.should_tile(img) and not (target_kb and target_format in ("JPG", "WEBP"))
+                tile_processor.check_pixels(img, streaming)
                 
-                # 转换为RGB模式（如果是RGBA或P模式）
-                if img.mode not in ["RGB", "L"]:
-                    img = img.convert("RGB")
+                # 编辑器打开过且未缩小的彩色图直接用缓存的像素（已摆正）
+                cached = None
+                if not streaming and img.mode != "L":
+                    cached = image_cache.load(file_path, full_resolution=True)
+                if cached is not None:
+                    img = cached
+                elif not streaming:
+                    # 转换为RGB模式（如果是RGBA或P模式）
+                    if img.mode not in ["RGB", "L"]:
+                        img = img.convert("RGB")
+                    # 按 EXIF 方向摆正
+                    img = ImageOps.exif_transpose(img)
                 
                 # 生成输出文件名
                 filename = os.path.basename(file_path)
@@ -2010,7 +2452,7 @@ class EditorController:
                 else:
                     new_name = name_without_ext
                 
-                output_filename = f"{new_name}.{target_format.lower()}"
+                output_filename = f"{new_name}{encoder.extension}"
                 output_path = os.path.join(output_dir, output_filename)
                 
                 # 检查输出文件是否已存在
@@ -2018,20 +2460,24 @@ class EditorController:
                     # 自动重命名
                     counter = 1
                     while os.path.exists(output_path):
-                        output_filename = f"{new_name}_{counter}.{target_format.lower()}"
+                        output_filename = f"{new_name}_{counter}{encoder.extension}"
                         output_path = os.path.join(output_dir, output_filename)
                         counter += 1
                 
-                # 保存图片
-                save_options = {}
-                if target_format == "JPG":
-                    save_options = {"quality": quality, "optimize": True}
-                elif target_format == "WEBP":
-                    save_options = {"quality": quality, "method": 6}
-                elif target_format == "TIFF":
-                    save_options = {"compression": "tiff_lzw"}
-                
-                img.save(output_path, **save_options)
+                # 按目标大小压缩：多组候选参数并行编码，取放得下的最高质量
+                if target_kb and target_format in ("JPG", "WEBP"):
+                    fmt = "JPEG" if target_format == "JPG" else "WEBP"
+                    data = encode_to_target(img, target_kb * 1024, fmt,
+                                            metadata=lambda im: encoder.metadata_options(metadata, im))
+                    with open(output_path, "wb") as f:
+                        f.write(data)
+                elif streaming:
+                    img.close()
+                    tile_processor.process_file(file_path, output_path, [], encoder, preset, quality)
+                else:
+                    # 保存图片：参数来自编码器注册表的预设
+                    encoder.prepare(img).save(output_path, **encoder.save_options(preset, quality),
+                                              **encoder.metadata_options(metadata, img))
                 success_count += 1
                 
             except Exception as e:
@@ -2096,6 +2542,11 @@ class EditorController:
             'offset_x_var': tk.IntVar(value=50),
             'offset_y_var': tk.IntVar(value=50),
             
+            # 平铺水印
+            'tile_var': tk.BooleanVar(value=False),
+            'tile_angle_var': tk.IntVar(value=30),
+            'tile_spacing_var': tk.IntVar(value=100),
+            
             # UI控件变量
             'input_label_var': tk.StringVar(value="未选择输入"),
             'file_count_label_var': tk.StringVar(value="找到图片: 0 张"),
@@ -2193,6 +2644,36 @@ class EditorController:
         import threading
         threading.Thread(target=self._batch_add_watermark_in_thread, daemon=True).start()
     
+    def _create_batch_tiled_watermark(self, watermark_type):
+        """根据批量水印设置创建平铺水印"""
+        vars = self.batch_watermark_vars
+        spacing = vars['tile_spacing_var'].get()
+        angle = vars['tile_angle_var'].get()
+        
+        if watermark_type == "text":
+            text_color = tuple(int(vars['text_color_var'].get()[i:i+2], 16) for i in (1, 3, 5))
+            stroke_color = tuple(int(vars['stroke_color_var'].get()[i:i+2], 16) for i in (1, 3, 5))
+            return TiledWatermark.from_text(
+                vars['text_var'].get(),
+                vars['font_size_var'].get(),
+                text_color,
+                stroke_color,
+                vars['stroke_width_var'].get(),
+                spacing=spacing,
+                angle=angle,
+                opacity=vars['opacity_var'].get()
+            )
+        
+        img_watermark_path = vars['image_watermark_path'].get()
+        if not img_watermark_path:
+            raise ValueError("请选择图片水印")
+        watermark_img = Image.open(img_watermark_path).convert("RGBA")
+        scale = vars['image_watermark_scale'].get() / 100
+        watermark_img = watermark_img.resize((max(1, int(watermark_img.width * scale)),
+                                              max(1, int(watermark_img.height * scale))), Image.LANCZOS)
+        return TiledWatermark(watermark_img, spacing=spacing, angle=angle,
+                              opacity=vars['image_watermark_opacity'].get())
+    
     def _batch_add_watermark_in_thread(self):
         """在后台线程中执行批量添加水印"""
         vars = self.batch_watermark_vars
@@ -2207,6 +2688,9 @@ class EditorController:
         failed_count = 0
         failed_files = []
         
+        # 平铺水印在第一张图片时创建，之后所有图片复用同一个平铺单元和图层缓存
+        tiled = None
+        
         # 执行添加水印
         total_files = len(selected_files)
         for i, file_path in enumerate(selected_files):
@@ -2214,14 +2698,32 @@ class EditorController:
                 # 更新当前处理文件
                 vars['current_file_var'].set(f"正在处理: {os.path.basename(file_path)}")
                 
-                # 打开图片
-                img = Image.open(file_path).convert("RGB")
-                img_width, img_height = img.size
+                # 打开图片：取出 EXIF/ICC 后按 EXIF 方向摆正，水印位置按摆正后的画面计算
+                img = tile_processor.open_image(file_path)
+                metadata = read_metadata(img)
+                # 超大图交给分块流式处理：这里不解码，各种水印只生成对应的分块操作
+                streaming = tile_processor.should_tile(img)
+                tile_processor.check_pixels(img, streaming)
+                watermark_op = None
+                if streaming:
+                    img_width, img_height = oriented_size(img)
+                else:
+                    cached = image_cache.load(file_path, full_resolution=True)
+                    img = cached if cached is not None else ImageOps.exif_transpose(img.convert("RGB"))
+                    img_width, img_height = img.size
                 
                 # 获取水印类型
                 watermark_type = vars['watermark_type_var'].get()
                 
-                if watermark_type == "text":
+                if vars['tile_var'].get():
+                    if tiled is None:
+                        tiled = self._create_batch_tiled_watermark(watermark_type)
+                    if streaming:
+                        watermark_op = tile_processor.TiledWatermarkOp(tiled)
+                    else:
+                        img_with_watermark = tiled.apply(img)
+                
+                elif watermark_type == "text":
                     # 创建文字水印
                     from models import DraggableTextWatermark
                     watermark = DraggableTextWatermark(img)
@@ -2286,7 +2788,10 @@ class EditorController:
                     watermark.move_to(x, y)
                     
                     # 应用水印
-                    img_with_watermark = watermark.apply()
+                    if streaming:
+                        watermark_op = tile_processor.Watermark.from_text(watermark)
+                    else:
+                        img_with_watermark = watermark.apply()
                 
                 elif watermark_type == "image":
                     # 图片水印处理
@@ -2350,15 +2855,27 @@ class EditorController:
                         y = img_height - wm_height - offset_y
                     
                     # 将水印图片应用到原始图片
-                    img = img.convert("RGBA")
-                    layer = Image.new("RGBA", img.size, (0, 0, 0, 0))
-                    layer.paste(watermark_img, (x, y), watermark_img)
-                    img_with_watermark = Image.alpha_composite(img, layer).convert("RGB")
+                    if streaming:
+                        # 与下面整图合成时的水印图层一致，只是不铺满整幅图
+                        layer = Image.new("RGBA", watermark_img.size, (0, 0, 0, 0))
+                        layer.paste(watermark_img, (0, 0), watermark_img)
+                        watermark_op = tile_processor.Watermark(layer, (x, y))
+                    else:
+                        img = img.convert("RGBA")
+                        layer = Image.new("RGBA", img.size, (0, 0, 0, 0))
+                        layer.paste(watermark_img, (x, y), watermark_img)
+                        img_with_watermark = Image.alpha_composite(img, layer).convert("RGB")
                 
                 # 保存图片
                 filename = os.path.basename(file_path)
                 output_path = os.path.join(output_dir, filename)
-                img_with_watermark.save(output_path, quality=95)
+                encoder = encoders.encoder_for_path(output_path)
+                if streaming:
+                    img.close()
+                    tile_processor.process_file(file_path, output_path, [watermark_op] if watermark_op else [], encoder)
+                else:
+                    encoder.prepare(img_with_watermark).save(output_path, **encoder.save_options(ENCODER_PRESET),
+                                                             **encoder.metadata_options(metadata, img_with_watermark))
                 
                 success_count += 1
             except Exception as e:
@@ -2384,36 +2901,112 @@ class EditorController:
     
 
     def save_image(self):
-        """保存图片"""
+        """保存图片：对话框在主线程，编码和写盘在后台线程进行，编辑可以继续"""
         if not self.editing_image: return
+        if self._save_worker:
+            self.view.update_status("上一次保存还没有完成")
+            return
         
         # 询问是否需要压缩
         response = messagebox.askyesno("压缩选项", "是否需要压缩图片？")
         
+        # 后台保存的是此刻的图片和操作记录，之后的编辑不影响这次保存
+        image = self.editing_image.copy()
+        metadata = self.source_metadata
+        
         if response:
             # 显示压缩设置对话框
             target_kb = simpledialog.askinteger("压缩设置", "目标大小 (KB):", minvalue=50, maxvalue=2048, initialvalue=800)
             if target_kb is None:
                 return  # 用户取消
             
-            # 执行压缩
-            from utils import auto_compress
-            compressed_data = auto_compress(self.editing_image, target_kb)
-            
             # 保存压缩后的图片
             path = filedialog.asksaveasfilename(defaultextension=".jpg",
                                                 filetypes=[("JPG", "*.jpg")])
-            if path:
-                with open(path, "wb") as f:
-                    f.write(compressed_data)
-                messagebox.showinfo("成功", f"图片已压缩并保存，大小约 {len(compressed_data)/1024:.1f} KB")
+            if not path:
+                return
+            
+            def job():
+                # 执行压缩
+                self._save_progress = "正在压缩..."
+                jpg = encoders.get_encoder("JPG")
+                compressed_data = auto_compress(image, target_kb,
+                                                metadata=lambda img: jpg.metadata_options(metadata, img))
+                atomic_save(path, lambda fp: fp.write(compressed_data))
+                return f"图片已压缩并保存，大小约 {len(compressed_data)/1024:.1f} KB"
         else:
-            # 普通保存
-            path = filedialog.asksaveasfilename(defaultextension=".jpg",
-                                                filetypes=[("JPG", "*.jpg"), ("PNG", "*.png")])
-            if path:
-                self.editing_image.save(path, quality=95)
-                messagebox.showinfo("成功", "保存成功")
+            # 普通保存：可选格式和保存参数来自编码器注册表
+            path = filedialog.asksaveasfilename(defaultextension=".jpg", filetypes=encoders.filetypes())
+            if not path:
+                return
+            
+            encoder = encoders.encoder_for_path(path)
+            save_options = encoder.save_options(ENCODER_PRESET)
+            filepath = self.filepath
+            recipe = self.recipe
+            source_scale = self.source_scale
+            lossless_ops = pipeline.lossless_jpeg_ops(recipe, self.lossless_mcu)
+            
+            def job():
+                # 只做过旋转/翻转/对齐裁剪的 JPEG 直接在 DCT 域变换源文件，不重新压缩
+                if (lossless_ops is not None and filepath
+                        and os.path.splitext(path)[1].lower() in (".jpg", ".jpeg")
+                        and lossless_jpeg_transform(filepath, path, lossless_ops, expected_size=image.size)):
+                    return "保存成功（无损）"
+                # 打开时缩小过的图片：把记录的操作重放到全分辨率源图上导出
+                if recipe is not None and filepath and source_scale > 1:
+                    try:
+                        size = pipeline.export(
+                            filepath, recipe, source_scale, path,
+                            progress=lambda done, total: self._set_save_progress(
+                                f"正在按原始分辨率处理 ({done}/{total})"),
+                            write_progress=self._report_written,
+                            metadata=lambda img: encoder.metadata_options(metadata, img), **save_options)
+                        return f"已按原始分辨率保存 ({size[0]}x{size[1]})"
+                    except Exception as e:
+                        print(f"全分辨率导出失败，改为保存工作图: {str(e)}")
+                self._save_progress = "正在编码..."
+                save_options.update(encoder.metadata_options(metadata, image))
+                save_image_atomic(encoder.prepare(image), path, self._report_written, **save_options)
+                return "保存成功"
+        
+        self._save_result = None
+        self._save_progress = "正在保存..."
+        self._save_worker = threading.Thread(target=self._save_in_thread, args=(job,), daemon=True)
+        self._save_worker.start()
+        self.view.bottom_status.config(text=self._save_progress)
+        self.view.after(100, self._poll_save)
+    
+    def _set_save_progress(self, text):
+        self._save_progress = text
+    
+    def _report_written(self, written):
+        """后台写盘时的进度回调"""
+        self._save_progress = f"正在写入 {written / 1024:.0f} KB..."
+    
+    def _save_in_thread(self, job):
+        """后台线程：执行保存任务，结果交给主线程轮询"""
+        try:
+            self._save_result = job()
+        except Exception as e:
+            self._save_result = e
+    
+    def _poll_save(self):
+        """在主线程轮询后台保存，显示进度和结果"""
+        if self._save_worker.is_alive():
+            self.view.bottom_status.config(text=self._save_progress)
+            self.view.after(100, self._poll_save)
+            return
+        
+        self._save_worker = None
+        result = self._save_result
+        if isinstance(result, Exception):
+            print(f"保存失败: {str(result)}")
+            self.view.update_status("保存失败")
+            messagebox.showerror("错误", f"保存失败: {str(result)}")
+        else:
+            self.view.update_status(result)
+            messagebox.showinfo("成功", result)
     
     def _hide_delete_button(self):
         """隐藏删除按钮"""
@@ -2442,7 +3035,7 @@ class EditorController:
         # 更新贴纸样式
         self.sticker_obj.set_style(self.sticker_scale, self.sticker_rotation)
         # 更新预览
-        self._update_sticker_preview()
+        self._update_sticker_preview(region=True)
         # 更新删除按钮位置
         if self.show_sticker_delete_button:
             self._hide_delete_button()
@@ -2613,14 +3206,24 @@ class EditorController:
         self._update_canvas()
     
     def _delete_sticker(self, event=None):
-        """删除贴纸"""
-        self.sticker_image = None
-        self.selected_sticker = None
-        self.sticker_obj = None
-        self.sticker_scale = 1.0
-        self.sticker_rotation = 0
-        self.preview_image = self.editing_image.copy()
+        """删除当前贴纸，其余贴纸保留"""
+        if self.sticker_layer and self.sticker_obj:
+            self.sticker_layer.remove(self.sticker_obj)
         self._hide_delete_button()
+        self._hide_rotation_handle()
+        
+        if self.sticker_layer and len(self.sticker_layer):
+            # 最上层的贴纸成为当前贴纸
+            self._activate_sticker(self.sticker_layer.stickers[-1])
+            self.preview_image = self.sticker_layer.image
+        else:
+            self.sticker_layer = None
+            self.sticker_image = None
+            self.selected_sticker = None
+            self.sticker_obj = None
+            self.sticker_scale = 1.0
+            self.sticker_rotation = 0
+            self.preview_image = self.editing_image.copy()
         self._update_canvas()
     
     def _image_to_screen(self, px, py):
@@ -2674,6 +3277,23 @@ class EditorController:
             print(f"坐标转换错误: {e}")
             return None, None
     
+    def _schedule_magnifier(self):
+        """合并短时间内的多次请求，放大镜每帧最多重绘一次"""
+        if self._magnifier_job is None:
+            self._magnifier_job = self.view.after(16, self._redraw_magnifier)
+
+    def _redraw_magnifier(self):
+        """只重绘放大镜，不触碰底下的图像"""
+        self._magnifier_job = None
+        self.view.canvas.delete("magnifier")
+        if not self.show_magnifier or not self.preview_image:
+            return
+        new_w = int(self.preview_image.width * self.zoom_scale)
+        new_h = int(self.preview_image.height * self.zoom_scale)
+        cx = self.view.canvas.winfo_width() // 2 + self.pan_offset_x
+        cy = self.view.canvas.winfo_height() // 2 + self.pan_offset_y
+        self._draw_magnifier(cx, cy, new_w, new_h)
+
     def _draw_magnifier(self, cx, cy, new_w, new_h):
         """绘制放大镜视图"""
         # 计算放大镜显示的区域
@@ -2700,14 +3320,11 @@ class EditorController:
         # 获取用于放大的图像，根据当前工具状态选择
         # 如果是涂鸦模式，使用包含当前涂鸦/擦除痕迹的图像
         if self.current_tool == "doodle" and self.doodle_editor:
-            # 使用涂鸦编辑器生成的包含实时涂鸦的图像
-            magnifier_source = self.doodle_editor.merge()
+            # 只合成放大区域内的底图和涂鸦图层
+            magnified_region = self.doodle_editor.merge_region((x1, y1, x2, y2))
         else:
             # 否则使用普通预览图像
-            magnifier_source = self.preview_image
-        
-        # 裁剪放大区域
-        magnified_region = magnifier_source.crop((x1, y1, x2, y2))
+            magnified_region = self.preview_image.crop((x1, y1, x2, y2)).convert("RGB")
         
         # 计算放大镜在画布上的位置
         # 将放大镜固定显示在左上角，参考示例图
@@ -2717,12 +3334,13 @@ class EditorController:
         # 放大区域，确保放大后的图像尺寸与放大镜尺寸一致
         scaled_w = self.magnifier_size
         scaled_h = self.magnifier_size
-        from PIL import Image
         magnified_region = magnified_region.resize((scaled_w, scaled_h), Image.Resampling.LANCZOS)
         
-        # 转换为Tkinter可用的图像
-        from PIL import ImageTk
-        magnified_tk = ImageTk.PhotoImage(magnified_region)
+        # 复用同一个 PhotoImage，只更新像素
+        if self.magnified_tk is None or self.magnified_tk.width() != scaled_w or self.magnified_tk.height() != scaled_h:
+            self.magnified_tk = ImageTk.PhotoImage("RGB", (scaled_w, scaled_h))
+        self.magnified_tk.paste(magnified_region)
+        magnified_tk = self.magnified_tk
         
         # 1. 绘制放大镜阴影，增强立体感
         shadow_offset = 3
@@ -2808,8 +3426,6 @@ class EditorController:
             center_x, center_y,
             fill="#333333", width=1, dash=(4, 2), tags="magnifier"
         )
-        
-        # 保存图像引用，防止被垃圾回收
-        self.magnified_tk = magnified_tk
+
     
 
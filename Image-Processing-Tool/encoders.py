@@ -0,0 +1,157 @@
+"""
+输出编码器注册表
+
+每种输出格式登记 Pillow 格式名、扩展名、默认质量和 "最快/平衡/最小" 三档预设，
+编辑器保存和批量转换都从这里取保存参数，部署时可以在 config.ENCODER_PRESET 中明确用 CPU 换体积。
+AVIF/JPEG XL 依赖 Pillow 的编译选项或第三方插件，不可用时不出现在格式列表中。
+"""
+from collections import OrderedDict
+import os
+
+from PIL import Image, features
+
+from utils import output_metadata
+
+# 可选插件：导入时向 Pillow 注册 AVIF / JPEG XL 编解码器
+try:
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+try:
+    import pillow_jxl  # noqa: F401
+except ImportError:
+    pass
+
+PRESETS = ("最快", "平衡", "最小")
+
+
+class Encoder:
+    """一种输出格式的保存方式"""
+
+    def __init__(self, name, pil_format, extensions, presets, quality=None, modes=("RGB", "L"),
+                 feature=None, metadata=("exif", "icc_profile"), streaming=None):
+        self.name = name  # 界面上显示的格式名
+        self.pil_format = pil_format
+        self.extensions = extensions  # 第一个为默认扩展名
+        self.presets = presets  # 预设名 -> 保存参数
+        self.quality = quality  # 默认质量，None 表示该格式没有质量参数
+        self.modes = modes  # 可以直接保存的颜色模式
+        self.feature = feature  # PIL.features 中对应的特性名
+        self.metadata = metadata  # 能写入的元数据种类
+        self.streaming = streaming or {}  # 分块处理超大图时覆盖的参数，避免编码器缓存整图
+
+    @property
+    def extension(self):
+        return self.extensions[0]
+
+    def available(self):
+        """当前 Pillow 能否写出该格式"""
+        if self.feature and not features.check(self.feature):
+            return False
+        Image.init()
+        return self.pil_format in Image.SAVE
+
+    def save_options(self, preset=None, quality=None, streaming=False):
+        """
+        返回 img.save 的参数（含 format）；quality 为 None 时使用该格式的默认质量。
+        streaming 为 True 时换掉需要缓存整图的选项（见 tile_processor）
+        """
+        options = dict(self.presets.get(preset) or self.presets["平衡"])
+        if self.quality is not None:
+            options["quality"] = self.quality if quality is None else quality
+        if streaming:
+            options.update(self.streaming)
+        options["format"] = self.pil_format
+        return options
+
+    def metadata_options(self, meta, img):
+        """把源图元数据（utils.read_metadata 的结果）转换成保存 img 时的参数，格式不支持的元数据略去"""
+        return output_metadata(meta, img, self.metadata)
+
+    def prepare(self, img):
+        """转换成该格式能保存的颜色模式"""
+        if img.mode in self.modes:
+            return img
+        if "RGBA" in self.modes and ("A" in img.getbands() or "transparency" in img.info):
+            return img.convert("RGBA")
+        return img.convert("RGB")
+
+
+_encoders = OrderedDict()
+
+
+def register(encoder):
+    """登记编码器；同名的后登记者覆盖先登记者"""
+    _encoders[encoder.name] = encoder
+
+
+def get_encoder(name):
+    return _encoders[name.upper()]
+
+
+def encoder_for_path(path):
+    """
+    按扩展名找编码器。未登记的扩展名按 Pillow 的扩展名表临时生成一个只用默认参数的编码器，
+    保证写出的内容与扩展名一致；Pillow 也不认识时抛出 ValueError（与 img.save 相同）。
+    """
+    ext = os.path.splitext(path)[1].lower()
+    for encoder in _encoders.values():
+        if ext in encoder.extensions:
+            return encoder
+    Image.init()
+    pil_format = Image.registered_extensions().get(ext)
+    if pil_format is None or pil_format not in Image.SAVE:
+        raise ValueError(f"无法识别的文件扩展名: {ext or path}")
+    return Encoder(pil_format, pil_format, [ext], {"平衡": {}}, metadata=())
+
+
+def available_formats():
+    """当前环境可写出的格式名，按登记顺序"""
+    return [name for name, encoder in _encoders.items() if encoder.available()]
+
+
+def filetypes():
+    """文件对话框用的 (名称, 通配符) 列表"""
+    return [(name, " ".join(f"*{ext}" for ext in _encoders[name].extensions)) for name in available_formats()]
+
+
+register(Encoder("JPG", "JPEG", [".jpg", ".jpeg"], {
+    "最快": {"optimize": False},
+    "平衡": {"optimize": True},
+    "最小": {"optimize": True, "progressive": True},
+}, quality=95, modes=("RGB", "RGBX", "L", "CMYK"),
+    # libjpeg 的 optimize/progressive 要先缓存整图的 DCT 系数（每像素约 3 字节）
+    streaming={"optimize": False, "progressive": False}))
+register(Encoder("PNG", "PNG", [".png"], {
+    "最快": {"compress_level": 1},
+    "平衡": {"compress_level": 6},
+    "最小": {"compress_level": 9, "optimize": True},
+}, modes=("RGB", "RGBA", "L", "LA", "P")))
+register(Encoder("BMP", "BMP", [".bmp"], {"平衡": {}}, modes=("RGB", "L", "P"), metadata=()))
+register(Encoder("WEBP", "WEBP", [".webp"], {
+    "最快": {"method": 0},
+    "平衡": {"method": 4},
+    "最小": {"method": 6},
+}, quality=90, modes=("RGB", "RGBX", "RGBA"), feature="webp"))
+register(Encoder("AVIF", "AVIF", [".avif"], {
+    "最快": {"speed": 10},
+    "平衡": {"speed": 6},
+    "最小": {"speed": 2},
+}, quality=80, modes=("RGB", "RGBX", "RGBA")))
+register(Encoder("JXL", "JXL", [".jxl"], {
+    "最快": {"effort": 1},
+    "平衡": {"effort": 7},
+    "最小": {"effort": 9},
+}, quality=90, modes=("RGB", "RGBA", "L")))
+register(Encoder("TIFF", "TIFF", [".tiff", ".tif"], {
+    "最快": {"compression": "raw"},
+    "平衡": {"compression": "tiff_lzw"},
+    "最小": {"compression": "tiff_adobe_deflate"},
+}, modes=("RGB", "RGBX", "RGBA", "L", "CMYK")))
+register(Encoder("ICO", "ICO", [".ico"], {"平衡": {}}, modes=("RGBA", "RGB"), metadata=()))
+register(Encoder("GIF", "GIF", [".gif"], {
+    "最快": {},
+    "平衡": {},
+    "最小": {"optimize": True},
+}, modes=("P", "L", "RGB", "RGBA"), metadata=()))
+register(Encoder("PPM", "PPM", [".ppm", ".pgm", ".pbm", ".pnm"], {"平衡": {}}, modes=("RGB", "L", "1"), metadata=()))
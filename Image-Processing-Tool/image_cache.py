@@ -0,0 +1,149 @@
+"""
+工作图像素缓存
+
+打开图片时解码出的工作图（已摆正、已缩小的 RGB）按原始像素写到磁盘，
+再次打开同一文件（路径、修改时间、大小都不变）时用 mmap 映射缓存文件，直接从映射中拷出像素，不用重新解码。
+（Pillow 的 RGB 图在内存中每像素占 4 字节，无法直接引用打包的 RGB 数据，所以仍有一次内存拷贝。）
+缓存总大小超过 config.RAW_CACHE_MAX_BYTES 时按最近使用时间淘汰。
+
+缓存文件格式：20 字节头（魔数、宽、高、源图宽、源图高）后接逐行 RGB 像素。
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+from PIL import Image
+
+from config import RAW_CACHE_DIR, RAW_CACHE_MAX_BYTES, WORKING_MAX_SIZE
+
+_MAGIC = b"IPR1"
+_HEADER = struct.Struct("<4sLLLL")  # 魔数, 宽, 高, 源图宽, 源图高
+_WRITE_ROWS = 256  # 写缓存时每次转出的行数，避免整图再复制一份
+
+_lock = threading.Lock()
+
+
+def enabled():
+    return RAW_CACHE_MAX_BYTES > 0
+
+
+def _cache_path(path, max_size):
+    st = os.stat(path)
+    key = f"{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}|{max_size}"
+    return os.path.join(RAW_CACHE_DIR, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".raw")
+
+
+def contains(path, max_size=WORKING_MAX_SIZE):
+    """缓存中是否有该文件的工作图"""
+    if not enabled():
+        return False
+    try:
+        return os.path.exists(_cache_path(path, max_size))
+    except OSError:
+        return False
+
+
+def load(path, max_size=WORKING_MAX_SIZE, full_resolution=False):
+    """
+    返回从缓存读出的工作图，没有缓存时返回 None。
+    full_resolution=True 时只在缓存的就是原始分辨率像素时返回（批量处理按原图输出，不能用缩小过的图）。
+    """
+    if not enabled():
+        return None
+    try:
+        cache_path = _cache_path(path, max_size)
+        with open(cache_path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    try:
+        magic, w, h, src_w, src_h = _HEADER.unpack_from(mm, 0)
+        if magic != _MAGIC or len(mm) != _HEADER.size + w * h * 3:
+            raise ValueError("缓存文件不完整")
+    except (struct.error, ValueError) as e:
+        mm.close()
+        print(f"工作图缓存损坏，已忽略: {e}")
+        _remove(cache_path)
+        return None
+    if full_resolution and (w, h) != (src_w, src_h):
+        mm.close()
+        return None
+
+    # 像素拷出后立即解除映射，缓存文件随时可以被淘汰
+    try:
+        with memoryview(mm) as view:
+            image = Image.frombytes("RGB", (w, h), view[_HEADER.size:])
+    finally:
+        mm.close()
+
+    # 更新修改时间作为最近使用时间，淘汰时以此排序
+    try:
+        os.utime(cache_path)
+    except OSError:
+        pass
+    return image
+
+
+def store(path, image, source_size, max_size=WORKING_MAX_SIZE):
+    """把工作图写入缓存；source_size 为摆正后的原图尺寸。写入失败只打印，不影响打开"""
+    if not enabled() or image.mode != "RGB":
+        return
+    size = _HEADER.size + image.width * image.height * 3
+    if size > RAW_CACHE_MAX_BYTES:
+        return
+    tmp_path = None
+    try:
+        cache_path = _cache_path(path, max_size)
+        os.makedirs(RAW_CACHE_DIR, exist_ok=True)
+        with _lock:
+            _evict(RAW_CACHE_MAX_BYTES - size, keep=cache_path)
+        # 先写临时文件再改名，避免并发或中断留下不完整的缓存
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, image.width, image.height, *source_size))
+            for y in range(0, image.height, _WRITE_ROWS):
+                f.write(image.crop((0, y, image.width, min(image.height, y + _WRITE_ROWS))).tobytes())
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"写入工作图缓存失败: {e}")
+        _remove(tmp_path)
+
+
+def _remove(path):
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except OSError:
+        pass  # Windows 下正被读取的文件删不掉，留到下次淘汰
+
+
+def _evict(budget, keep=None):
+    """按最近使用时间从旧到新删除缓存文件，直到总大小不超过 budget"""
+    entries = []
+    total = 0
+    try:
+        with os.scandir(RAW_CACHE_DIR) as it:
+            for entry in it:
+                if not entry.name.endswith(".raw") or entry.path == keep:
+                    continue
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+    except OSError:
+        return
+    entries.sort()
+    for _, size, path in entries:
+        if total <= budget:
+            break
+        _remove(path)
+        total -= size
+
+
+def clear():
+    """删除全部缓存文件"""
+    with _lock:
+        _evict(0)
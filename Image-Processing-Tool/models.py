@@ -1,4 +1,117 @@
-from PIL import Image, ImageDraw, ImageFilter, ImageFont
+import math
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from utils import TESSELLATION_SHAPES, get_font, tessellate
+
+
+def _boxes_overlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def _union_box(a, b):
+    """合并两个 (x1, y1, x2, y2) 区域，任一为 None 时返回另一个"""
+    if not a:
+        return b
+    if not b:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+class StrokeSmoother:
+    """笔画平滑引擎：按最小距离抽稀鼠标事件，用 Catmull-Rom 样条拟合，再按固定间距重采样为笔触点
+
+    涂鸦和马赛克共用。快速移动时原始 <B1-Motion> 事件稀疏且不均匀，
+    经过拟合和重采样后输出间距一致的笔触点，既平滑又减少栅格化次数。
+    """
+
+    def __init__(self, min_distance=2.0, spacing=2.0):
+        self.min_distance = min_distance  # 小于该距离的事件点被丢弃
+        self.spacing = spacing  # 输出笔触点之间的间距
+        self.points = []  # 抽稀后的控制点（只保留拟合需要的最后4个）
+        self._carry = 0.0  # 上一个笔触点之后已走过的距离
+        self._last = None  # 重采样游标所在位置
+
+    def set_params(self, min_distance, spacing):
+        self.min_distance = max(0.5, float(min_distance))
+        self.spacing = max(0.5, float(spacing))
+
+    def begin(self, x, y):
+        """开始一笔，返回起点笔触"""
+        self.points = [(float(x), float(y))]
+        self._carry = 0.0
+        self._last = self.points[0]
+        return [self._last]
+
+    def add_point(self, x, y):
+        """加入一个新的事件点，返回新产生的笔触点列表（可能为空）"""
+        if not self.points:
+            return self.begin(x, y)
+
+        last_x, last_y = self.points[-1]
+        if math.hypot(x - last_x, y - last_y) < self.min_distance:
+            return []
+
+        self.points.append((float(x), float(y)))
+        if len(self.points) < 3:
+            return []
+
+        # 有了后一个点才能确定 p1 -> p2 这一段的切线
+        if len(self.points) == 3:
+            p0, p1, p2, p3 = self.points[0], self.points[0], self.points[1], self.points[2]
+        else:
+            p0, p1, p2, p3 = self.points[-4:]
+            self.points = self.points[-3:]
+        return self._resample(self._sample_segment(p0, p1, p2, p3))
+
+    def end(self):
+        """结束一笔，补齐最后一段并保证笔画到达松开的位置"""
+        dabs = []
+        if len(self.points) >= 2:
+            p1, p2 = self.points[-2], self.points[-1]
+            p0 = self.points[-3] if len(self.points) >= 3 else p1
+            dabs = self._resample(self._sample_segment(p0, p1, p2, p2))
+            if self._carry > 0:
+                dabs.append(p2)
+        self.points = []
+        self._carry = 0.0
+        self._last = None
+        return dabs
+
+    def _sample_segment(self, p0, p1, p2, p3):
+        """在 p1 -> p2 之间按弦长密集采样 Catmull-Rom 曲线"""
+        chord = math.hypot(p2[0] - p1[0], p2[1] - p1[1])
+        steps = max(2, int(chord / max(0.5, self.spacing * 0.5)) + 1)
+        samples = []
+        for i in range(1, steps + 1):
+            t = i / steps
+            t2 = t * t
+            t3 = t2 * t
+            samples.append(tuple(
+                0.5 * (2 * b + (c - a) * t + (2 * a - 5 * b + 4 * c - d) * t2 + (3 * b - a - 3 * c + d) * t3)
+                for a, b, c, d in zip(p0, p1, p2, p3)
+            ))
+        return samples
+
+    def _resample(self, samples):
+        """沿折线按固定间距取点"""
+        dabs = []
+        px, py = self._last
+        for qx, qy in samples:
+            seg = math.hypot(qx - px, qy - py)
+            while seg > 0 and self._carry + seg >= self.spacing:
+                t = (self.spacing - self._carry) / seg
+                px, py = px + (qx - px) * t, py + (qy - py) * t
+                dabs.append((px, py))
+                self._carry = 0.0
+                seg = math.hypot(qx - px, qy - py)
+            self._carry += seg
+            px, py = qx, qy
+        self._last = (px, py)
+        return dabs
+
 
 class DoodleEditor:
     def __init__(self, base_img: Image.Image):
@@ -8,14 +121,85 @@ class DoodleEditor:
         self.size = 20
         self.color = (255, 0, 0, 255)
         self.mode = "brush"  # "brush" or "eraser"
+        self.smoother = StrokeSmoother()
+        self._last_dab = None
+        self._merged = None  # 合成结果缓存，每段笔画只重新合成其包围盒
+        self.set_brush(self.size, self.color)
 
     def set_brush(self, size, color):
         self.size = size
         self.color = color
+        # 笔触间距与笔刷大小成比例，细笔刷也保持至少1像素
+        self.smoother.set_params(max(1.5, size * 0.1), max(1.0, size * 0.15))
 
     def set_mode(self, mode):
         self.mode = mode
 
+    def begin_stroke(self, x, y):
+        """开始一笔，返回受影响的区域"""
+        dabs = self.smoother.begin(x, y)
+        self._last_dab = dabs[0]
+        return self._touch(self._stamp_dot(*dabs[0]))
+
+    def continue_stroke(self, x, y):
+        """继续当前笔画，没有新笔触时返回 None"""
+        return self._touch(self._draw_dabs(self.smoother.add_point(x, y)))
+
+    def end_stroke(self):
+        """结束当前笔画，补画末段和圆形收笔"""
+        box = self._draw_dabs(self.smoother.end())
+        if self._last_dab is not None:
+            box = _union_box(box, self._stamp_dot(*self._last_dab))
+        self._last_dab = None
+        return self._touch(box)
+
+    def _draw_dabs(self, dabs):
+        """把一串重采样后的笔触点一次性画成折线"""
+        if not dabs or self._last_dab is None:
+            return None
+        points = [self._last_dab] + dabs
+        self._last_dab = dabs[-1]
+        r = self.size / 2 + 1
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        box = self._clip_box((min(xs) - r, min(ys) - r, max(xs) + r, max(ys) + r))
+        if not box:
+            return None
+
+        if self.mode == "eraser":
+            # 橡皮擦只在笔画包围盒内生成遮罩，避免每次分配整幅遮罩
+            mask = Image.new("L", (box[2] - box[0], box[3] - box[1]), 0)
+            local = [(x - box[0], y - box[1]) for x, y in points]
+            ImageDraw.Draw(mask).line(local, fill=255, width=self.size, joint="curve")
+            self.layer.paste((0, 0, 0, 0), box, mask)
+        else:
+            self.draw.line(points, fill=self.color, width=self.size, joint="curve")
+        return box
+
+    def _stamp_dot(self, x, y):
+        """在单点处画一个圆形笔触（起笔/收笔的圆头）"""
+        r = self.size / 2
+        box = self._clip_box((x - r - 1, y - r - 1, x + r + 1, y + r + 1))
+        if not box:
+            return None
+        if self.mode == "eraser":
+            mask = Image.new("L", (box[2] - box[0], box[3] - box[1]), 0)
+            ImageDraw.Draw(mask).ellipse((x - r - box[0], y - r - box[1], x + r - box[0], y + r - box[1]), fill=255)
+            self.layer.paste((0, 0, 0, 0), box, mask)
+        else:
+            self.draw.ellipse((x - r, y - r, x + r, y + r), fill=self.color)
+        return box
+
+    def _clip_box(self, box):
+        """把浮点包围盒转换为整数并裁剪到图层范围内，空区域返回 None"""
+        x1 = max(0, int(math.floor(box[0])))
+        y1 = max(0, int(math.floor(box[1])))
+        x2 = min(self.layer.width, int(math.ceil(box[2])))
+        y2 = min(self.layer.height, int(math.ceil(box[3])))
+        if x1 >= x2 or y1 >= y2:
+            return None
+        return (x1, y1, x2, y2)
+
     def draw_line(self, x1, y1, x2, y2):
         """绘制平滑的线条或橡皮擦"""
         if self.mode == "eraser":
@@ -26,75 +210,250 @@ class DoodleEditor:
         else:
             # 画笔模式：正常绘制彩色线条
             self.draw.line((x1, y1, x2, y2), fill=self.color, width=self.size)
+        self._merged = None
+
+    def _touch(self, box):
+        """图层 box 区域有变化时同步更新合成缓存"""
+        if box and self._merged is not None:
+            self._merged.paste(self.merge_region(box), box)
+        return box
+
+    def merge_region(self, box):
+        """只合成 box 区域内的底图和图层"""
+        return Image.alpha_composite(self.base.crop(box).convert("RGBA"), self.layer.crop(box)).convert("RGB")
+
+    def get_preview(self):
+        """返回合成缓存（不复制），调用方只能读取"""
+        if self._merged is None:
+            self._merged = Image.alpha_composite(self.base.convert("RGBA"), self.layer).convert("RGB")
+        return self._merged
 
     def merge(self):
-        return Image.alpha_composite(self.base.convert("RGBA"), self.layer).convert("RGB")
+        return self.get_preview().copy()
+
+def build_mosaic_map(img, mosaic_type, param):
+    """对整幅图像预先计算一种马赛克效果
+
+    :param img: 原始图像
+    :param mosaic_type: pixel, blur, triangle, hexagon, circle
+    :param param: blur 为模糊半径，其余类型为网格单元边长（像素）
+    :return: 与原图同尺寸的马赛克图，网格以图像左上角为原点全局对齐
+    """
+    img = img.convert("RGB")
+    w, h = img.size
+    if mosaic_type == "blur":
+        return img.filter(ImageFilter.GaussianBlur(radius=param))
+
+    cell = max(2, int(param))
+    if mosaic_type in TESSELLATION_SHAPES:
+        # 真正的几何镶嵌：每个单元填充其覆盖像素的平均色；缺少 numpy 时退回下面的近似效果
+        tiled = tessellate(img, mosaic_type, cell)
+        if tiled is not None:
+            return tiled
+
+    grid_w = -(-w // cell)
+    grid_h = -(-h // cell)
+    if mosaic_type == "triangle":
+        # 三角形马赛克效果
+        small = img.resize((grid_w, grid_h), Image.NEAREST)
+        mosaic = small.resize((grid_w * cell, grid_h * cell), Image.NEAREST)
+        mosaic = mosaic.filter(ImageFilter.EDGE_ENHANCE_MORE)
+        mosaic = mosaic.filter(ImageFilter.SHARPEN)
+        mosaic = mosaic.filter(ImageFilter.SHARPEN)
+    elif mosaic_type == "hexagon":
+        # 六边形马赛克效果
+        small = img.resize((grid_w, grid_h), Image.NEAREST)
+        mosaic = small.resize((grid_w * cell, grid_h * cell), Image.LANCZOS)
+        mosaic = mosaic.filter(ImageFilter.EDGE_ENHANCE_MORE)
+        mosaic = mosaic.filter(ImageFilter.SHARPEN)
+    elif mosaic_type == "circle":
+        # 圆形马赛克效果
+        small = img.resize((grid_w, grid_h), Image.BICUBIC)
+        mosaic = small.resize((grid_w * cell, grid_h * cell), Image.BICUBIC)
+        mosaic = mosaic.filter(ImageFilter.GaussianBlur(radius=1))
+        mosaic = mosaic.filter(ImageFilter.EDGE_ENHANCE_MORE)
+    else:
+        # 像素化马赛克：reduce 按块取平均，末尾不足一块的部分单独成块
+        small = img.reduce(cell)
+        mosaic = small.resize((small.width * cell, small.height * cell), Image.NEAREST)
+    return mosaic.crop((0, 0, w, h))
+
 
 class MosaicEditor:
+    MAX_CACHED_MAPS = 3  # 最多缓存几张整幅马赛克图
+
     def __init__(self, base_img: Image.Image):
         self.base = base_img
-        self.layer = Image.new("RGBA", base_img.size, (0, 0, 0, 0))  # 透明图层
+        self.layer = Image.new("RGBA", base_img.size, (0, 0, 0, 0))  # 透明图层，alpha 即显示马赛克图的遮罩
         self.size = 20
-        self.type = "pixel"  # 马赛克类型: pixel, blur, triangle
+        self.type = "pixel"  # 马赛克类型: pixel, blur, triangle, hexagon, circle
         self.base_copy = base_img.copy()  # 保存原始图像副本，用于多次马赛克处理
+        self.smoother = StrokeSmoother()
+        self.smoother.set_params(max(2.0, self.size * 0.1), max(2.0, self.size * 0.4))
+
+        # 整幅马赛克图缓存：(类型, 参数) -> Image，按需在后台线程中计算
+        self._maps = OrderedDict()
+        self._map_cond = threading.Condition()
+        self._pending_key = None
+        self._computing_key = None
+        self._worker = None
+        self._stamps = {}  # 笔触直径 -> 圆形遮罩
+        self._merged = None  # 合成结果缓存，每个笔触只更新其覆盖的区域
 
     def set_mosaic_params(self, size, type_):
         self.size = size
         self.type = type_
+        # 马赛克笔触互相重叠一半左右即可连成一片
+        self.smoother.set_params(max(2.0, size * 0.1), max(2.0, size * 0.4))
+        # 提前在后台准备当前参数对应的马赛克图
+        self._request_map(self._map_key())
+
+    def _map_key(self):
+        if self.type == "blur":
+            return ("blur", max(5, min(30, self.size // 6)))
+        return (self.type, max(4, min(48, self.size // 4)))
+
+    def _request_map(self, key):
+        """请求后台计算马赛克图，只保留最新一次请求"""
+        with self._map_cond:
+            if key in self._maps or key == self._computing_key:
+                return
+            self._pending_key = key
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._map_worker, daemon=True)
+                self._worker.start()
+
+    def _map_worker(self):
+        while True:
+            with self._map_cond:
+                key = self._pending_key
+                self._pending_key = None
+                if key is None:
+                    self._worker = None
+                    return
+                if key in self._maps:
+                    continue
+                self._computing_key = key
+            mosaic_map = build_mosaic_map(self.base_copy, *key)
+            with self._map_cond:
+                self._store_map(key, mosaic_map)
+                self._computing_key = None
+                self._map_cond.notify_all()
+
+    def _store_map(self, key, mosaic_map):
+        self._maps[key] = mosaic_map
+        while len(self._maps) > self.MAX_CACHED_MAPS:
+            self._maps.popitem(last=False)
+
+    def _get_map(self, key):
+        """取得马赛克图：已缓存直接返回，后台正在计算则等待，否则当场计算"""
+        with self._map_cond:
+            while key == self._computing_key:
+                self._map_cond.wait()
+            if key in self._maps:
+                self._maps.move_to_end(key)
+                return self._maps[key]
+            if self._pending_key == key:
+                self._pending_key = None
+        mosaic_map = build_mosaic_map(self.base_copy, *key)
+        with self._map_cond:
+            self._store_map(key, mosaic_map)
+        return mosaic_map
+
+    def _get_stamp(self, diameter):
+        stamp = self._stamps.get(diameter)
+        if stamp is None:
+            stamp = Image.new("L", (diameter, diameter), 0)
+            ImageDraw.Draw(stamp).ellipse((0, 0, diameter - 1, diameter - 1), fill=255)
+            self._stamps[diameter] = stamp
+        return stamp
+
+    def begin_stroke(self, x, y):
+        """开始一笔马赛克，返回受影响的区域"""
+        return self._stamp_dabs(self.smoother.begin(x, y))
+
+    def continue_stroke(self, x, y):
+        """继续当前笔画，没有新笔触时返回 None"""
+        return self._stamp_dabs(self.smoother.add_point(x, y))
+
+    def end_stroke(self):
+        """结束当前笔画"""
+        return self._stamp_dabs(self.smoother.end())
+
+    def _stamp_dabs(self, dabs):
+        box = None
+        for x, y in dabs:
+            box = _union_box(box, self.apply_mosaic_area(x, y))
+        return box
 
     def apply_mosaic_area(self, x, y):
-        """应用马赛克效果到指定区域"""
+        """在指定位置盖一个圆形笔触，露出预先计算好的整幅马赛克图"""
         r = self.size // 2
+        diameter = max(1, 2 * r)
         # 将坐标转换为整数，修复TypeError
-        box = tuple(int(coord) for coord in (x - r, y - r, x + r, y + r))
+        left, top = int(x) - r, int(y) - r
         # 边界检查
-        box = (max(0, box[0]), max(0, box[1]), min(self.base.width, box[2]), min(self.base.height, box[3]))
+        box = (max(0, left), max(0, top), min(self.base.width, left + diameter), min(self.base.height, top + diameter))
         if box[0] >= box[2] or box[1] >= box[3]:
-            return
-        
-        region = self.base_copy.crop(box)
-        
-        if self.type == "pixel":
-            # 像素化马赛克
-            pixel_size = max(2, min(20, self.size // 12))
-            small = region.resize((pixel_size, pixel_size), Image.NEAREST)
-            mosaic = small.resize(region.size, Image.NEAREST)
-        elif self.type == "blur":
-            # 模糊马赛克
-            blur_radius = max(5, min(30, self.size // 6))
-            mosaic = region.filter(ImageFilter.GaussianBlur(radius=blur_radius))
-        elif self.type == "triangle":
-            # 三角形马赛克效果
-            small_size = max(4, min(16, self.size // 15))
-            small = region.resize((small_size, small_size), Image.NEAREST)
-            mosaic = small.resize(region.size, Image.Resampling.NEAREST)
-            mosaic = mosaic.filter(ImageFilter.EDGE_ENHANCE_MORE)
-            mosaic = mosaic.filter(ImageFilter.SHARPEN)
-            mosaic = mosaic.filter(ImageFilter.SHARPEN)
-        elif self.type == "hexagon":
-            # 六边形马赛克效果
-            small_size = max(6, min(20, self.size // 12))
-            small = region.resize((small_size, small_size), Image.NEAREST)
-            mosaic = small.resize(region.size, Image.Resampling.LANCZOS)
-            mosaic = mosaic.filter(ImageFilter.EDGE_ENHANCE_MORE)
-            mosaic = mosaic.filter(ImageFilter.SHARPEN)
-        elif self.type == "circle":
-            # 圆形马赛克效果
-            small_size = max(4, min(18, self.size // 11))
-            small = region.resize((small_size, small_size), Image.BICUBIC)
-            mosaic = small.resize(region.size, Image.Resampling.BICUBIC)
-            mosaic = mosaic.filter(ImageFilter.GaussianBlur(radius=1))
-            mosaic = mosaic.filter(ImageFilter.EDGE_ENHANCE_MORE)
-        else:
-            # 默认像素化
-            pixel_size = max(2, min(20, self.size // 12))
-            small = region.resize((pixel_size, pixel_size), Image.NEAREST)
-            mosaic = small.resize(region.size, Image.NEAREST)
-        
-        self.layer.paste(mosaic, box)
+            return None
+
+        mosaic_map = self._get_map(self._map_key())
+        stamp = self._get_stamp(diameter).crop((box[0] - left, box[1] - top, box[2] - left, box[3] - top))
+        patch = mosaic_map.crop(box)
+        self.layer.paste(patch, box, stamp)
+        if self._merged is not None:
+            # 笔触遮罩非 0 即 255，直接贴到合成缓存上与重新整体合成的结果一致
+            self._merged.paste(patch, box, stamp)
+        return box
+
+    def get_preview(self):
+        """返回合成缓存（不复制），调用方只能读取"""
+        if self._merged is None:
+            self._merged = Image.alpha_composite(self.base.convert("RGBA"), self.layer).convert("RGB")
+        return self._merged
 
     def merge(self):
-        return Image.alpha_composite(self.base.convert("RGBA"), self.layer).convert("RGB")
+        return self.get_preview().copy()
+
+def render_text_sprite(text, size, fill, stroke_width=0, stroke_fill=None):
+    """
+    把文字渲染成紧凑的 RGBA 小图，描边使用 Pillow 自带的 stroke 参数
+    :return: (sprite, (dx, dy), bbox)，dx/dy 为小图相对文字原点的偏移，bbox 为不含描边的文字边界框；
+             文字为空时 sprite 为 None
+    """
+    font = get_font(size)
+    draw = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+    bbox = draw.textbbox((0, 0), text, font=font)
+    # 包含描边在内的紧凑范围
+    left, top, right, bottom = draw.textbbox((0, 0), text, font=font, stroke_width=stroke_width)
+    if right <= left or bottom <= top:
+        return None, (left, top), bbox
+    sprite = Image.new("RGBA", (right - left, bottom - top), (0, 0, 0, 0))
+    ImageDraw.Draw(sprite).text((-left, -top), text, font=font, fill=fill,
+                                stroke_width=stroke_width, stroke_fill=stroke_fill)
+    return sprite, (left, top), bbox
+
+
+class RegionCompositor:
+    """在底图的 RGB 缓存副本上只合成叠加物覆盖的区域，移动时先还原上一次覆盖的区域"""
+
+    def __init__(self, base_img):
+        self.base = base_img.convert("RGB")
+        self.image = self.base.copy()
+        self._covered = None  # 上一次叠加物覆盖的区域
+
+    def update(self, draw_on):
+        """
+        重新合成叠加物
+        :param draw_on: 把叠加物就地画到图像上并返回实际改动区域的函数
+        :return: 需要刷新的区域（新旧覆盖区域的并集），没有变化时为 None
+        """
+        old = self._covered
+        if old:
+            self.image.paste(self.base.crop(old), old[:2])
+        self._covered = draw_on(self.image)
+        return _union_box(old, self._covered)
+
 
 class DraggableTextWatermark:
     """可拖动 + 可删除 + 支持描边 + 支持透明度 + 支持时间水印"""
@@ -107,6 +466,11 @@ class DraggableTextWatermark:
         self.stroke = (0, 0, 0)
         self.stroke_width = 3
         self.size = 42
+        self._sprite = None  # 预先渲染好的水印小图
+        self._sprite_offset = (0, 0)
+        self._sprite_key = None
+        self._bbox = (0, 0, 0, 0)
+        self._compositor = None  # 预览用的局部合成器
 
         # 默认放在中心
         self.x = base_img.width // 2
@@ -127,41 +491,131 @@ class DraggableTextWatermark:
         self.x = int(x)
         self.y = int(y)
 
+    def _style_key(self):
+        return (self.text, self.size, self.color, self.stroke, self.stroke_width)
+
     def get_bbox(self):
         """获取水印文字的像素边界框"""
-        try:
-            font = ImageFont.truetype("msyh.ttc", self.size)
-        except:
-            font = ImageFont.load_default()
+        self.get_sprite()
+        return self._bbox
+
+    def get_sprite(self):
+        """
+        返回预先渲染好的水印小图及其相对 (x, y) 的偏移，文字或样式变化时才重新渲染
+        :return: (sprite, (dx, dy))，文字为空时 sprite 为 None
+        """
+        key = self._style_key()
+        if key != self._sprite_key:
+            self._sprite, self._sprite_offset, self._bbox = render_text_sprite(
+                self.text, self.size, self.color, self.stroke_width, self.stroke)
+            self._sprite_key = key
+        return self._sprite, self._sprite_offset
 
-        dummy = Image.new("RGBA", (1, 1))
-        draw = ImageDraw.Draw(dummy)
-        return draw.textbbox((0, 0), self.text, font=font)
+    def get_sprite_box(self):
+        """水印小图在原图上覆盖的区域 (x1, y1, x2, y2)，未裁剪到图像范围"""
+        sprite, (dx, dy) = self.get_sprite()
+        if sprite is None:
+            return None
+        x, y = self.x + dx, self.y + dy
+        return (x, y, x + sprite.width, y + sprite.height)
+
+    def draw_on(self, img):
+        """把水印小图就地贴到 RGB 图像上，返回实际改动的区域"""
+        box = self.get_sprite_box()
+        if box is None:
+            return None
+        sprite = self._sprite
+        img.paste(sprite, box[:2], sprite)
+        clipped = (max(0, box[0]), max(0, box[1]), min(img.width, box[2]), min(img.height, box[3]))
+        if clipped[0] >= clipped[2] or clipped[1] >= clipped[3]:
+            return None
+        return clipped
+
+    def update_preview(self):
+        """只在水印覆盖的区域重新合成预览，返回 (预览图, 需要刷新的区域)"""
+        if self._compositor is None:
+            self._compositor = RegionCompositor(self.base)
+        box = self._compositor.update(self.draw_on)
+        return self._compositor.image, box
 
     def apply(self):
-        """真正绘制到新图层，用于预览和最终应用"""
-        img = self.base.convert("RGBA")
-        layer = Image.new("RGBA", img.size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(layer)
+        """生成带水印的新图，用于最终应用"""
+        img = self.base.convert("RGB")
+        self.draw_on(img)
+        return img
+
+class TiledWatermark:
+    """平铺水印：旋转后的单元只渲染一次，按图像尺寸缓存整层平铺结果，每张图只需一次合成"""
+    MAX_CACHED_LAYERS = 4  # 批量处理时常见的几种图像尺寸
+
+    def __init__(self, mark, spacing=100, angle=30, opacity=255):
+        """
+        :param mark: RGBA 水印单元（文字小图或图片水印）
+        :param spacing: 相邻水印之间的间距（像素）
+        :param angle: 逆时针旋转角度
+        :param opacity: 整体不透明度 0-255
+        """
+        mark = mark.convert("RGBA")
+        if opacity < 255:
+            alpha = mark.getchannel("A").point(lambda p: p * opacity // 255)
+            mark.putalpha(alpha)
+        mark = mark.rotate(angle, expand=True, resample=Image.BICUBIC)
+        # 隔行错开半个单元，两行组成一个可以无缝重复的平铺块
+        spacing = max(0, int(spacing))
+        tile_w = mark.width + spacing
+        row_h = mark.height + spacing
+        half = tile_w // 2
+        self.tile = Image.new("RGBA", (tile_w, row_h * 2), (0, 0, 0, 0))
+        self.tile.alpha_composite(mark, (0, 0))
+        # 第二行超出右边界的部分绕回左侧
+        self.tile.alpha_composite(mark, (half, row_h), (0, 0, min(mark.width, tile_w - half), mark.height))
+        if mark.width > tile_w - half:
+            self.tile.alpha_composite(mark, (0, row_h), (tile_w - half, 0))
+        self._layers = OrderedDict()
+        self._lock = threading.Lock()
 
-        try:
-            font = ImageFont.truetype("msyh.ttc", self.size)
-        except:
-            font = ImageFont.load_default()
+    @classmethod
+    def from_text(cls, text, size, rgb_color, stroke_color=(0, 0, 0), stroke_width=0, **kwargs):
+        """用文字创建平铺水印，透明度通过 opacity 统一作用于文字和描边"""
+        sprite, _, _ = render_text_sprite(text, size, (*rgb_color, 255), stroke_width, stroke_color)
+        if sprite is None:
+            raise ValueError("水印文字不能为空")
+        return cls(sprite, **kwargs)
 
-        # 描边
-        if self.stroke_width > 0:
-            for dx in (-self.stroke_width, self.stroke_width):
-                for dy in (-self.stroke_width, self.stroke_width):
-                    draw.text((self.x + dx, self.y + dy), self.text, font=font, fill=self.stroke)
+    def get_layer(self, size):
+        """取得覆盖整幅图像的平铺图层，同一尺寸只生成一次"""
+        with self._lock:
+            layer = self._layers.get(size)
+            if layer is not None:
+                self._layers.move_to_end(size)
+                return layer
+            layer = self.layer_for((0, 0) + tuple(size))
+            self._layers[size] = layer
+            while len(self._layers) > self.MAX_CACHED_LAYERS:
+                self._layers.popitem(last=False)
+            return layer
 
-        # 主文字
-        draw.text((self.x, self.y), self.text, font=font, fill=self.color)
+    def layer_for(self, box):
+        """整层平铺图层中 box 区域的部分；分块处理超大图时只生成当前块需要的部分"""
+        x1, y1, x2, y2 = box
+        layer = Image.new("RGBA", (x2 - x1, y2 - y1), (0, 0, 0, 0))
+        tile_w, tile_h = self.tile.size
+        for y in range(y1 - y1 % tile_h, y2, tile_h):
+            for x in range(x1 - x1 % tile_w, x2, tile_w):
+                layer.paste(self.tile, (x - x1, y - y1))
+        return layer
+
+    def apply(self, img):
+        """返回加上平铺水印的新图"""
+        img = img.convert("RGB")
+        layer = self.get_layer(img.size)
+        img.paste(layer, (0, 0), layer)
+        return img
 
-        return Image.alpha_composite(img, layer).convert("RGB")
 
 class DraggableSticker:
     """可拖动 + 可删除 + 支持大小调整 + 支持旋转的贴纸"""
+    MAX_CACHED_TRANSFORMS = 32  # 最多缓存多少种 (缩放, 角度) 的变换结果
 
     def __init__(self, base_img, sticker_path):
         self.base = base_img
@@ -171,16 +625,18 @@ class DraggableSticker:
         if img.mode == 'P' and 'transparency' in img.info:
             img = img.convert('RGBA')
         self.original_sticker = img.convert("RGBA")
-        self.sticker = self.original_sticker.copy()
+        # 变换缓存：(缩放, 角度) -> 贴纸图像；缩放缓存：最近一次缩放的 (缩放, 预乘 alpha 的缩放图)
+        self._transforms = OrderedDict()
+        self._scaled = None
         
         # 默认大小为原始贴纸的50%，但不超过图片的1/3
         max_size = min(base_img.width, base_img.height) // 3
-        original_width, original_height = self.sticker.size
+        original_width, original_height = self.original_sticker.size
         scale_factor = min(0.5, max_size / max(original_width, original_height))
         
         self.original_width = int(original_width * scale_factor)
         self.original_height = int(original_height * scale_factor)
-        self.sticker = self.sticker.resize((self.original_width, self.original_height), Image.LANCZOS)
+        self.sticker = self._get_transformed(scale_factor, 0)
         
         # 默认放在中心
         self.x = base_img.width // 2
@@ -192,33 +648,64 @@ class DraggableSticker:
         # 缩放比例
         self.scale = 1.0
         
-        # 更新宽高（旋转前的宽高）
-        self.width = self.original_width
-        self.height = self.original_height
+        # 更新宽高：取变换后贴纸的实际尺寸，与 set_style 一致
+        self.width, self.height = self.sticker.size
         
     def set_style(self, scale, rotation):
         """设置贴纸样式：缩放比例和旋转角度"""
         self.scale = scale
         self.rotation = rotation
         
-        # 应用缩放和旋转
-        original_width, original_height = self.original_sticker.size
-        new_width = int(original_width * self.scale)
-        new_height = int(original_height * self.scale)
-        
         # 保存旋转前的宽高（用于白框）
-        self.original_width = new_width
-        self.original_height = new_height
-        
-        # 先缩放
-        scaled_sticker = self.original_sticker.resize((new_width, new_height), Image.LANCZOS)
+        original_width, original_height = self.original_sticker.size
+        self.original_width = int(original_width * self.scale)
+        self.original_height = int(original_height * self.scale)
         
-        # 再旋转
-        self.sticker = scaled_sticker.rotate(self.rotation, expand=True, resample=Image.BICUBIC)
+        # 缩放和旋转合并为一次仿射变换，相同参数直接取缓存
+        self.sticker = self._get_transformed(self.scale, self.rotation)
         
         # 更新宽高（旋转后的宽高）
         self.width, self.height = self.sticker.size
     
+    def _get_transformed(self, scale, rotation):
+        """取得缩放并旋转后的贴纸，角度按 0.5° 量化后作为缓存键"""
+        key = (round(scale, 3), round(rotation * 2) / 2 % 360)
+        sticker = self._transforms.get(key)
+        if sticker is not None:
+            self._transforms.move_to_end(key)
+            return sticker
+        sticker = self._transform(*key)
+        self._transforms[key] = sticker
+        while len(self._transforms) > self.MAX_CACHED_TRANSFORMS:
+            self._transforms.popitem(last=False)
+        return sticker
+    
+    def _transform(self, scale, rotation):
+        """先用 LANCZOS 缩放到目标尺寸，再用一次仿射重采样旋转（输出尺寸与 rotate(expand=True) 一致）"""
+        # 仿射采样缩小时不会加宽插值核，缩放交给 resize；只调角度时复用同一张缩放图
+        if self._scaled is None or self._scaled[0] != scale:
+            w, h = self.original_sticker.size
+            size = (max(1, int(w * scale)), max(1, int(h * scale)))
+            # 在预乘 alpha 空间插值，透明边缘不会混入黑边
+            self._scaled = (scale, self.original_sticker.convert("RGBa").resize(size, Image.LANCZOS))
+        src = self._scaled[1]
+        if rotation == 0:
+            return src.convert("RGBA")
+        
+        w, h = src.size
+        angle = math.radians(rotation)
+        cos_a, sin_a = math.cos(angle), math.sin(angle)
+        out_w = max(1, int(math.ceil(abs(w * cos_a) + abs(h * sin_a) - 1e-6)))
+        out_h = max(1, int(math.ceil(abs(w * sin_a) + abs(h * cos_a) - 1e-6)))
+        
+        # 输出坐标 -> 源坐标：以中心为原点逆向旋转
+        cx, cy = w / 2, h / 2
+        ox, oy = out_w / 2, out_h / 2
+        a, b = cos_a, -sin_a
+        d, e = sin_a, cos_a
+        matrix = (a, b, cx - a * ox - b * oy, d, e, cy - d * ox - e * oy)
+        return src.transform((out_w, out_h), Image.AFFINE, matrix, resample=Image.BICUBIC).convert("RGBA")
+    
     def get_original_bbox(self):
         """获取旋转前的边界框（用于绘制白框）"""
         # 计算旋转前的边界框
@@ -243,23 +730,167 @@ class DraggableSticker:
         
         return (x1, y1, x2, y2)
     
-    def apply(self):
-        """真正绘制到新图层，用于预览和最终应用"""
-        img = self.base.convert("RGBA")
-        layer = Image.new("RGBA", img.size, (0, 0, 0, 0))
-        
-        # 计算贴纸在图层上的位置
+    def get_paste_box(self, img_size):
+        """贴纸实际贴到图像上的区域 (x1, y1, x2, y2)，位置限制在图像范围内"""
+        # 计算贴纸在图像上的位置
         x = self.x - self.width // 2
         y = self.y - self.height // 2
         
         # 确保贴纸不会超出图片边界
-        x = max(0, min(x, img.width - self.width))
-        y = max(0, min(y, img.height - self.height))
-        
-        # 绘制贴纸 - 确保坐标为整数
-        layer.paste(self.sticker, (int(x), int(y)), self.sticker)
-        
-        return Image.alpha_composite(img, layer).convert("RGB")
+        x = int(max(0, min(x, img_size[0] - self.width)))
+        y = int(max(0, min(y, img_size[1] - self.height)))
+        box = (x, y, min(img_size[0], x + self.width), min(img_size[1], y + self.height))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return None
+        return box
+    
+    def draw_on(self, img, clip=None):
+        """
+        把贴纸就地贴到 RGB 图像上
+        :param clip: 只绘制该区域内的部分，None 表示整个贴纸
+        :return: 实际改动的区域
+        """
+        box = self.get_paste_box(img.size)
+        if box is None:
+            return None
+        x, y = box[:2]
+        if clip is not None:
+            box = (max(box[0], clip[0]), max(box[1], clip[1]), min(box[2], clip[2]), min(box[3], clip[3]))
+            if box[0] >= box[2] or box[1] >= box[3]:
+                return None
+        # 以贴纸自身的 alpha 作为遮罩贴上
+        part = self.sticker.crop((box[0] - x, box[1] - y, box[2] - x, box[3] - y))
+        img.paste(part, box[:2], part)
+        return box
+    
+    def contains(self, px, py, img_size):
+        """点 (px, py) 是否落在贴纸的不透明像素上"""
+        box = self.get_paste_box(img_size)
+        if box is None or not (box[0] <= px < box[2] and box[1] <= py < box[3]):
+            return False
+        return self.sticker.getpixel((int(px) - box[0], int(py) - box[1]))[3] > 0
+    
+    def apply(self):
+        """生成带贴纸的新图，用于最终应用"""
+        img = self.base.convert("RGB")
+        self.draw_on(img)
+        return img
+
+class StickerLayer:
+    """
+    同时容纳多个贴纸的叠加层
+    用均匀网格做空间索引，点击检测和区域重绘只检查相关格子里的贴纸；
+    贴纸移动或变化时只重新合成它新旧位置覆盖的区域
+    """
+    CELL_SIZE = 128  # 网格边长（像素）
+
+    def __init__(self, base_img):
+        self.base = base_img.convert("RGB")
+        self.image = self.base.copy()  # 合成结果，保持最新
+        self.stickers = []  # 按叠放顺序，最后一个在最上层
+        self._order = {}  # id(sticker) -> 叠放序号
+        self._boxes = {}  # id(sticker) -> 建立索引时的区域
+        self._grid = {}  # (列, 行) -> {id(sticker)}
+        self._by_id = {}
+
+    def __len__(self):
+        return len(self.stickers)
+
+    def _cells(self, box):
+        c = self.CELL_SIZE
+        for gy in range(box[1] // c, (box[3] - 1) // c + 1):
+            for gx in range(box[0] // c, (box[2] - 1) // c + 1):
+                yield gx, gy
+
+    def _unindex(self, key):
+        """从网格中删除贴纸，返回它原来的区域"""
+        old = self._boxes.pop(key, None)
+        if old:
+            for cell in self._cells(old):
+                ids = self._grid.get(cell)
+                if ids:
+                    ids.discard(key)
+                    if not ids:
+                        del self._grid[cell]
+        return old
+
+    def _index(self, sticker):
+        """按贴纸当前位置重新建立索引，返回 (原区域, 新区域)"""
+        key = id(sticker)
+        old = self._unindex(key)
+        box = sticker.get_paste_box(self.base.size)
+        if box:
+            self._boxes[key] = box
+            for cell in self._cells(box):
+                self._grid.setdefault(cell, set()).add(key)
+        return old, box
+
+    def _renumber(self):
+        self._order = {id(s): i for i, s in enumerate(self.stickers)}
+
+    def _query(self, box):
+        """与 box 相交的贴纸，按叠放顺序从下到上"""
+        ids = set()
+        for cell in self._cells(box):
+            ids.update(self._grid.get(cell, ()))
+        hits = [key for key in ids if _boxes_overlap(self._boxes[key], box)]
+        return [self._by_id[key] for key in sorted(hits, key=self._order.get)]
+
+    def _recomposite(self, box):
+        """从底图开始重新合成 box 区域内的所有贴纸"""
+        if not box:
+            return None
+        self.image.paste(self.base.crop(box), box[:2])
+        for sticker in self._query(box):
+            sticker.draw_on(self.image, clip=box)
+        return box
+
+    def add(self, sticker):
+        """添加贴纸到最上层，返回需要刷新的区域"""
+        self.stickers.append(sticker)
+        self._by_id[id(sticker)] = sticker
+        self._renumber()
+        _, box = self._index(sticker)
+        if box:
+            sticker.draw_on(self.image)
+        return box
+
+    def remove(self, sticker):
+        """移除贴纸，返回需要刷新的区域"""
+        if sticker not in self.stickers:
+            return None
+        self.stickers.remove(sticker)
+        old = self._unindex(id(sticker))
+        del self._by_id[id(sticker)]
+        self._renumber()
+        return self._recomposite(old)
+
+    def update(self, sticker):
+        """贴纸移动、缩放或旋转后调用，返回需要刷新的区域"""
+        old, box = self._index(sticker)
+        return self._recomposite(_union_box(old, box))
+
+    def raise_to_top(self, sticker):
+        """把贴纸移到最上层，返回需要刷新的区域"""
+        if not self.stickers or self.stickers[-1] is sticker:
+            return None
+        self.stickers.remove(sticker)
+        self.stickers.append(sticker)
+        self._renumber()
+        return self._recomposite(self._boxes.get(id(sticker)))
+
+    def hit_test(self, px, py):
+        """返回点 (px, py) 处最上层的贴纸，没有则返回 None"""
+        if px < 0 or py < 0:
+            return None
+        c = self.CELL_SIZE
+        ids = self._grid.get((int(px) // c, int(py) // c), ())
+        for key in sorted(ids, key=self._order.get, reverse=True):
+            sticker = self._by_id[key]
+            if sticker.contains(px, py, self.base.size):
+                return sticker
+        return None
+
 
 class CropController:
     RATIOS = {
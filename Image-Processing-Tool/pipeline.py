@@ -0,0 +1,325 @@
+"""
+非破坏编辑流水线
+
+编辑时操作的是缩小到工作尺寸的代理图，同时把每一步记成一个操作对象（recipe）。
+导出时把 recipe 按顺序重放到全分辨率源图上：逐像素/小邻域的操作按水平条带处理并写回原图，
+几何操作整体变换一次，因此任何时刻只有一到两份全尺寸图在内存里。
+"""
+import math
+
+from PIL import Image, ImageChops, ImageEnhance, ImageFilter, ImageOps
+
+from utils import apply_3d_lut, lossless_mcu, parse_cube_file, save_image_atomic
+
+STRIP_HEIGHT = 512  # 条带处理时每条的行数
+
+
+def process_strips(img, func, margin=0):
+    """
+    把 img 按水平条带交给 func 处理，结果就地写回 img。
+
+    func(strip, box) 接收带上下 margin 行的条带和条带在图中的区域，返回同尺寸的图；
+    需要邻域的滤镜靠 margin 读到相邻条带的原始像素，上一条已写回的部分用 carry 里保存的原始行代替。
+    """
+    w, h = img.size
+    carry = None  # 上一条带末尾 margin 行的原始像素
+    for y0 in range(0, h, STRIP_HEIGHT):
+        y1 = min(h, y0 + STRIP_HEIGHT)
+        bottom = min(h, y1 + margin)
+        body = img.crop((0, y0, w, bottom))
+        if carry is not None:
+            strip = Image.new(img.mode, (w, carry.height + body.height))
+            strip.paste(carry, (0, 0))
+            strip.paste(body, (0, carry.height))
+            top = carry.height
+        else:
+            strip = body
+            top = 0
+        if margin:
+            carry = img.crop((0, max(y0, y1 - margin), w, y1))
+
+        result = func(strip, (0, y0 - top, w, bottom))
+        img.paste(result.crop((0, top, w, top + y1 - y0)), (0, y0))
+    return img
+
+
+class Operation:
+    """可重放的编辑操作。apply 接收当前图片和源图相对工作图的缩放比例，返回结果图"""
+
+    def apply(self, img, scale=1.0):
+        raise NotImplementedError
+
+
+class RegionOperation(Operation):
+    """
+    逐像素或只依赖小邻域的操作，可以按条带（process_strips）或分块（tile_processor）处理。
+    子类实现 apply_region；需要邻域时由 halo 给出每边多读的像素数。
+    """
+
+    def halo(self, scale=1.0):
+        return 0
+
+    def apply_region(self, region, box, size, scale=1.0):
+        """处理整图中 box 区域（已含邻域）的像素 region，size 为整图尺寸，返回同尺寸的图"""
+        raise NotImplementedError
+
+    def apply(self, img, scale=1.0):
+        size = img.size
+        return process_strips(img, lambda strip, box: self.apply_region(strip, box, size, scale), self.halo(scale))
+
+
+class Transpose(Operation):
+    """90° 旋转和镜像翻转"""
+
+    # Image.Transpose -> jpegtran 无损操作（jpegtran 的旋转为顺时针）
+    LOSSLESS = {
+        Image.Transpose.ROTATE_90: ("rotate", 270),
+        Image.Transpose.ROTATE_270: ("rotate", 90),
+        Image.Transpose.ROTATE_180: ("rotate", 180),
+        Image.Transpose.FLIP_LEFT_RIGHT: ("flip", "horizontal"),
+        Image.Transpose.FLIP_TOP_BOTTOM: ("flip", "vertical"),
+    }
+
+    def __init__(self, method):
+        self.method = method
+
+    def apply(self, img, scale=1.0):
+        return img.transpose(self.method)
+
+
+class Rotate(Operation):
+    """任意角度旋转（逆时针，扩展画布）"""
+
+    def __init__(self, angle):
+        self.angle = angle
+
+    def apply(self, img, scale=1.0):
+        return img.rotate(self.angle, resample=Image.Resampling.BICUBIC, expand=True)
+
+
+class Crop(Operation):
+    """裁剪，box 为工作图坐标"""
+
+    def __init__(self, box):
+        self.box = tuple(box)
+
+    def apply(self, img, scale=1.0):
+        x1, y1, x2, y2 = (round(v * scale) for v in self.box)
+        w, h = img.size
+        return img.crop((max(0, x1), max(0, y1), min(w, max(x1 + 1, x2)), min(h, max(y1 + 1, y2))))
+
+
+class Enhance(RegionOperation):
+    """亮度/对比度/饱和度/锐度调节，按调节面板的顺序依次应用"""
+
+    def __init__(self, adjustments, mean=128):
+        self.adjustments = dict(adjustments)
+        self.mean = mean  # 对比度以整图平均灰度为中心，条带处理时不能按条带各自计算
+
+    @classmethod
+    def record(cls, img, adjustments):
+        """在工作图上记录调节参数以及对比度需要的平均灰度"""
+        mean = 128
+        if adjustments.get("contrast", 1.0) != 1.0:
+            base = img
+            if adjustments.get("brightness", 1.0) != 1.0:
+                base = ImageEnhance.Brightness(img).enhance(adjustments["brightness"])
+            hist = base.convert("L").histogram()
+            mean = int(sum(i * n for i, n in enumerate(hist)) / max(1, sum(hist)) + 0.5)
+        return cls(adjustments, mean)
+
+    def halo(self, scale=1.0):
+        return 1 if self.adjustments.get("sharpness", 1.0) != 1.0 else 0
+
+    def apply_region(self, strip, box, size, scale=1.0):
+        adj = self.adjustments
+        if adj.get("brightness", 1.0) != 1.0:
+            strip = ImageEnhance.Brightness(strip).enhance(adj["brightness"])
+        if adj.get("contrast", 1.0) != 1.0:
+            gray = Image.new("L", strip.size, self.mean).convert(strip.mode)
+            strip = Image.blend(gray, strip, adj["contrast"])
+        if adj.get("saturation", 1.0) != 1.0:
+            strip = ImageEnhance.Color(strip).enhance(adj["saturation"])
+        if adj.get("sharpness", 1.0) != 1.0:
+            strip = ImageEnhance.Sharpness(strip).enhance(adj["sharpness"])
+        return strip
+
+
+def apply_filter(img, mode, scale=1.0):
+    """滤镜面板的预设滤镜；scale 为相对工作图的缩放，模糊半径随之放大"""
+    if mode == "黑白":
+        return img.convert("L").convert("RGB")
+    elif mode == "怀旧":
+        # 简单的棕褐色滤镜模拟
+        sepia = []
+        r, g, b = (239, 224, 198)
+        for i in range(255):
+            sepia.extend((int(r * i / 255), int(g * i / 255), int(b * i / 255)))
+        img = img.convert("L")
+        img.putpalette(sepia)
+        return img.convert("RGB")
+    elif mode == "模糊":
+        return img.filter(ImageFilter.GaussianBlur(5 * scale))
+    elif mode == "浮雕":
+        return img.filter(ImageFilter.EMBOSS)
+    elif mode == "轮廓":
+        return img.filter(ImageFilter.CONTOUR)
+    return img
+
+
+class Filter(RegionOperation):
+    """预设滤镜"""
+
+    def __init__(self, mode):
+        self.mode = mode
+
+    def halo(self, scale=1.0):
+        if self.mode == "模糊":
+            return math.ceil(5 * scale * 3) + 1
+        elif self.mode in ("浮雕", "轮廓"):
+            return 1
+        return 0
+
+    def apply_region(self, region, box, size, scale=1.0):
+        return apply_filter(region, self.mode, scale)
+
+
+class LUT(RegionOperation):
+    """LUT 滤镜：.cube 文件逐像素映射，图片 LUT 按 0.6 混合"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lut = None  # 解析后的 .cube 数据或 LUT 图，按区域处理时只读一次
+
+    def _load(self):
+        if self._lut is None:
+            if self.path.lower().endswith(".cube"):
+                self._lut = parse_cube_file(self.path)
+            else:
+                self._lut = Image.open(self.path).convert("RGB")
+        return self._lut
+
+    def apply_region(self, region, box, size, scale=1.0):
+        lut = self._load()
+        if isinstance(lut, tuple):
+            return apply_3d_lut(region, *lut)
+        # 只把 LUT 图对应区域的部分缩放到区域尺寸
+        fx, fy = lut.width / size[0], lut.height / size[1]
+        part = lut.resize(region.size, box=(box[0] * fx, box[1] * fy, box[2] * fx, box[3] * fy))
+        return Image.blend(region, part, 0.6)
+
+
+class Autocontrast(RegionOperation):
+    """自动对比度：映射表在工作图上按直方图求得，导出时直接查表"""
+
+    def __init__(self, lut):
+        self.lut = lut
+
+    @classmethod
+    def record(cls, img):
+        hist = img.histogram()
+        lut = []
+        for band in range(len(img.getbands())):
+            h = hist[band * 256:(band + 1) * 256]
+            used = [i for i, n in enumerate(h) if n]
+            lo, hi = (used[0], used[-1]) if used else (0, 255)
+            if hi <= lo:
+                lut.extend(range(256))
+                continue
+            k = 255.0 / (hi - lo)
+            lut.extend(max(0, min(255, int((i - lo) * k))) for i in range(256))
+        return cls(lut)
+
+    def apply_region(self, region, box, size, scale=1.0):
+        return region.point(self.lut)
+
+
+class Patch(Operation):
+    """
+    局部绘制结果（涂鸦、马赛克、文字、贴纸等）：保存工作图上发生变化的区域及其遮罩，
+    导出时放大后贴回对应位置。这些内容本身在工作分辨率下生成，放大后会略软。
+    """
+
+    def __init__(self, box, layer):
+        self.box = box  # 变化区域 (x1, y1, x2, y2)，工作图坐标；None 表示没有变化
+        self.layer = layer  # 变化区域的 RGBA 图，alpha 为变化遮罩
+
+    @classmethod
+    def from_diff(cls, before, after):
+        """比较操作前后的工作图，只保留变化的像素"""
+        if before.size != after.size:
+            raise ValueError("Patch 要求操作前后尺寸一致")
+        diff = ImageChops.difference(before, after)
+        box = diff.getbbox()
+        if not box:
+            return cls(None, None)
+        mask = diff.crop(box)
+        if mask.mode != "L":
+            bands = mask.split()
+            mask = bands[0]
+            for band in bands[1:]:
+                mask = ImageChops.lighter(mask, band)
+        mask = mask.point(lambda v: 255 if v else 0)
+        layer = after.crop(box).convert("RGBA")
+        layer.putalpha(mask)
+        return cls(box, layer)
+
+    def apply(self, img, scale=1.0):
+        if not self.box:
+            return img
+        x1, y1, x2, y2 = (round(v * scale) for v in self.box)
+        size = (max(1, x2 - x1), max(1, y2 - y1))
+        layer = self.layer if size == self.layer.size else self.layer.resize(size, Image.Resampling.BILINEAR)
+        img.paste(layer.convert(img.mode), (x1, y1), layer)
+        return img
+
+
+def open_source(path):
+    """与 open_image 相同的方式读取全分辨率源图（按 EXIF 方向摆正）"""
+    img = Image.open(path)
+    if img.mode == 'P' and 'transparency' in img.info:
+        img = img.convert('RGBA')
+    return ImageOps.exif_transpose(img.convert("RGB"))
+
+
+def render(path, ops, scale, progress=None):
+    """把 recipe 重放到全分辨率源图上，返回结果图；progress(已完成步数, 总步数) 报告进度"""
+    img = open_source(path)
+    for i, op in enumerate(ops):
+        if progress:
+            progress(i, len(ops))
+        img = op.apply(img, scale)
+    if progress:
+        progress(len(ops), len(ops))
+    return img
+
+
+def export(path, ops, scale, out_path, progress=None, write_progress=None, metadata=None, **save_kwargs):
+    """
+    全分辨率导出：重放 recipe 后原子地保存到 out_path，返回导出尺寸。
+    metadata(img) 按导出图生成元数据参数（EXIF 尺寸、缩略图要与导出图一致）。
+    """
+    img = render(path, ops, scale, progress)
+    if metadata:
+        save_kwargs.update(metadata(img))
+    save_image_atomic(img, out_path, write_progress, **save_kwargs)
+    return img.size
+
+
+def lossless_jpeg_ops(ops, mcu):
+    """recipe 只含 90° 旋转、翻转和左上角对齐 MCU 的裁剪时，返回对应的 jpegtran 操作序列，否则返回 None"""
+    if ops is None or not mcu:
+        return None
+    result = []
+    for op in ops:
+        if isinstance(op, Transpose):
+            result.append(Transpose.LOSSLESS[op.method])
+        elif isinstance(op, Crop):
+            x1, y1, x2, y2 = op.box
+            mcu_w, mcu_h = lossless_mcu(mcu, result)
+            if x1 % mcu_w or y1 % mcu_h:
+                return None
+            result.append(("crop", (x1, y1, x2 - x1, y2 - y1)))
+        else:
+            return None
+    return result
@@ -0,0 +1,309 @@
+"""
+超大图分块流式处理
+
+面向上亿像素的扫描图：源图先按行条带解码到磁盘上的 RGBX 缓冲区（mmap），
+再按 TILE_SIZE 分块读出、依次应用逐像素/邻域操作（pipeline.RegionOperation）后写到输出缓冲区，
+需要邻域的滤镜按各操作 halo 之和多读一圈像素；最后直接从映射的缓冲区编码保存。
+进程内存只与分块大小有关，整图像素都在由系统按页调度的文件映射里。
+
+未压缩的 TIFF/PPM/BMP 可以逐条带解码；JPEG/PNG 等压缩格式 Pillow 只能整图解码，
+这时解码一次后立刻写入缓冲区并释放。PNG/BMP 不能直接保存 RGBX，输出时需要整图转换一次；
+WEBP/AVIF 编码器本身要求整图在内存中。输出一律为 RGB。
+"""
+import math
+import mmap
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from PIL import Image
+
+import encoders
+from config import ENCODER_PRESET, TILE_SIZE, TILE_TEMP_DIR, TILED_MAX_PIXELS, TILED_MIN_PIXELS
+from pipeline import RegionOperation
+from utils import ORIENTATION_TRANSPOSE, exif_orientation, oriented_size, read_metadata, save_image_atomic
+
+BAND_ROWS = 256  # 解码源图时每个条带的行数
+
+# raw 解码器的行模式 -> 每像素字节数，用于计算条带在文件中的偏移
+_RAW_BYTES = {
+    "L": 1, "P": 1, "LA": 2, "RGB": 3, "BGR": 3,
+    "RGBX": 4, "RGBA": 4, "RGBa": 4, "BGRX": 4, "BGRA": 4, "CMYK": 4,
+}
+
+# large_images() 的嵌套计数：多个批量线程同时使用时，最后一个退出的才恢复默认上限
+_limit_lock = threading.Lock()
+_limit_users = 0
+_saved_limit = None
+
+
+class Watermark(RegionOperation):
+    """把 RGBA 水印图贴到固定位置（图片水印或文字水印的小图）"""
+
+    def __init__(self, layer, position):
+        self.layer = layer.convert("RGBA")
+        self.position = tuple(position)
+
+    @classmethod
+    def from_text(cls, watermark):
+        """从已设置好文字、样式和位置的 DraggableTextWatermark 创建，文字为空时返回 None"""
+        sprite, _ = watermark.get_sprite()
+        if sprite is None:
+            return None
+        return cls(sprite, watermark.get_sprite_box()[:2])
+
+    def apply_region(self, region, box, size, scale=1.0):
+        x, y = self.position[0] - box[0], self.position[1] - box[1]
+        if x < region.width and y < region.height and x + self.layer.width > 0 and y + self.layer.height > 0:
+            region.paste(self.layer, (x, y), self.layer)
+        return region
+
+
+class TiledWatermarkOp(RegionOperation):
+    """平铺水印（models.TiledWatermark），每块只生成自己区域内的图层"""
+
+    def __init__(self, tiled):
+        self.tiled = tiled
+
+    def apply_region(self, region, box, size, scale=1.0):
+        layer = self.tiled.layer_for(box)
+        region.paste(layer, (0, 0), layer)
+        return region
+
+
+class _RawBuffer:
+    """磁盘上的 RGBX 像素缓冲区，通过 mmap 读写"""
+
+    def __init__(self, size, directory=None):
+        self.size = size
+        self.stride = size[0] * 4
+        fd, self.path = tempfile.mkstemp(prefix="tile-", suffix=".rgbx", dir=directory)
+        try:
+            with os.fdopen(fd, "r+b") as f:
+                f.truncate(self.stride * size[1])
+                self.mm = mmap.mmap(f.fileno(), 0)
+        except Exception:
+            os.remove(self.path)
+            raise
+
+    def paste(self, region, xy):
+        """把 region 写到缓冲区的 xy 处（region 不超出缓冲区）"""
+        x, y = xy
+        data = region.convert("RGBX").tobytes()
+        row = region.width * 4
+        start = y * self.stride + x * 4
+        if x == 0 and region.width == self.size[0]:
+            self.mm[start:start + len(data)] = data  # 整行的条带在文件中是连续的
+            return
+        for i in range(region.height):
+            offset = start + i * self.stride
+            self.mm[offset:offset + row] = data[i * row:(i + 1) * row]
+
+    def image(self):
+        """直接引用缓冲区的只读图，不复制像素；用完要先释放图再 close"""
+        return Image.frombuffer("RGBX", self.size, self.mm, "raw", "RGBX", 0, 1)
+
+    def close(self):
+        try:
+            self.mm.close()
+        except BufferError:
+            pass  # 仍有图片引用映射，交给垃圾回收
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass  # Windows 下仍被映射的文件删不掉
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@contextmanager
+def large_images():
+    """
+    在 with 块内把 Pillow 的解压炸弹上限放宽到 TILED_MAX_PIXELS（Pillow 超过两倍上限才报错），
+    退出后恢复。只包住分块处理打开源图的地方，编辑器等其它地方仍按默认上限检查。
+    """
+    global _limit_users, _saved_limit
+    with _limit_lock:
+        if _limit_users == 0:
+            _saved_limit = Image.MAX_IMAGE_PIXELS
+            if _saved_limit and _saved_limit < TILED_MAX_PIXELS // 2:
+                Image.MAX_IMAGE_PIXELS = TILED_MAX_PIXELS // 2
+        _limit_users += 1
+    try:
+        yield
+    finally:
+        with _limit_lock:
+            _limit_users -= 1
+            if _limit_users == 0:
+                Image.MAX_IMAGE_PIXELS = _saved_limit
+
+
+def open_image(path):
+    """
+    以放宽的上限打开批量处理的源图（只读文件头）。
+    决定处理方式后要调用 check_pixels，整图解码的图片仍按 Pillow 的默认上限检查。
+    """
+    with large_images():
+        return Image.open(path)
+
+
+def check_pixels(img, streaming):
+    """按处理方式检查像素数：分块处理不超过 TILED_MAX_PIXELS，整图解码不超过 Pillow 的默认上限"""
+    pixels = img.width * img.height
+    if streaming:
+        limit = TILED_MAX_PIXELS
+    else:
+        limit = Image.MAX_IMAGE_PIXELS and 2 * Image.MAX_IMAGE_PIXELS
+    if limit and pixels > limit:
+        raise Image.DecompressionBombError(f"图片像素数 {pixels} 超过上限 {limit}")
+
+
+def should_tile(img):
+    """批量处理时这张图是否改用分块处理"""
+    return img.width * img.height > TILED_MIN_PIXELS
+
+
+def _to_rgb(img):
+    # 与 pipeline.open_source 相同的颜色处理
+    if img.mode == 'P' and 'transparency' in img.info:
+        img = img.convert('RGBA')
+    return img.convert("RGB")
+
+
+def _band_tiles(img, y1, y2):
+    """
+    把 raw 解码的 tile 描述裁到 [y1, y2) 行，返回新的 tile 列表；
+    不是整行宽的 raw 数据（压缩格式、分块 TIFF 等）或已经解码过（tile 已清空）时返回 None。
+    """
+    if not img.tile:
+        return None
+    w = img.width
+    result = []
+    for tile in img.tile:
+        name, extents, offset, args = tile
+        if isinstance(args, str):
+            args = (args,)
+        rawmode = args[0]
+        stride = args[1] if len(args) > 1 else 0
+        orientation = args[2] if len(args) > 2 else 1
+        if name != "raw" or rawmode not in _RAW_BYTES or extents[0] != 0 or extents[2] != w:
+            return None
+        stride = stride or _RAW_BYTES[rawmode] * w
+        top, bottom = max(y1, extents[1]), min(y2, extents[3])
+        if top >= bottom:
+            continue
+        if orientation < 0:
+            # 自下而上存储：tile 最后一行在文件最前
+            offset += (extents[3] - bottom) * stride
+        else:
+            offset += (top - extents[1]) * stride
+        result.append(tile._replace(extents=(0, top - y1, w, bottom - y1), offset=offset,
+                                    args=(rawmode, stride, orientation)))
+    return result
+
+
+def _spill_source(img, path, banded, buffer):
+    """
+    把已打开的源图 img 按行条带解码到缓冲区，同时按 EXIF 方向摆正。
+    banded 为 True（无需摆正的整行 raw 数据）时逐条带重新打开 path 解码；
+    否则 img 已整图解码，按条带摆正写入。
+    """
+    w, h = img.size
+    if banded:
+        for y in range(0, h, BAND_ROWS):
+            y2 = min(h, y + BAND_ROWS)
+            with Image.open(path) as band:
+                band.tile = _band_tiles(band, y, y2)
+                band._size = (w, y2 - y)
+                if hasattr(band, "_tile_size"):
+                    band._tile_size = band._size  # TIFF 按此分配解码缓冲区
+                buffer.paste(_to_rgb(band), (0, y))
+        return
+
+    full = _to_rgb(img)
+    # TIFF 解码时已经就地摆正并去掉了方向标记，这里取解码后剩下的方向
+    orientation = exif_orientation(img)
+    method = ORIENTATION_TRANSPOSE.get(orientation)
+    w, h = full.size
+    for y in range(0, h, BAND_ROWS):
+        band = full.crop((0, y, w, min(h, y + BAND_ROWS)))
+        if method is None:
+            buffer.paste(band, (0, y))
+        else:
+            buffer.paste(band.transpose(method), _band_position(orientation, y, band.height, buffer.size))
+
+
+def _band_position(orientation, y, rows, size):
+    """源图第 y 行起 rows 行的整行条带摆正后在目标图（尺寸 size）中的左上角"""
+    w, h = size
+    if orientation in (2, 4, 3):
+        # 宽高不变：上下翻转的方向条带落在对称位置
+        return (0, h - y - rows) if orientation in (3, 4) else (0, y)
+    # 5-8 宽高互换，源图的行变成目标图的列
+    return (w - y - rows, 0) if orientation in (6, 7) else (y, 0)
+
+
+def process_file(src, dst, ops, encoder=None, preset=ENCODER_PRESET, quality=None, tile_size=TILE_SIZE,
+                 progress=None):
+    """
+    分块处理 src 并保存到 dst，返回输出尺寸。
+    ops 为 pipeline.RegionOperation 列表（坐标和半径按原图像素计），为空时只做格式转换；
+    输出保留源图的 EXIF/ICC，按 EXIF 方向摆正；progress(已完成块数, 总块数) 报告进度。
+    """
+    for op in ops:
+        if not isinstance(op, RegionOperation):
+            raise ValueError(f"{type(op).__name__} 不能分块处理")
+    encoder = encoder or encoders.encoder_for_path(dst)
+    img = open_image(src)
+    source = None
+    output = None
+    try:
+        check_pixels(img, True)
+        # 先看 tile 再读 EXIF：PNG 的 getexif 会整图解码并清空 tile
+        banded = _band_tiles(img, 0, img.height) is not None and exif_orientation(img) == 1
+        with large_images():  # TIFF 解码时会再次检查尺寸，逐条带解码时会反复打开源图
+            if not banded:
+                img.load()  # 压缩格式只能整图解码，先解码再读元数据和方向，免得为读 EXIF 再解码一次
+            metadata = read_metadata(img)
+            size = oriented_size(img)
+            source = _RawBuffer(size, TILE_TEMP_DIR)
+            _spill_source(img, src, banded, source)
+        img.close()  # 释放整图解码的像素
+        w, h = size
+        halo = sum(op.halo() for op in ops)
+        # 不需要邻域时每块只读自己的区域，可以就地写回
+        output = source if halo == 0 else _RawBuffer(size, TILE_TEMP_DIR)
+
+        if ops:
+            cols, rows = math.ceil(w / tile_size), math.ceil(h / tile_size)
+            total = cols * rows
+            image = source.image()
+            for i in range(total):
+                x1, y1 = (i % cols) * tile_size, (i // cols) * tile_size
+                x2, y2 = min(w, x1 + tile_size), min(h, y1 + tile_size)
+                box = (max(0, x1 - halo), max(0, y1 - halo), min(w, x2 + halo), min(h, y2 + halo))
+                region = image.crop(box).convert("RGB")
+                for op in ops:
+                    region = op.apply_region(region, box, size)
+                output.paste(region.crop((x1 - box[0], y1 - box[1], x2 - box[0], y2 - box[1])), (x1, y1))
+                if progress:
+                    progress(i + 1, total)
+            del image
+
+        result = encoder.prepare(output.image())
+        save_options = encoder.save_options(preset, quality, streaming=True)
+        save_options.update(encoder.metadata_options(metadata, result))
+        save_image_atomic(result, dst, **save_options)
+        del result
+    finally:
+        img.close()
+        if output is not None and output is not source:
+            output.close()
+        if source is not None:
+            source.close()
+    return size
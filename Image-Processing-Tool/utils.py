@@ -1,5 +1,252 @@
-from PIL import Image
+from PIL import ExifTags, Image, ImageFont
 from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import math
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+
+from config import FONT_CACHE_SIZE, FONT_CANDIDATES, FONT_PATH, THUMB_CACHE_DIR
+
+# numpy 为可选依赖：没有安装时几何马赛克退回到基于缩放的近似效果
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# 字体缓存：(字体路径, 字号) -> FreeTypeFont，进程内共享，按最近使用淘汰
+_font_cache = OrderedDict()
+_font_lock = threading.Lock()
+_font_path = None  # 查找到的默认字体，"" 表示没有可用的 TrueType 字体
+
+
+def _find_font_path():
+    """按配置查找第一个能加载的字体文件，只在第一次调用时查找"""
+    global _font_path
+    if _font_path is None:
+        candidates = ([FONT_PATH] if FONT_PATH else []) + list(FONT_CANDIDATES)
+        for candidate in candidates:
+            try:
+                ImageFont.truetype(candidate, 12)
+            except OSError:
+                continue
+            _font_path = candidate
+            break
+        else:
+            _font_path = ""
+            print("未找到可用的 TrueType 字体，水印将使用 Pillow 默认字体，"
+                  "可通过环境变量 IMAGE_TOOL_FONT 指定字体文件")
+    return _font_path
+
+
+def get_font(size, path=None):
+    """
+    获取指定字号的字体对象，相同 (字体, 字号) 只加载一次
+    :param size: 字号
+    :param path: 字体文件路径，默认使用自动查找到的字体
+    :return: ImageFont 字体对象
+    """
+    size = max(1, int(size))
+    with _font_lock:
+        if path is None:
+            path = _find_font_path()
+        key = (path, size)
+        font = _font_cache.get(key)
+        if font is not None:
+            _font_cache.move_to_end(key)
+            return font
+
+        try:
+            font = ImageFont.truetype(path, size) if path else ImageFont.load_default(size=size)
+        except OSError as e:
+            print(f"加载字体失败 {path}: {e}")
+            font = ImageFont.load_default(size=size)
+        _font_cache[key] = font
+        while len(_font_cache) > FONT_CACHE_SIZE:
+            _font_cache.popitem(last=False)
+        return font
+
+
+def _render_thumbnail(path, thumb_size):
+    """按比例缩放到 thumb_size 以内，居中放在透明底上"""
+    img = Image.open(path)
+    # JPEG 可以在解码时直接缩小，省去大部分解码时间
+    img.draft("RGB", (thumb_size[0] * 2, thumb_size[1] * 2))
+    # 处理带有透明通道的调色板图像
+    img = img.convert("RGBA")
+
+    scale = min(thumb_size[0] / img.width, thumb_size[1] / img.height)
+    new_size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+    img = img.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+    thumb = Image.new("RGBA", thumb_size, (255, 255, 255, 0))
+    thumb.paste(img, ((thumb_size[0] - new_size[0]) // 2, (thumb_size[1] - new_size[1]) // 2), img)
+    return thumb
+
+
+def get_thumbnail(path, thumb_size=(70, 70)):
+    """
+    获取图片的缩略图，结果缓存在磁盘上，文件路径、修改时间或大小变化后自动重新生成
+    :param path: 图片路径
+    :param thumb_size: 缩略图尺寸
+    :return: RGBA 缩略图
+    """
+    st = os.stat(path)
+    key = f"{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}|{thumb_size[0]}x{thumb_size[1]}"
+    cache_path = os.path.join(THUMB_CACHE_DIR, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".png")
+
+    try:
+        with Image.open(cache_path) as cached:
+            return cached.convert("RGBA")
+    except (OSError, ValueError):
+        pass
+
+    thumb = _render_thumbnail(path, thumb_size)
+    try:
+        os.makedirs(THUMB_CACHE_DIR, exist_ok=True)
+        # 先写临时文件再改名，避免并发或中断留下不完整的缓存
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        thumb.save(tmp_path, "PNG")
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"写入缩略图缓存失败: {e}")
+    return thumb
+
+
+def exif_thumbnail(img):
+    """取出 JPEG 的 EXIF 中内嵌的缩略图，没有或损坏时返回 None"""
+    raw = img.info.get("exif")
+    if not raw or not raw.startswith(b"Exif\x00\x00"):
+        return None
+    try:
+        ifd1 = img.getexif().get_ifd(ExifTags.IFD.IFD1)
+        offset = ifd1.get(0x0201)  # JPEGInterchangeFormat，相对 TIFF 头
+        length = ifd1.get(0x0202)  # JPEGInterchangeFormatLength
+        if not offset or not length:
+            return None
+        thumb = Image.open(BytesIO(raw[6 + offset:6 + offset + length]))
+        return thumb.convert("RGB")
+    except Exception as e:
+        print(f"读取EXIF缩略图失败: {str(e)}")
+        return None
+
+
+# EXIF Orientation -> 摆正图片所需的变换（与 ImageOps.exif_transpose 一致）
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+EXIF_THUMB_SIZE = (160, 120)
+
+
+def exif_orientation(img):
+    """读取 EXIF 方向标记，没有或无效时返回 1"""
+    try:
+        orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+    except Exception:
+        return 1
+    return orientation if orientation in ORIENTATION_TRANSPOSE else 1
+
+
+def oriented_size(img):
+    """
+    按 EXIF 方向摆正后的图片尺寸（只读文件头）。
+    Pillow 的 TIFF 读取器解码时自行摆正，报告的 size 已经是摆正后的（与内部的 _tile_size 不同）。
+    """
+    if exif_orientation(img) < 5 or img.size != getattr(img, "_tile_size", img.size):
+        return img.size
+    return img.size[::-1]
+
+
+def apply_orientation(img, orientation):
+    """按 EXIF 方向标记摆正图片（用于 EXIF 缩略图等不带标记的图）"""
+    method = ORIENTATION_TRANSPOSE.get(orientation)
+    return img.transpose(method) if method is not None else img
+
+
+def read_metadata(img):
+    """在转换颜色模式之前取出要带到输出文件的元数据：原始 EXIF 与 ICC 配置"""
+    meta = {}
+    for key in ("exif", "icc_profile"):
+        if img.info.get(key):
+            meta[key] = img.info[key]
+    if "exif" in meta:
+        meta["has_thumbnail"] = exif_thumbnail(img) is not None
+    return meta
+
+
+def _append_exif_thumbnail(exif, thumb):
+    """
+    在 Exif.tobytes() 的结果后追加 IFD1 和 JPEG 缩略图。
+    Pillow 只写 IFD0 及其子 IFD，IFD1 需要手工拼：把 IFD0 的"下一 IFD"指针指向末尾的新 IFD1。
+    """
+    tiff = bytearray(exif[6:])
+    order = "<" if tiff[:2] == b"II" else ">"
+    ifd0 = struct.unpack_from(order + "L", tiff, 4)[0]
+    count = struct.unpack_from(order + "H", tiff, ifd0)[0]
+    next_ptr = ifd0 + 2 + 12 * count
+    if struct.unpack_from(order + "L", tiff, next_ptr)[0]:
+        return exif  # 已有后续 IFD，不改动
+    buf = BytesIO()
+    thumb.save(buf, "JPEG", quality=75)
+    data = buf.getvalue()
+    if len(tiff) + 2 + 12 * 3 + 4 + len(data) > 65000:
+        return exif  # JPEG 的 APP1 段放不下
+    if len(tiff) % 2:
+        tiff += b"\x00"
+    ifd1 = len(tiff)
+    struct.pack_into(order + "L", tiff, next_ptr, ifd1)
+    data_offset = ifd1 + 2 + 12 * 3 + 4
+    tiff += struct.pack(order + "H", 3)
+    tiff += struct.pack(order + "HHLHH", 0x0103, 3, 1, 6, 0)  # Compression = JPEG
+    tiff += struct.pack(order + "HHLL", 0x0201, 4, 1, data_offset)
+    tiff += struct.pack(order + "HHLL", 0x0202, 4, 1, len(data))
+    tiff += struct.pack(order + "L", 0)
+    tiff += data
+    return exif[:6] + bytes(tiff)
+
+
+def output_metadata(meta, img, keys=("exif", "icc_profile")):
+    """
+    根据 read_metadata 的结果生成 img.save 的元数据参数，keys 为目标格式支持的元数据。
+    输出像素已经摆正，所以方向标记改为 1，EXIF 中的像素尺寸改为输出尺寸；
+    源文件带缩略图时按输出图重新生成，EXIF 无法重建时丢弃 EXIF 而不影响保存。
+    """
+    options = {}
+    if not meta:
+        return options
+    if "icc_profile" in keys and meta.get("icc_profile"):
+        options["icc_profile"] = meta["icc_profile"]
+    if "exif" in keys and meta.get("exif"):
+        try:
+            exif = Image.Exif()
+            exif.load(meta["exif"])
+            exif[ExifTags.Base.Orientation] = 1
+            sub = exif.get_ifd(ExifTags.IFD.Exif)
+            if sub:
+                sub[ExifTags.Base.ExifImageWidth] = img.width
+                sub[ExifTags.Base.ExifImageHeight] = img.height
+            data = exif.tobytes()
+            if meta.get("has_thumbnail"):
+                k = min(EXIF_THUMB_SIZE[0] / img.width, EXIF_THUMB_SIZE[1] / img.height, 1.0)
+                size = (max(1, round(img.width * k)), max(1, round(img.height * k)))
+                thumb = img.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0).convert("RGB")
+                data = _append_exif_thumbnail(data, thumb)
+            options["exif"] = data
+        except Exception as e:
+            print(f"重建EXIF失败，输出将不含EXIF: {str(e)}")
+    return options
 
 
 def parse_cube_file(cube_path):
@@ -101,13 +348,500 @@ def apply_LUT(img, lut_img_or_path):
         return Image.blend(img, lut, 0.6)
 
 
-def auto_compress(img, target_kb=800):
+JPEG_MIN_QUALITY = 40  # 压缩到目标大小时质量不低于此值，再不够就抽样色度、缩小尺寸
+JPEG_MAX_QUALITY = 95
+
+# 候选编码并行执行：Pillow 编码时释放 GIL，多个候选可以同时跑在不同核上
+ENCODE_WORKERS = min(4, os.cpu_count() or 1)
+_encode_pool = None
+_encode_pool_lock = threading.Lock()
+
+
+def _get_encode_pool():
+    global _encode_pool
+    with _encode_pool_lock:
+        if _encode_pool is None:
+            _encode_pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS,
+                                              thread_name_prefix="encode")
+        return _encode_pool
+
+
+def _encode_image(img, fmt, quality, subsampling=None, extra=None):
+    """
+    编码为字节；每次用新的缓冲区，不会残留上一次更长的内容。extra 为附加的保存参数（如元数据）。
+    Pillow 把保存参数记在图片对象上（encoderinfo），同一张图并发保存会互相串参数，
+    所以先复制一份再保存，也不会改动调用者的图片。
+    """
+    img = img.copy()
     buffer = BytesIO()
-    quality = 95
-    while quality > 10:
-        buffer.seek(0)
-        img.save(buffer, format="JPEG", quality=quality, optimize=True)
-        if len(buffer.getvalue()) / 1024 <= target_kb:
-            break
-        quality -= 5
+    extra = extra or {}
+    if fmt == "WEBP":
+        img.save(buffer, format="WEBP", quality=quality, method=4, **extra)
+    else:
+        img.save(buffer, format="JPEG", quality=quality, optimize=True, subsampling=subsampling, **extra)
     return buffer.getvalue()
+
+
+class _SizeModel:
+    """
+    用采样图估算整图在不同 (质量, 色度抽样, 缩放) 下的编码大小。
+
+    采样图由原图上均匀分布的 4x4 个小块拼成，保持原图的细节密度；
+    估算值 = 文件头开销 + 采样图数据量 x 像素数之比，再乘以按实际编码结果校准的系数。
+    """
+
+    GRID = 4
+    PATCH = 128
+
+    def __init__(self, img, fmt="JPEG", extra=None):
+        self.fmt = fmt
+        self.extra = extra  # 元数据等附加参数，计入文件头开销
+        w, h = img.size
+        patch = min(self.PATCH, w // self.GRID, h // self.GRID)
+        if patch < 16:
+            self.sample = img
+        else:
+            self.sample = Image.new(img.mode, (patch * self.GRID, patch * self.GRID))
+            for i in range(self.GRID):
+                for j in range(self.GRID):
+                    x = (w - patch) * (2 * i + 1) // (2 * self.GRID)
+                    y = (h - patch) * (2 * j + 1) // (2 * self.GRID)
+                    self.sample.paste(img.crop((x, y, x + patch, y + patch)), (i * patch, j * patch))
+        self.ratio = (w * h) / (self.sample.width * self.sample.height)
+        self.correction = 1.0
+        self._samples = {}  # scale -> 缩放后的采样图
+        self._cache = {}  # (quality, subsampling, scale) -> 未校准的估算字节数
+
+    def _raw_estimate(self, quality, subsampling, scale):
+        key = (quality, subsampling, scale)
+        if key not in self._cache:
+            sample = self._samples.get(scale)
+            if sample is None:
+                sample = self.sample
+                if scale != 1.0:
+                    size = (max(8, round(sample.width * scale)), max(8, round(sample.height * scale)))
+                    sample = sample.resize(size, Image.Resampling.LANCZOS)
+                self._samples[scale] = sample
+            header = len(_encode_image(Image.new(sample.mode, (8, 8)), self.fmt, quality, subsampling, self.extra))
+            data = len(_encode_image(sample, self.fmt, quality, subsampling, self.extra)) - header
+            self._cache[key] = header + max(0, data) * self.ratio
+        return self._cache[key]
+
+    def estimate(self, quality, subsampling, scale=1.0):
+        return self._raw_estimate(quality, subsampling, scale) * self.correction
+
+    def calibrate(self, actual, quality, subsampling, scale=1.0):
+        """用一次整图编码的实际大小修正估算系数"""
+        self.correction = actual / max(1.0, self._raw_estimate(quality, subsampling, scale))
+
+    def best_quality(self, target, subsampling, scale=1.0):
+        """估算不超过 target 的最高质量，最低质量也超出时返回 None"""
+        lo, hi = JPEG_MIN_QUALITY, JPEG_MAX_QUALITY
+        if self.estimate(lo, subsampling, scale) > target:
+            return None
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.estimate(mid, subsampling, scale) <= target:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def fit_scale(self, target, subsampling, quality=75):
+        """估算在 quality 下放得进 target 的缩放比例（编码大小大致与像素数成正比）"""
+        scale = 1.0
+        for _ in range(3):
+            size = self.estimate(quality, subsampling, scale)
+            if size <= target:
+                break
+            scale = round(scale * math.sqrt(target / size) * 0.95, 3)
+        return max(0.05, scale)
+
+
+def _spread(center, lo, hi, count):
+    """以 center 为中心在 [lo, hi] 内取至多 count 个不同的质量值"""
+    step = max(1, min(4, (hi - lo) // max(1, count)))
+    values = [center]
+    offset = 1
+    while len(values) < count and (center - offset * step >= lo or center + offset * step <= hi):
+        for q in (center - offset * step, center + offset * step):
+            if lo <= q <= hi and len(values) < count:
+                values.append(q)
+        offset += 1
+    return values
+
+
+def encode_to_target(img, target_bytes, fmt="JPEG", max_rounds=4, metadata=None):
+    """
+    编码为不超过 target_bytes 的 JPEG/WEBP 字节，尽量保留最高的质量。
+    metadata(img) 返回要写入的元数据参数，元数据计入目标大小。
+
+    先用采样图估算出合适的质量，再把估算值附近的几组参数放进线程池同时编码，
+    取放得下的质量最高者，并据此收窄区间；整图编码最多 max_rounds 轮。
+    只调质量达不到目标时，依次改用 4:2:0 色度抽样（仅 JPEG）、缩小分辨率。
+    都达不到时返回编码过的最小结果。
+    """
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    scaled = {1.0: img}
+    extras = {}  # scale -> 该尺寸下的元数据参数
+
+    def work_image(scale):
+        if scale not in scaled:
+            size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            scaled[scale] = img.resize(size, Image.Resampling.LANCZOS)
+        return scaled[scale]
+
+    def extra_for(scale):
+        if metadata is None:
+            return None
+        if scale not in extras:
+            extras[scale] = metadata(work_image(scale))
+        return extras[scale]
+
+    model = _SizeModel(img, fmt, extra_for(1.0))
+    pool = _get_encode_pool()
+    width = ENCODE_WORKERS
+
+    # 依次尝试：4:4:4 保留色度 -> 4:2:0 抽样 -> 4:2:0 并缩小尺寸；WEBP 只有后两档
+    if fmt == "JPEG":
+        plans = [("4:4:4", 1.0), ("4:2:0", 1.0)]
+    else:
+        plans = [(None, 1.0)]
+    plans.append((plans[-1][0], model.fit_scale(target_bytes, plans[-1][0])))
+    states = [{"lo": JPEG_MIN_QUALITY, "hi": JPEG_MAX_QUALITY, "best": None} for _ in plans]
+    smallest = None
+
+    def guess_for(index):
+        subsampling, scale = plans[index]
+        state = states[index]
+        q = model.best_quality(target_bytes, subsampling, scale)
+        if q is None:
+            return None
+        return min(state["hi"], max(state["lo"], q))
+
+    i = 0
+    rounds = 0
+    while i < len(plans) and rounds < max_rounds:
+        subsampling, scale = plans[i]
+        state = states[i]
+        last = i == len(plans) - 1
+        if state["lo"] > state["hi"]:
+            if state["best"]:
+                break
+            i += 1
+            continue
+        guess = guess_for(i)
+        if guess is None:
+            if not last and not state["best"]:
+                i += 1  # 估算表明这一档放不下，不必整图编码
+                continue
+            guess = state["lo"]
+        if state["best"] and guess <= state["best"][0]:
+            break  # 估算表明更高质量已放不下
+
+        # 本档估算值附近的几个质量；本档还没有结果时留一个位置给下一档
+        count = width
+        candidates = []
+        if not state["best"] and not last and width > 1:
+            next_guess = guess_for(i + 1)
+            if next_guess is not None:
+                candidates.append((i + 1, next_guess))
+                count -= 1
+        candidates = [(i, q) for q in _spread(guess, state["lo"], state["hi"], count)] + candidates
+
+        futures = [pool.submit(_encode_image, work_image(plans[j][1]), fmt, q, plans[j][0], extra_for(plans[j][1]))
+                   for j, q in candidates]
+        rounds += 1
+        for (j, q), future in zip(candidates, futures):
+            data = future.result()
+            if smallest is None or len(data) < len(smallest):
+                smallest = data
+            st = states[j]
+            if len(data) <= target_bytes:
+                if not st["best"] or q > st["best"][0]:
+                    st["best"] = (q, data)
+                st["lo"] = max(st["lo"], q + 1)
+            else:
+                st["hi"] = min(st["hi"], q - 1)
+            if j == i and q == guess:
+                model.calibrate(len(data), q, plans[j][0], plans[j][1])
+
+        if not state["best"] and state["lo"] > state["hi"]:
+            i += 1
+
+    for state in states:
+        if state["best"]:
+            return state["best"][1]
+    return smallest
+
+
+def auto_compress(img, target_kb=800, max_encodes=4, metadata=None):
+    """把图片压缩为不超过 target_kb 的 JPEG 字节，整图编码最多 max_encodes 轮（每轮并行若干候选）"""
+    return encode_to_target(img, target_kb * 1024, "JPEG", max_rounds=max_encodes, metadata=metadata)
+
+
+# --- 原子保存 ---
+class _ProgressWriter:
+    """包装文件对象，统计写入的字节数并回调 progress(已写入字节数)"""
+
+    def __init__(self, fp, progress):
+        self._fp = fp
+        self._progress = progress
+        self.written = 0
+
+    def write(self, data):
+        n = self._fp.write(data)
+        self.written += len(data)
+        self._progress(self.written)
+        return n
+
+    def __getattr__(self, name):
+        # 不暴露 fileno，让 Pillow 分块调用 write，进度才能逐块更新
+        if name == "fileno":
+            raise AttributeError(name)
+        return getattr(self._fp, name)
+
+
+def atomic_save(path, write, progress=None):
+    """
+    把 write(fp) 写出的内容先写到同目录的临时文件，完成后原子替换 path。
+    中途失败时不会留下写了一半的目标文件。progress(已写入字节数) 在每次写入后调用。
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".saving-", suffix=os.path.splitext(path)[1], dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            write(_ProgressWriter(fp, progress) if progress else fp)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def save_image_atomic(img, path, progress=None, format=None, **save_kwargs):
+    """通过 atomic_save 保存图片；没有指定 format 时按扩展名确定格式"""
+    fmt = format or Image.registered_extensions().get(os.path.splitext(path)[1].lower(), "JPEG")
+    if fmt == "JPEG" and img.mode not in ("RGB", "L", "CMYK"):
+        img = img.convert("RGB")
+    atomic_save(path, lambda fp: img.save(fp, format=fmt, **save_kwargs), progress)
+
+
+# --- JPEG 无损变换 ---
+# 只做 90° 旋转、翻转和按 MCU 对齐的裁剪时，可以用 jpegtran 直接在 DCT 系数上变换，
+# 不解码也不重新压缩。没有安装 jpegtran 时调用方退回普通保存。
+JPEGTRAN = shutil.which("jpegtran")
+
+# 像素坐标（以图片中心为原点）上的 2x2 变换矩阵 -> jpegtran 参数
+_LOSSLESS_MATRICES = {
+    ((1, 0), (0, 1)): [],
+    ((-1, 0), (0, 1)): ["-flip", "horizontal"],
+    ((1, 0), (0, -1)): ["-flip", "vertical"],
+    ((0, -1), (1, 0)): ["-rotate", "90"],
+    ((-1, 0), (0, -1)): ["-rotate", "180"],
+    ((0, 1), (-1, 0)): ["-rotate", "270"],
+    ((0, 1), (1, 0)): ["-transpose"],
+    ((0, -1), (-1, 0)): ["-transverse"],
+}
+_LOSSLESS_OPS = {
+    ("rotate", 90): ((0, -1), (1, 0)),  # 顺时针
+    ("rotate", 180): ((-1, 0), (0, -1)),
+    ("rotate", 270): ((0, 1), (-1, 0)),
+    ("flip", "horizontal"): ((-1, 0), (0, 1)),
+    ("flip", "vertical"): ((1, 0), (0, -1)),
+}
+
+
+def jpeg_mcu_size(img):
+    """返回 JPEG 的 MCU 宽高，无法确定时返回 None"""
+    if getattr(img, "format", None) != "JPEG":
+        return None
+    if img.mode == "L":
+        return (8, 8)
+    from PIL import JpegImagePlugin
+    return {0: (8, 8), 1: (16, 8), 2: (16, 16)}.get(JpegImagePlugin.get_sampling(img))
+
+
+def lossless_mcu(mcu, ops):
+    """经过 ops 中的旋转后 MCU 在当前方向上的宽高"""
+    w, h = mcu
+    for op in ops:
+        if op in (("rotate", 90), ("rotate", 270)):
+            w, h = h, w
+    return (w, h)
+
+
+def _matmul(a, b):
+    return tuple(tuple(sum(a[i][k] * b[k][j] for k in range(2)) for j in range(2)) for i in range(2))
+
+
+def _lossless_steps(ops):
+    """把连续的旋转/翻转合并成一次 jpegtran 变换，裁剪单独成一步"""
+    steps = []
+    matrix = ((1, 0), (0, 1))
+    for op in ops:
+        if op[0] == "crop":
+            if _LOSSLESS_MATRICES[matrix]:
+                steps.append(_LOSSLESS_MATRICES[matrix])
+            matrix = ((1, 0), (0, 1))
+            x, y, w, h = op[1]
+            steps.append(["-crop", f"{w}x{h}+{x}+{y}"])
+        else:
+            matrix = _matmul(_LOSSLESS_OPS[op], matrix)
+    if _LOSSLESS_MATRICES[matrix]:
+        steps.append(_LOSSLESS_MATRICES[matrix])
+    return steps
+
+
+def lossless_jpeg_transform(src, dst, ops, expected_size=None):
+    """
+    用 jpegtran 把 ops 依次无损应用到 JPEG 文件 src 上并写到 dst，成功返回 True。
+    ops 的元素为 ("rotate", 90/180/270)（顺时针）、("flip", "horizontal"/"vertical")
+    或 ("crop", (x, y, w, h))。边缘有不完整 MCU 而无法无损变换时返回 False，
+    此时 dst 不会被改动。
+    """
+    steps = _lossless_steps(ops)
+    if steps and not JPEGTRAN:
+        return False
+
+    out_dir = os.path.dirname(os.path.abspath(dst))
+    temps = []
+    try:
+        current = src
+        for args in steps:
+            fd, out = tempfile.mkstemp(suffix=".jpg", dir=out_dir)
+            os.close(fd)
+            temps.append(out)
+            cmd = [JPEGTRAN, "-copy", "all", "-perfect", *args, "-outfile", out, current]
+            result = subprocess.run(cmd, capture_output=True, timeout=120)
+            if result.returncode != 0:
+                print(f"无损变换失败: {result.stderr.decode(errors='ignore').strip()}")
+                return False
+            current = out
+
+        if not steps:
+            fd, out = tempfile.mkstemp(suffix=".jpg", dir=out_dir)
+            os.close(fd)
+            temps.append(out)
+            shutil.copyfile(src, out)
+            current = out
+
+        if expected_size is not None:
+            with Image.open(current) as check:
+                if check.size != tuple(expected_size):
+                    print(f"无损变换结果尺寸不符: {check.size} != {tuple(expected_size)}")
+                    return False
+        os.replace(current, dst)
+        temps.remove(current)
+        return True
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"无损变换失败: {e}")
+        return False
+    finally:
+        for path in temps:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+TESSELLATION_SHAPES = ("triangle", "hexagon", "circle")
+
+
+def _axis_cells(coords, step, offset=0.0):
+    """一维方向上求最近的格点序号，以及像素到格点中心的距离平方"""
+    index = np.floor((coords - offset) / step + 0.5)
+    dist = (coords - offset - index * step) ** 2
+    index = index.astype(np.int32)
+    index -= index.min()
+    return index, dist, int(index.max()) + 1
+
+
+def _hexagon_labels(w, h, cell):
+    """尖顶六边形网格：两套错开的矩形格点，取最近的中心即为六边形的 Voronoi 划分"""
+    x = np.arange(w, dtype=np.float32) + 0.5
+    y = np.arange(h, dtype=np.float32) + 0.5
+    radius = cell / math.sqrt(3)  # 六边形外接圆半径，宽度正好等于 cell
+    dx, dy = float(cell), 3 * radius
+
+    ax, ax_d, nax = _axis_cells(x, dx)
+    ay, ay_d, nay = _axis_cells(y, dy)
+    bx, bx_d, nbx = _axis_cells(x, dx, dx / 2)
+    by, by_d, _ = _axis_cells(y, dy, 1.5 * radius)
+
+    nearer_a = (ay_d[:, None] + ax_d[None, :]) <= (by_d[:, None] + bx_d[None, :])
+    labels_a = ay[:, None] * nax + ax[None, :]
+    labels_b = (by[:, None] * nbx + bx[None, :]) + nax * nay
+    return np.where(nearer_a, labels_a, labels_b)
+
+
+def _triangle_labels(w, h, cell):
+    """等边三角形网格：每行由朝上/朝下的三角形交替组成，奇数行错开半个边长"""
+    x = np.arange(w, dtype=np.float32) + 0.5
+    y = np.arange(h, dtype=np.float32) + 0.5
+    row_h = cell * math.sqrt(3) / 2
+    row = np.floor(y / row_h).astype(np.int32)
+    fy = (y / row_h - row).astype(np.float32)  # 行内纵向位置，0 为顶边，1 为底边
+
+    # 以"/"和"\"两组斜线分割，每个三角形对应两组斜线条带序号之和
+    u = (x / cell)[None, :] + (0.5 * (row % 2)).astype(np.float32)[:, None]
+    a = np.floor(u + (0.5 * fy - 0.5)[:, None])
+    b = np.floor(u - (0.5 * fy + 0.5)[:, None])
+    cols = 2 * (-(-w // cell)) + 6
+    return (row[:, None] * cols + (a + b + 2).astype(np.int32))
+
+
+def _circle_labels(w, h, cell):
+    """圆点网格：内切圆内取所在方格的平均色，圆外的缝隙按错开半格的网格单独取色"""
+    x = np.arange(w, dtype=np.float32) + 0.5
+    y = np.arange(h, dtype=np.float32) + 0.5
+    cx = np.floor(x / cell).astype(np.int32)
+    cy = np.floor(y / cell).astype(np.int32)
+    ncx = int(cx.max()) + 1
+    dist = ((y - (cy + 0.5) * cell) ** 2)[:, None] + ((x - (cx + 0.5) * cell) ** 2)[None, :]
+
+    gx = np.floor(x / cell + 0.5).astype(np.int32)
+    gy = np.floor(y / cell + 0.5).astype(np.int32)
+    ngx = int(gx.max()) + 1
+    inside = dist <= (cell / 2) ** 2
+    labels_dot = cy[:, None] * ncx + cx[None, :]
+    labels_gap = (gy[:, None] * ngx + gx[None, :]) + ncx * (int(cy.max()) + 1)
+    return np.where(inside, labels_dot, labels_gap)
+
+
+def tessellate(img, shape, cell):
+    """
+    几何镶嵌马赛克：把图像划分为三角形/六边形/圆形单元，每个单元填充其平均颜色
+    :param img: 原始图像
+    :param shape: "triangle", "hexagon" 或 "circle"
+    :param cell: 单元边长（像素）
+    :return: 马赛克图像；未安装 numpy 时返回 None
+    """
+    if np is None:
+        return None
+    img = img.convert("RGB")
+    w, h = img.size
+    cell = max(2, int(cell))
+    if shape == "hexagon":
+        labels = _hexagon_labels(w, h, cell)
+    elif shape == "triangle":
+        labels = _triangle_labels(w, h, cell)
+    elif shape == "circle":
+        labels = _circle_labels(w, h, cell)
+    else:
+        raise ValueError(f"不支持的镶嵌形状: {shape}")
+
+    # 按单元编号做 bincount 归约求平均色，再按编号查表回填
+    flat = labels.ravel().astype(np.intp)
+    del labels
+    cells = int(flat.max()) + 1
+    pixels = np.asarray(img).reshape(-1, 3)
+    counts = np.maximum(np.bincount(flat, minlength=cells), 1)
+    palette = np.empty((cells, 3), dtype=np.uint8)
+    for c in range(3):
+        sums = np.bincount(flat, weights=pixels[:, c], minlength=cells)
+        palette[:, c] = np.rint(sums / counts)
+    return Image.fromarray(np.take(palette, flat, axis=0).reshape(h, w, 3), "RGB")
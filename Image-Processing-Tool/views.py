@@ -5,6 +5,8 @@ import os
 import sys
 from config import COLORS
 from PIL import Image, ImageTk
+from utils import get_thumbnail
+import encoders
 
 # 获取资源文件路径
 def get_resource_path(relative_path):
@@ -134,9 +136,11 @@ class ModernEditorView(tk.Tk):
         # 确保滚动条始终可见，设置滚动增量
         self.scroll_canvas.configure(yscrollincrement=1)
 
-        # 内容容器，实际的面板内容将放在这里
-        self.panel_content = tk.Frame(self.scroll_canvas, bg=COLORS["bg_panel"])
-        self.content_window = self.scroll_canvas.create_window((0, 0), window=self.panel_content, anchor=tk.NW, width=290)
+        # 内容容器，各工具面板作为子框架放在这里，切换工具时只显示/隐藏
+        self.panel_host = tk.Frame(self.scroll_canvas, bg=COLORS["bg_panel"])
+        self.content_window = self.scroll_canvas.create_window((0, 0), window=self.panel_host, anchor=tk.NW, width=290)
+        # 当前工具的面板框架，面板构建方法都往这里添加控件
+        self.panel_content = None
 
         # 绑定鼠标滚轮事件，实现平滑滚动
         def _on_mousewheel(event):
@@ -146,19 +150,24 @@ class ModernEditorView(tk.Tk):
         def update_scrollregion(event):
             # 设置滚动区域，确保内容可以滚动
             self.scroll_canvas.configure(scrollregion=self.scroll_canvas.bbox("all"))
-            if event.widget == self.panel_content:
+            if event.widget == self.panel_host:
                 self.scroll_canvas.itemconfig(self.content_window, width=event.width)
             # 强制更新滚动条状态
             self.scrollbar.update()
             self.scroll_canvas.update()
 
-        self.panel_content.bind("<Configure>", update_scrollregion)
+        self.panel_host.bind("<Configure>", update_scrollregion)
         self.scroll_canvas.bind("<MouseWheel>", _on_mousewheel)
-        self.panel_content.bind("<MouseWheel>", _on_mousewheel)
+        self.panel_host.bind("<MouseWheel>", _on_mousewheel)
         
-        # 创建底部固定控制区域
-        self.bottom_control_frame = ttk.Frame(self.prop_panel, style="TFrame")
-        self.bottom_control_frame.pack(side=tk.BOTTOM, fill=tk.X, padx=5, pady=(5, 20))
+        # 创建底部固定控制区域，同样按工具放置子框架
+        self.bottom_host = ttk.Frame(self.prop_panel, style="TFrame")
+        self.bottom_host.pack(side=tk.BOTTOM, fill=tk.X, padx=5, pady=(5, 20))
+        self.bottom_control_frame = None
+        
+        # 已构建的面板：工具名 -> (面板框架, 底部控制框架)
+        self._panels = {}
+        self._current_panel = None
 
         # 2.3 中间画布 (Canvas) - 图片编辑的主要区域
         canvas_frame = tk.Frame(main_container, bg=COLORS["bg_main"])
@@ -207,9 +216,15 @@ class ModernEditorView(tk.Tk):
         self.bind("<Control-z>", lambda e: self._undo())
         self.bind("<Control-y>", lambda e: self._redo())
         self.bind("<Control-s>", lambda e: self._save_image())
+        self.bind("<Escape>", lambda e: self.controller.cancel_open())
     
-    def show_panel(self, tool_name):
-        """切换右侧面板内容"""
+    def show_panel(self, tool_name, rebuild=False):
+        """切换右侧面板内容
+
+        面板只在第一次显示时构建，之后切换工具只是隐藏/显示已有控件，
+        再执行该面板的激活步骤（绑定画布事件、初始化工具）。
+        :param rebuild: 为 True 时丢弃缓存的面板重新构建，用于把控件恢复为初始状态
+        """
         # 如果从其他工具切换过来，先应用更改
         self.controller._apply_pending_changes()
 
@@ -222,11 +237,14 @@ class ModernEditorView(tk.Tk):
         self.canvas.unbind("<ButtonPress-3>")
         self.canvas.config(cursor="")
 
-        # 清空面板和底部控制区域
-        for widget in self.panel_content.winfo_children():
-            widget.destroy()
-        for widget in self.bottom_control_frame.winfo_children():
-            widget.destroy()
+        # 隐藏当前面板，控件保留下来供下次直接显示
+        if self._current_panel in self._panels:
+            for frame in self._panels[self._current_panel]:
+                frame.pack_forget()
+        if rebuild and tool_name in self._panels:
+            for frame in self._panels.pop(tool_name):
+                frame.destroy()
+        self._current_panel = tool_name
 
         # 根据工具构建 UI
         titles = {
@@ -237,30 +255,34 @@ class ModernEditorView(tk.Tk):
         }
         self.panel_title.config(text=titles.get(tool_name, "工具"))
 
-        if tool_name == "adjust":
-            self._build_adjust_panel()
-        elif tool_name == "filter":
-            self._build_filter_panel()
-        elif tool_name == "crop":
-            self._build_crop_panel()
-        elif tool_name == "text":
-            self._build_text_panel()
-        elif tool_name == "doodle":
-            self._build_doodle_panel()
-        elif tool_name == "mosaic":
-            self._build_mosaic_panel()
-        elif tool_name == "sticker":
-            self._build_sticker_panel()
-        elif tool_name == "batch":
-            self._build_batch_panel()
-        elif tool_name == "batch_convert":
-            self._build_batch_convert_panel()
-        elif tool_name == "batch_watermark":
-            self._build_batch_watermark_panel()
+        if tool_name in self._panels:
+            self.panel_content, self.bottom_control_frame = self._panels[tool_name]
+        else:
+            self.panel_content = tk.Frame(self.panel_host, bg=COLORS["bg_panel"])
+            self.bottom_control_frame = ttk.Frame(self.bottom_host, style="TFrame")
+            builder = getattr(self, f"_build_{tool_name}_panel", None)
+            if builder:
+                builder()
+            self._panels[tool_name] = (self.panel_content, self.bottom_control_frame)
+        self.panel_content.pack(fill=tk.X)
+        self.bottom_control_frame.pack(fill=tk.X)
+        self.scroll_canvas.yview_moveto(0)
+
+        # 每次显示面板都要执行的激活步骤
+        activator = getattr(self, f"_activate_{tool_name}_panel", None)
+        if activator:
+            activator()
+    
+    def discard_panels(self):
+        """丢弃除当前面板外缓存的编辑面板（批量处理面板保留），打开新图片后各面板按初始状态重新构建"""
+        for name in [n for n in self._panels if n != self._current_panel and not n.startswith("batch")]:
+            for frame in self._panels.pop(name):
+                frame.destroy()
     
     # 面板构建方法
     def _build_adjust_panel(self):
         """构建调节滑块"""
+        self.adjust_scales = {}
         self._create_slider("亮度", "brightness", 0.5, 1.5)
         self._create_slider("对比度", "contrast", 0.5, 1.5)
         self._create_slider("饱和度", "saturation", 0.0, 2.0)
@@ -269,6 +291,11 @@ class ModernEditorView(tk.Tk):
         ttk.Button(self.panel_content, text="应用调节", command=self.controller._apply_adjust).pack(pady=20, fill=tk.X)
         ttk.Label(self.panel_content, text="* 拖动滑块实时预览", foreground="#888888").pack()
 
+    def _activate_adjust_panel(self):
+        """滑块位置与当前调节参数同步（离开面板时参数可能已被重置）"""
+        for param_key, scale in self.adjust_scales.items():
+            scale.configure(value=self.controller.temp_adjustments[param_key])
+
     def _create_slider(self, label, param_key, min_v, max_v):
         frame = tk.Frame(self.panel_content, bg=COLORS["bg_panel"])
         frame.pack(fill=tk.X, pady=5)
@@ -277,6 +304,7 @@ class ModernEditorView(tk.Tk):
         scale = ttk.Scale(frame, from_=min_v, to=max_v, value=self.controller.temp_adjustments[param_key],
                           command=lambda v: self.controller._on_adjust_change(param_key, float(v)))
         scale.pack(fill=tk.X)
+        self.adjust_scales[param_key] = scale
     
     def _build_filter_panel(self):
         """构建滤镜面板"""
@@ -452,12 +480,24 @@ class ModernEditorView(tk.Tk):
         ttk.Button(self.panel_content, text="选择描边颜色", command=self.controller._choose_stroke_color).pack(fill=tk.X, pady=5)
         self.controller.watermark_stroke_color = (0, 0, 0)
         
+        # 平铺水印：旋转后铺满整张图片
+        self.controller.watermark_tile_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.panel_content, text="平铺水印", variable=self.controller.watermark_tile_var,
+                        command=self.controller._update_text_preview).pack(anchor=tk.W, pady=(10, 5))
+        self.controller.watermark_tile_angle_var = tk.IntVar(value=30)
+        self._create_labeled_scale("平铺角度:", self.controller.watermark_tile_angle_var, -90, 90,
+                                   command=lambda v: self.controller._update_text_preview())
+        self.controller.watermark_tile_spacing_var = tk.IntVar(value=100)
+        self._create_labeled_scale("平铺间距:", self.controller.watermark_tile_spacing_var, 0, 400,
+                                   command=lambda v: self.controller._update_text_preview())
+        
         # 添加水印按钮
         ttk.Button(self.panel_content, text="✔ 添加到图片", command=self.controller._add_text_watermark).pack(pady=20, fill=tk.X)
         ttk.Label(self.panel_content, text="* 可直接拖动文字调整位置", foreground="#888888").pack()
         ttk.Label(self.panel_content, text="* 右键点击水印可删除", foreground="#888888").pack()
-        
-        # 初始化文字水印实例并绑定事件
+    
+    def _activate_text_panel(self):
+        """初始化文字水印实例并绑定事件"""
         if self.controller.editing_image:
             self.controller._update_text_preview()
             # 绑定事件
@@ -492,8 +532,9 @@ class ModernEditorView(tk.Tk):
         tk.Button(self.panel_content, text="✔ 结束绘制", bg=COLORS["accent"], fg="white", 
                  command=self.controller._apply_doodle).pack(fill=tk.X, pady=20)
         ttk.Label(self.panel_content, text="* 绘制过程中可撤销", foreground="#888888").pack()
-        
-        # 初始化涂鸦工具
+    
+    def _activate_doodle_panel(self):
+        """初始化涂鸦工具"""
         if self.controller.editing_image:
             self.controller._init_doodle_tool()
     
@@ -519,6 +560,11 @@ class ModernEditorView(tk.Tk):
             ("像素化", "pixel"),
             ("模糊", "blur")
         ], self.controller.mosaic_type_var, self.controller._on_mosaic_type_change)
+        self._create_radio_group("几何镶嵌:", [
+            ("三角形", "triangle"),
+            ("六边形", "hexagon"),
+            ("圆形", "circle")
+        ], self.controller.mosaic_type_var, self.controller._on_mosaic_type_change)
 
         # 马赛克大小 - 使用辅助函数创建标签和滑块组合
         self._create_labeled_scale("马赛克大小:", self.controller.mosaic_size_var, 10, 200, 
@@ -527,8 +573,9 @@ class ModernEditorView(tk.Tk):
         # 结束马赛克按钮
         ttk.Button(self.panel_content, text="✔ 结束马赛克", command=self.controller._apply_mosaic).pack(pady=20, fill=tk.X)
         ttk.Label(self.panel_content, text="* 绘制过程中可撤销", foreground="#888888").pack()
-
-        # 初始化马赛克工具
+    
+    def _activate_mosaic_panel(self):
+        """初始化马赛克工具"""
         if self.controller.editing_image:
             self.controller._init_mosaic_tool()
     
@@ -588,65 +635,67 @@ class ModernEditorView(tk.Tk):
         sticker_grid.bind("<MouseWheel>", on_sticker_mousewheel)
         
         # 每行显示3个贴纸
-        row = 0
-        col = 0
         thumb_size = (70, 70)  # 调整贴纸大小，优化显示效果
         
-        # 优化贴纸加载和显示
+        # 先用透明占位图创建全部按钮，缩略图等滚动到可见区域时再加载
+        placeholder = ImageTk.PhotoImage(Image.new('RGBA', thumb_size, (255, 255, 255, 0)))
+        pending_buttons = []
         for i, sticker_path in enumerate(self.controller.sticker_files):
-            try:
-                # 跳过损坏的文件，减少错误处理开销
-                sticker_img = Image.open(sticker_path)
-                # 处理带有透明通道的调色板图像
-                if sticker_img.mode == 'P' and 'transparency' in sticker_img.info:
-                    sticker_img = sticker_img.convert('RGBA')
-                
-                # 计算缩放比例，保持原始比例
-                original_width, original_height = sticker_img.size
-                scale = min(thumb_size[0] / original_width, thumb_size[1] / original_height)
-                new_width = int(original_width * scale)
-                new_height = int(original_height * scale)
-                
-                # 高质量缩放
-                resized_sticker = sticker_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                
-                # 处理透明背景
-                display_sticker = Image.new('RGBA', thumb_size, (255, 255, 255, 0))
-                x = (thumb_size[0] - new_width) // 2
-                y = (thumb_size[1] - new_height) // 2
-                
-                if resized_sticker.mode == 'RGBA':
-                    display_sticker.paste(resized_sticker, (x, y), resized_sticker)
-                else:
-                    rgba_sticker = resized_sticker.convert('RGBA')
-                    display_sticker.paste(rgba_sticker, (x, y), rgba_sticker)
-                
-                sticker_tk = ImageTk.PhotoImage(display_sticker)
-                
-                # 创建贴纸按钮
-                sticker_btn = tk.Button(sticker_grid, image=sticker_tk, 
-                                      bg=COLORS["bg_tool"], 
-                                      bd=1, 
-                                      relief="raised",
-                                      highlightthickness=1,
-                                      highlightbackground=COLORS["accent"],
-                                      width=thumb_size[0],
-                                      height=thumb_size[1],
-                                      command=lambda path=sticker_path: self.controller._select_sticker(path))
-                sticker_btn.image = sticker_tk  # 保存引用
-                
-                # 网格布局，每行3个
-                sticker_btn.grid(row=row, column=col, padx=5, pady=5, sticky="nsew")
-                
-                # 递增行列计数
-                col += 1
-                if col >= 3:
-                    col = 0
-                    row += 1
-            except Exception as e:
-                # 忽略无法加载的文件
-                print(f"无法加载贴纸文件 {sticker_path}: {e}")
-                continue
+            # 创建贴纸按钮
+            sticker_btn = tk.Button(sticker_grid, image=placeholder, 
+                                  bg=COLORS["bg_tool"], 
+                                  bd=1, 
+                                  relief="raised",
+                                  highlightthickness=1,
+                                  highlightbackground=COLORS["accent"],
+                                  width=thumb_size[0],
+                                  height=thumb_size[1],
+                                  command=lambda path=sticker_path: self.controller._select_sticker(path))
+            sticker_btn.image = placeholder  # 保存引用
+            sticker_btn.sticker_path = sticker_path
+            sticker_btn.bind("<MouseWheel>", on_sticker_mousewheel)
+            
+            # 网格布局，每行3个
+            sticker_btn.grid(row=i // 3, column=i % 3, padx=5, pady=5, sticky="nsew")
+            pending_buttons.append(sticker_btn)
+        
+        load_job = [None]
+        
+        def load_visible_thumbnails():
+            """加载可见区域（上下各多预取一屏）内尚未加载的缩略图"""
+            load_job[0] = None
+            if not sticker_canvas.winfo_exists():
+                return
+            view_h = sticker_canvas.winfo_height()
+            top = sticker_canvas.canvasy(0) - view_h
+            bottom = sticker_canvas.canvasy(0) + view_h * 2
+            for btn in list(pending_buttons):
+                y = btn.winfo_y()
+                if y + btn.winfo_height() < top or y > bottom:
+                    continue
+                pending_buttons.remove(btn)
+                try:
+                    sticker_tk = ImageTk.PhotoImage(get_thumbnail(btn.sticker_path, thumb_size))
+                except Exception as e:
+                    # 跳过损坏的文件
+                    print(f"无法加载贴纸文件 {btn.sticker_path}: {e}")
+                    btn.config(state=tk.DISABLED)
+                    continue
+                btn.config(image=sticker_tk)
+                btn.image = sticker_tk  # 保存引用
+        
+        def schedule_thumbnail_load(*args):
+            if pending_buttons and load_job[0] is None:
+                load_job[0] = sticker_canvas.after_idle(load_visible_thumbnails)
+        
+        # 滚动或尺寸变化时检查是否有新的贴纸进入可见区域
+        def on_sticker_yscroll(first, last):
+            sticker_scrollbar.set(first, last)
+            schedule_thumbnail_load()
+        
+        sticker_canvas.config(yscrollcommand=on_sticker_yscroll)
+        sticker_grid.bind("<Configure>", schedule_thumbnail_load, add="+")
+        sticker_canvas.bind("<Configure>", schedule_thumbnail_load, add="+")
         
         # 提示文本
         ttk.Label(self.panel_content, text="* 点击贴纸添加到图片，添加后可拖动调整位置", foreground="#888888").pack(pady=10)
@@ -701,8 +750,9 @@ class ModernEditorView(tk.Tk):
         self.sticker_scale_entry.bind("<FocusOut>", lambda e: self.controller._update_sticker_style(self.sticker_scale_var.get(), self.controller.sticker_rotation))
         self.sticker_rotation_entry.bind("<Return>", lambda e: self.controller._update_sticker_style(self.controller.sticker_scale, self.sticker_rotation_var.get()))
         self.sticker_rotation_entry.bind("<FocusOut>", lambda e: self.controller._update_sticker_style(self.controller.sticker_scale, self.sticker_rotation_var.get()))
-        
-        # 绑定画布事件
+    
+    def _activate_sticker_panel(self):
+        """绑定画布事件"""
         if self.controller.editing_image:
             self.canvas.bind("<ButtonPress-1>", self.controller._on_sticker_press)
             self.canvas.bind("<B1-Motion>", self.controller._on_sticker_drag)
@@ -855,7 +905,7 @@ class ModernEditorView(tk.Tk):
         format_container = ttk.Frame(content_frame)
         format_container.pack(fill=tk.X, pady=1, padx=3)
         
-        supported_formats = ["JPG", "PNG", "BMP", "WEBP", "TIFF", "ICO"]
+        supported_formats = encoders.available_formats()
         for i, fmt in enumerate(supported_formats):
             radio_btn = ttk.Radiobutton(format_container, text=fmt, variable=self.controller.batch_convert_vars['target_format_var'], 
                           value=fmt)
@@ -881,6 +931,19 @@ class ModernEditorView(tk.Tk):
         ttk.Button(quick_quality_frame, text="中质量", command=lambda: self.controller.batch_convert_vars['quality_var'].set(70)).pack(side=tk.LEFT, padx=2)
         ttk.Button(quick_quality_frame, text="低质量", command=lambda: self.controller.batch_convert_vars['quality_var'].set(50)).pack(side=tk.LEFT, padx=2)
         
+        # 编码预设：在编码速度和文件大小之间取舍
+        preset_frame = ttk.Frame(content_frame)
+        preset_frame.pack(fill=tk.X, pady=1, padx=3)
+        ttk.Label(preset_frame, text="编码预设:").pack(side=tk.LEFT, padx=3)
+        ttk.Combobox(preset_frame, textvariable=self.controller.batch_convert_vars['preset_var'],
+                     values=encoders.PRESETS, state="readonly", width=6).pack(side=tk.LEFT, padx=3)
+        
+        # 目标大小：JPG/WEBP 按大小自动选择质量
+        target_kb_frame = ttk.Frame(content_frame)
+        target_kb_frame.pack(fill=tk.X, pady=1, padx=3)
+        ttk.Label(target_kb_frame, text="目标大小(KB, 0为不限):").pack(side=tk.LEFT, padx=3)
+        ttk.Entry(target_kb_frame, textvariable=self.controller.batch_convert_vars['target_kb_var'], width=6).pack(side=tk.LEFT, padx=3)
+        
         # 5. 重命名选项
         ttk.Label(content_frame, text="✏️ 重命名", style="Header.TLabel").pack(pady=3, anchor=tk.W, padx=3)
         ttk.Separator(content_frame, orient=tk.HORIZONTAL).pack(fill=tk.X, pady=3)
@@ -1158,6 +1221,25 @@ class ModernEditorView(tk.Tk):
                  orient=tk.HORIZONTAL).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=2)
         ttk.Label(offset_y_frame, textvariable=self.controller.batch_watermark_vars['offset_y_var'], width=3).pack(side=tk.LEFT, padx=2)
         
+        # 平铺水印（启用后忽略位置和偏移）
+        tile_container = ttk.Frame(content_frame)
+        tile_container.pack(fill=tk.X, pady=1, padx=3)
+        ttk.Checkbutton(tile_container, text="平铺水印（忽略位置）", variable=self.controller.batch_watermark_vars['tile_var']).pack(anchor=tk.W, pady=3)
+        
+        tile_angle_frame = ttk.Frame(tile_container)
+        tile_angle_frame.pack(fill=tk.X, pady=5)
+        ttk.Label(tile_angle_frame, text="角度:").pack(side=tk.LEFT, padx=2, anchor=tk.CENTER)
+        ttk.Scale(tile_angle_frame, from_=-90, to=90, variable=self.controller.batch_watermark_vars['tile_angle_var'], 
+                 orient=tk.HORIZONTAL).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=2)
+        ttk.Label(tile_angle_frame, textvariable=self.controller.batch_watermark_vars['tile_angle_var'], width=3).pack(side=tk.LEFT, padx=2)
+        
+        tile_spacing_frame = ttk.Frame(tile_container)
+        tile_spacing_frame.pack(fill=tk.X, pady=5)
+        ttk.Label(tile_spacing_frame, text="间距:").pack(side=tk.LEFT, padx=2, anchor=tk.CENTER)
+        ttk.Scale(tile_spacing_frame, from_=0, to=400, variable=self.controller.batch_watermark_vars['tile_spacing_var'], 
+                 orient=tk.HORIZONTAL).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=2)
+        ttk.Label(tile_spacing_frame, textvariable=self.controller.batch_watermark_vars['tile_spacing_var'], width=3).pack(side=tk.LEFT, padx=2)
+        
         # 6. 进度显示
         ttk.Label(content_frame, text="📊 进度", style="Header.TLabel").pack(pady=3, anchor=tk.W)
         ttk.Separator(content_frame, orient=tk.HORIZONTAL).pack(fill=tk.X, pady=3)